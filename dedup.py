@@ -0,0 +1,229 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+import filecmp
+
+import utils
+import verify
+
+logger = logging.getLogger(__name__)
+
+# bytes hashed at the start and at the end of a file for the partial hash
+partial_size = 65536
+
+
+def partial_hash(path):
+    """SHA-1 of the first and last ``partial_size`` bytes of a file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        digest.update(f.read(partial_size))
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 2*partial_size:
+            f.seek(-partial_size, os.SEEK_END)
+            digest.update(f.read(partial_size))
+    return digest.hexdigest()
+
+
+def full_hash(path):
+    """SHA-1 of the whole contents of a file."""
+    path, digest = verify.hash_file(path)
+    if digest is None:
+        raise IOError("Could not read {}".format(path))
+    return digest
+
+
+def hard_link(existing, link_name):
+    """Create a hard link ``link_name`` to the file ``existing``.
+
+    Python 2 has no ``os.link`` on Windows, where ``CreateHardLinkW`` is called instead.
+    """
+    if hasattr(os, 'link'):
+        os.link(existing, link_name)
+        return
+    import ctypes
+    if not ctypes.windll.kernel32.CreateHardLinkW(unicode(link_name), unicode(existing), None):
+        raise OSError(ctypes.GetLastError(), "Could not create hard link {} to {}".format(link_name, existing))
+
+
+def file_id(path):
+    """Volume serial number and file index of a file, the same for all hard links to it.
+
+    Used on Windows, where Python 2 has no ``os.path.samefile``, through ``GetFileInformationByHandle``.
+    """
+    import msvcrt
+    import ctypes
+    import ctypes.wintypes
+
+    class FileInformation(ctypes.Structure):
+        # BY_HANDLE_FILE_INFORMATION
+        _fields_ = [('dwFileAttributes', ctypes.wintypes.DWORD),
+                    ('ftCreationTime', ctypes.wintypes.FILETIME),
+                    ('ftLastAccessTime', ctypes.wintypes.FILETIME),
+                    ('ftLastWriteTime', ctypes.wintypes.FILETIME),
+                    ('dwVolumeSerialNumber', ctypes.wintypes.DWORD),
+                    ('nFileSizeHigh', ctypes.wintypes.DWORD),
+                    ('nFileSizeLow', ctypes.wintypes.DWORD),
+                    ('nNumberOfLinks', ctypes.wintypes.DWORD),
+                    ('nFileIndexHigh', ctypes.wintypes.DWORD),
+                    ('nFileIndexLow', ctypes.wintypes.DWORD)]
+
+    get_file_information = ctypes.windll.kernel32.GetFileInformationByHandle
+    get_file_information.argtypes = [ctypes.wintypes.HANDLE, ctypes.POINTER(FileInformation)]
+    get_file_information.restype = ctypes.wintypes.BOOL
+
+    info = FileInformation()
+    with open(path, 'rb') as f:
+        if not get_file_information(msvcrt.get_osfhandle(f.fileno()), ctypes.byref(info)):
+            raise OSError(ctypes.GetLastError(), "Could not get file information of {}".format(path))
+    return info.dwVolumeSerialNumber, info.nFileIndexHigh, info.nFileIndexLow
+
+
+def same_file(a, b):
+    """True if two paths are hard links to the same file.
+
+    Also True if that cannot be told, so that the files are not linked again on every run.
+    """
+    if hasattr(os.path, 'samefile'):
+        return os.path.samefile(a, b)
+    try:
+        return file_id(a) == file_id(b)
+    except (ImportError, AttributeError, ValueError, OSError) as e:
+        logger.debug("Could not compare the file ids of {} and {}, not linking them: {}".format(a, b, e))
+        return True
+
+
+class Deduplicator(object):
+    """Replaces files at the target that have identical copies with hard links to one copy.
+
+    Subscribe an instance to a job with :meth:`jobs.Job.subscribe` to collect the files
+    rsync transfers, then call :meth:`run` after the sync. Only those files are looked
+    up in a persistent index of target files, first by size and modification time, then
+    by a hash of their first and last 64 kB, and last by a hash of the whole file. Files
+    are hashed only when another file in the index matches so far, and their hashes are
+    kept in the index. Before linking, the two files are compared byte by byte.
+
+    Only files with the same modification time are linked, so rsync still sees every
+    path at the target with the size and time it expects and does not transfer it again.
+    The directory tree is left as it is; only file contents are shared.
+
+    :param index_file: Path to the index database. Jobs sharing it deduplicate against each other.
+    :type index_file: str
+    :param min_size: Smallest file size worth linking, in bytes.
+    :type min_size: int
+    """
+    def __init__(self, index_file, min_size=1048576):
+        super(Deduplicator, self).__init__()
+        self.index_file = index_file
+        self.min_size = min_size
+        self.transferred = set()
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(index_file, timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                                    "partial_hash TEXT, full_hash TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size, mtime)")
+
+    def __call__(self, event):
+        # files received by rsync, e.g. ">f.st...... 1024 d/docs/file.txt"
+        if isinstance(event, utils.ItemizedChange) and event.change.startswith('>f') and \
+                (event.size is None or event.size >= self.min_size):
+            with self.lock:
+                self.transferred.add(event.path)
+
+    def candidates(self, path, size, mtime):
+        """Indexed files with the same size and modification time, dropping rows of changed or deleted files."""
+        rows = self.connection.execute("SELECT path, partial_hash, full_hash FROM files "
+                                       "WHERE size = ? AND mtime = ? AND path != ?", (size, mtime, path)).fetchall()
+        candidates = []
+        for row in rows:
+            try:
+                st = os.stat(row[0])
+            except OSError:
+                st = None
+            if st is None or st.st_size != size or st.st_mtime != mtime:
+                self.connection.execute("DELETE FROM files WHERE path = ?", (row[0],))
+                continue
+            candidates.append(list(row))
+        return candidates
+
+    def update_hashes(self, path, partial=None, full=None):
+        if partial is not None:
+            self.connection.execute("UPDATE files SET partial_hash = ? WHERE path = ?", (partial, path))
+        if full is not None:
+            self.connection.execute("UPDATE files SET full_hash = ? WHERE path = ?", (full, path))
+
+    def deduplicate_file(self, path):
+        """Index one file and link it to an identical indexed file, if there is one.
+
+        :returns: int -- Number of bytes saved.
+        """
+        st = os.stat(path)
+        if st.st_size < self.min_size:
+            return 0
+        candidates = self.candidates(path, st.st_size, st.st_mtime)
+        self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL, NULL)", (path, st.st_size, st.st_mtime))
+        if not candidates:
+            return 0
+
+        partial = partial_hash(path)
+        self.update_hashes(path, partial=partial)
+        for candidate in candidates:
+            if candidate[1] is None:
+                candidate[1] = partial_hash(candidate[0])
+                self.update_hashes(candidate[0], partial=candidate[1])
+        candidates = [c for c in candidates if c[1] == partial]
+        if not candidates:
+            return 0
+
+        full = full_hash(path)
+        self.update_hashes(path, full=full)
+        for candidate in candidates:
+            if candidate[2] is None:
+                candidate[2] = full_hash(candidate[0])
+                self.update_hashes(candidate[0], full=candidate[2])
+            if candidate[2] != full or same_file(candidate[0], path):
+                continue
+            if not filecmp.cmp(candidate[0], path, shallow=False):
+                continue
+
+            temp_path = path + '.josync-dedup'
+            hard_link(candidate[0], temp_path)
+            try:
+                os.remove(path)
+            except OSError:
+                os.remove(temp_path)
+                raise
+            os.rename(temp_path, path)
+            logger.debug("Linked {} to identical file {}".format(path, candidate[0]))
+            return st.st_size
+        return 0
+
+    def run(self, target_root):
+        """Deduplicate the files transferred since the last call.
+
+        :param target_root: Directory that the paths reported by rsync are relative to.
+        :type target_root: str
+        :returns: dict -- Stats: ``dedup_files`` linked and ``dedup_bytes`` saved.
+        """
+        with self.lock:
+            transferred, self.transferred = self.transferred, set()
+
+        stats = {'dedup_files': 0, 'dedup_bytes': 0}
+        for relative in sorted(transferred):
+            path = os.path.join(target_root, relative)
+            try:
+                with self.connection:
+                    saved = self.deduplicate_file(path)
+            except (IOError, OSError) as e:
+                logger.warning("Could not deduplicate {}: {}".format(path, e))
+                continue
+            if saved:
+                stats['dedup_files'] += 1
+                stats['dedup_bytes'] += saved
+
+        logger.info("Deduplicated {} of {} transferred file(s), saving {:.1f} MB.".format(
+                    stats['dedup_files'], len(transferred), stats['dedup_bytes']/1048576.))
+        return stats
@@ -0,0 +1,213 @@
+import os
+import re
+import logging
+import tempfile
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+
+def split_patterns(excludes):
+    """Normalize a list of excludes from a job file into single rsync patterns.
+
+    Entries may hold several patterns separated by semicolons, e.g. ``"*.pyc;*.pyo"``.
+    Surrounding whitespace and empty patterns are dropped, and duplicates are removed
+    keeping the first occurrence. Backslashes are left alone, as rsync reads them as
+    escapes: paths in patterns need forward slashes.
+
+    :param excludes: List of excludes as written in the job file.
+    :type excludes: list
+    :returns: List of patterns.
+    """
+    patterns = []
+    seen = set()
+    for entry in excludes:
+        for pattern in entry.split(';'):
+            pattern = pattern.strip()
+            if pattern and not pattern in seen:
+                seen.add(pattern)
+                patterns.append(pattern)
+    return patterns
+
+
+def compile_excludes(global_excludes, source_excludes):
+    """Merge the global excludes of a job with the excludes of one source.
+
+    :param global_excludes: Excludes applying to all sources.
+    :type global_excludes: list
+    :param source_excludes: Excludes of the source.
+    :type source_excludes: list
+    :returns: List of patterns, global patterns first and without duplicates.
+    """
+    return split_patterns(list(global_excludes) + list(source_excludes))
+
+
+def pattern_to_regex(pattern):
+    """Translate an rsync exclude pattern to a regular expression matching relative paths.
+
+    Follows the rules of rsync: ``*`` does not match slashes, ``**`` does, ``?`` matches
+    one character other than a slash and ``[...]`` a character class. A trailing ``/***``
+    matches a directory and everything in it. Patterns starting with ``/`` are anchored
+    at the transfer root; other patterns containing a slash match the end of the path,
+    and patterns without a slash match the last path component.
+
+    :param pattern: rsync pattern without a trailing slash.
+    :type pattern: str
+    :returns: Compiled regular expression.
+    """
+    contents = pattern.endswith('/***')
+    if contents:
+        pattern = pattern[:-4]
+    anchored = pattern.startswith('/')
+    pattern = pattern.lstrip('/')
+
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        elif c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end < 0:
+                regex += re.escape(c)
+            else:
+                members = pattern[i+1:end]
+                if members.startswith('!'):
+                    members = '^' + members[1:]
+                regex += '[' + members.replace('\\', '\\\\') + ']'
+                i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+
+    if contents:
+        regex += '(/.*)?'
+    if anchored:
+        regex = '^' + regex
+    else:
+        regex = '(^|/)' + regex
+    return re.compile(regex + '$')
+
+
+class ExcludeFilter(object):
+    """Compiled set of exclude patterns of one rsync call.
+
+    The patterns are passed to rsync in a single filter file (see :meth:`filter_file`)
+    instead of one ``--exclude`` option each. The same patterns can be matched in
+    Python with :meth:`match` and :meth:`pruned`, to preview what rsync will skip.
+    """
+    def __init__(self, patterns):
+        super(ExcludeFilter, self).__init__()
+        self.patterns = []
+        for pattern in patterns:
+            if not pattern in self.patterns:
+                self.patterns.append(pattern)
+        self.compiled = []
+        for pattern in self.patterns:
+            dir_only = pattern.endswith('/') and not pattern.endswith('/***')
+            self.compiled.append((pattern, pattern_to_regex(pattern.rstrip('/') if dir_only else pattern), dir_only))
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def match(self, path, is_dir=False):
+        """Find the pattern excluding a path, not looking at its parent directories.
+
+        :param path: Path relative to the transfer root, with forward slashes.
+        :type path: str
+        :param is_dir: True if the path is a directory.
+        :type is_dir: bool
+        :returns: str -- The first matching pattern, or ``None``.
+        """
+        path = path.strip('/')
+        for pattern, regex, dir_only in self.compiled:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(path):
+                return pattern
+        return None
+
+    def is_excluded(self, path, is_dir=False):
+        """True if rsync skips a path, either itself or because one of its parent directories is excluded."""
+        parts = path.strip('/').split('/')
+        for i in range(1, len(parts)):
+            if self.match('/'.join(parts[:i]), True) is not None:
+                return True
+        return self.match('/'.join(parts), is_dir) is not None
+
+    def pruned(self, root, prefix=''):
+        """Iterate over the paths below a directory that rsync would skip.
+
+        Excluded directories are listed once and not walked into.
+
+        :param root: Directory to walk.
+        :type root: str
+        :param prefix: Path of ``root`` relative to the transfer root, with forward slashes.
+        :type prefix: str
+        :returns: Iterator over 2-tuples of relative path and matching pattern.
+        """
+        prefix = prefix.replace('\\', '/').strip('/')
+        for dirpath, dirnames, filenames in os.walk(root):
+            relative = os.path.relpath(dirpath, root).replace('\\', '/')
+            relative = prefix if relative == '.' else (prefix + '/' + relative).lstrip('/')
+            for name in list(dirnames):
+                pattern = self.match((relative + '/' + name).lstrip('/'), True)
+                if pattern is not None:
+                    dirnames.remove(name)
+                    yield (relative + '/' + name).lstrip('/'), pattern
+            for name in filenames:
+                pattern = self.match((relative + '/' + name).lstrip('/'), False)
+                if pattern is not None:
+                    yield (relative + '/' + name).lstrip('/'), pattern
+
+    def included_files(self, root, prefix=''):
+        """Iterate over the files below a directory that rsync would transfer.
+
+        :param root: Directory to walk.
+        :type root: str
+        :param prefix: Path of ``root`` relative to the transfer root, with forward slashes.
+        :type prefix: str
+        :returns: Iterator over 2-tuples of path relative to ``root`` and full path.
+        """
+        prefix = prefix.replace('\\', '/').strip('/')
+        for dirpath, dirnames, filenames in os.walk(root):
+            relative = os.path.relpath(dirpath, root).replace('\\', '/')
+            relative = '' if relative == '.' else relative + '/'
+            for name in list(dirnames):
+                if self.match((prefix + '/' + relative + name).lstrip('/'), True) is not None:
+                    dirnames.remove(name)
+            for name in filenames:
+                if self.match((prefix + '/' + relative + name).lstrip('/'), False) is None:
+                    yield relative + name, os.path.join(dirpath, name)
+
+    @contextlib.contextmanager
+    def filter_file(self):
+        """Write the patterns to a temporary file for ``--exclude-from``.
+
+        Every line is written as an explicit exclude rule (``- pattern``), so that patterns
+        starting with ``+``, ``#`` or ``;`` are not read as includes or comments.
+
+        :returns: Path of the file, or ``None`` if there are no patterns.
+        """
+        if not self.patterns:
+            yield None
+            return
+        fd, path = tempfile.mkstemp(suffix='.josync-excludes')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for pattern in self.patterns:
+                    f.write(u'- {}\n'.format(pattern).encode('utf-8'))
+            logger.debug("Wrote {} excludes to {}".format(len(self.patterns), path))
+            yield path
+        finally:
+            os.remove(path)
@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import logging
+import time
+import threading
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def scan_tree(root, prefix, entries):
+    """Walk a directory tree and collect size and modification time of all entries.
+
+    :param root: Directory to walk.
+    :type root: unicode
+    :param prefix: Relative path of ``root`` to use in the collected paths, with forward slashes.
+    :type prefix: unicode
+    :param entries: List to append 4-tuples of relative path, size, mtime and is_dir to.
+    :type entries: list
+    """
+    stack = [(root, prefix)]
+    while stack:
+        path, relative = stack.pop()
+        try:
+            if scandir is not None:
+                children = []
+                for entry in scandir(path):
+                    st = entry.stat(follow_symlinks=False)
+                    children.append((entry.name, entry.path, st, entry.is_dir(follow_symlinks=False)))
+            else:
+                children = []
+                for name in os.listdir(path):
+                    child_path = os.path.join(path, name)
+                    st = os.lstat(child_path)
+                    children.append((name, child_path, st, os.path.isdir(child_path) and not os.path.islink(child_path)))
+        except OSError as e:
+            logger.warning("Could not scan {}: {}".format(path, e))
+            continue
+
+        for name, child_path, st, is_dir in children:
+            child_relative = relative + '/' + name
+            if is_dir:
+                entries.append((child_relative, 0, st.st_mtime, 1))
+                stack.append((child_path, child_relative))
+            else:
+                entries.append((child_relative, st.st_size, st.st_mtime, 0))
+
+
+class FileIndex(object):
+    """On-disk index of the files of each source of a job, as of its last successful sync.
+
+    Each source is scanned before syncing and compared to the index, giving the paths
+    that were added, changed or deleted since the last successful sync. The new scan
+    replaces the index entries of the source with :meth:`commit` once the sync has
+    succeeded. The index is a SQLite database, so that the comparison does not need
+    to keep the whole tree in memory.
+    """
+    def __init__(self, index_file):
+        super(FileIndex, self).__init__()
+        self.index_file = index_file
+        self.local = threading.local()
+
+        connection = self.connect()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS files (source TEXT, path TEXT, size INTEGER, mtime REAL, is_dir INTEGER, PRIMARY KEY (source, path))")
+            connection.execute("CREATE TABLE IF NOT EXISTS scan (source TEXT, path TEXT, size INTEGER, mtime REAL, is_dir INTEGER, PRIMARY KEY (source, path))")
+            connection.execute("CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, last_full REAL, last_sync REAL)")
+
+    def connect(self):
+        """Return a connection for the current thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.index_file, timeout=60)
+            self.local.connection = connection
+        return connection
+
+    def scan(self, source, root, prefix, workers=1):
+        """Scan the tree of a source into the scan table.
+
+        The subdirectories at the top of the tree are scanned in parallel.
+
+        :param source: Name of the source in the index.
+        :type source: str
+        :param root: Directory to scan.
+        :type root: str
+        :param prefix: Path of ``root`` relative to the rsync source directory, with forward slashes.
+        :type prefix: str
+        :param workers: Number of threads scanning subtrees.
+        :type workers: int
+        :returns: int -- Number of scanned entries.
+        """
+        root = unicode(root)
+        prefix = unicode(prefix).strip('/')
+        start = time.time()
+
+        # entries at the top of the tree, then one list of entries per subtree
+        entry_lists = [[]]
+        subtrees = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                entry_lists[0].append((prefix + '/' + name, 0, st.st_mtime, 1))
+                entry_lists.append([])
+                subtrees.append((path, prefix + '/' + name, entry_lists[-1]))
+            else:
+                entry_lists[0].append((prefix + '/' + name, st.st_size, st.st_mtime, 0))
+        utils.run_in_parallel(scan_tree, subtrees, workers)
+
+        connection = self.connect()
+        count = 0
+        with connection:
+            connection.execute("DELETE FROM scan WHERE source = ?", (source,))
+            for entries in entry_lists:
+                connection.executemany("INSERT OR REPLACE INTO scan VALUES (?, ?, ?, ?, ?)",
+                                       ((source,) + e for e in entries))
+                count += len(entries)
+        logger.info("Scanned {} entries of {} in {:.1f} s.".format(count, source, time.time()-start))
+        return count
+
+    def changes(self, source):
+        """Iterate over paths that changed between the index and the latest scan of a source.
+
+        :param source: Name of the source in the index.
+        :type source: str
+        :returns: Iterator over 2-tuples of relative path and ``True`` if the path was deleted.
+        """
+        connection = self.connect()
+        changed = connection.execute(
+            "SELECT s.path FROM scan s LEFT JOIN files f ON f.source = s.source AND f.path = s.path "
+            "WHERE s.source = ? AND (f.path IS NULL OR f.size != s.size OR f.mtime != s.mtime OR f.is_dir != s.is_dir)",
+            (source,))
+        for row in changed:
+            yield row[0], False
+        deleted = connection.execute(
+            "SELECT f.path FROM files f LEFT JOIN scan s ON s.source = f.source AND s.path = f.path "
+            "WHERE f.source = ? AND s.path IS NULL ORDER BY f.path",
+            (source,))
+        deleted_dir = None
+        for row in deleted:
+            # contents of deleted directories go with the directory
+            if deleted_dir is not None and row[0].startswith(deleted_dir + '/'):
+                continue
+            deleted_dir = row[0]
+            yield row[0], True
+
+    def needs_full_run(self, source, full_run_days):
+        """True if the source has no index or was last fully synced more than ``full_run_days`` ago."""
+        row = self.connect().execute("SELECT last_full FROM sources WHERE source = ?", (source,)).fetchone()
+        if row is None or row[0] is None:
+            return True
+        return (time.time() - row[0])/86400. >= full_run_days
+
+    def commit(self, source, full_run=False):
+        """Replace the index of a source with its latest scan, after a successful sync.
+
+        :param source: Name of the source in the index.
+        :type source: str
+        :param full_run: True if the sync was a full (non-incremental) sync.
+        :type full_run: bool
+        """
+        connection = self.connect()
+        now = time.time()
+        with connection:
+            connection.execute("DELETE FROM files WHERE source = ?", (source,))
+            connection.execute("INSERT INTO files SELECT * FROM scan WHERE source = ?", (source,))
+            connection.execute("DELETE FROM scan WHERE source = ?", (source,))
+            row = connection.execute("SELECT last_full FROM sources WHERE source = ?", (source,)).fetchone()
+            last_full = now if full_run or row is None else row[0]
+            connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (source, last_full, now))
+
+    def forget(self, source):
+        """Remove a source from the index, forcing a full sync next time."""
+        connection = self.connect()
+        with connection:
+            for table in ['files', 'scan', 'sources']:
+                connection.execute("DELETE FROM {} WHERE source = ?".format(table), (source,))
@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import logging
+import json
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values)//2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle-1] + values[middle])/2.
+
+
+def job_key(job_file):
+    """Name of a job in the history: the absolute path of its job file."""
+    return os.path.normcase(os.path.abspath(job_file))
+
+
+class RunHistory(object):
+    """SQLite database with the outcome, duration and stats of every run of every job.
+
+    Each run is recorded from its run report (see :func:`josync.write_run_report`),
+    with one row for the run and one row for each source synced in it. The history
+    is used to sync sources that take longest first, and to flag runs that are far
+    slower or larger than usual.
+    """
+    def __init__(self, history_file):
+        super(RunHistory, self).__init__()
+        self.history_file = history_file
+        self.local = threading.local()
+
+        connection = self.connect()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, job_file TEXT, start_time TEXT, "
+                               "duration REAL, success INTEGER, dry_run INTEGER, error TEXT, "
+                               "file_size_transferred INTEGER, tot_file_size INTEGER, stats TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS sources (run_id INTEGER, source TEXT, duration REAL, "
+                               "success INTEGER, file_size_transferred INTEGER, tot_file_size INTEGER)")
+            connection.execute("CREATE INDEX IF NOT EXISTS runs_job ON runs (job_file, start_time)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sources_run ON sources (run_id)")
+
+    def connect(self):
+        """Return a connection for the current thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.history_file, timeout=60)
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    def record(self, report):
+        """Add a run to the history.
+
+        :param report: Run report as written by :func:`josync.write_run_report`.
+        :type report: dict
+        :returns: int -- Id of the run in the history.
+        """
+        stats = report.get('stats', {})
+        connection = self.connect()
+        with connection:
+            cursor = connection.execute("INSERT INTO runs (job_file, start_time, duration, success, dry_run, error, "
+                                        "file_size_transferred, tot_file_size, stats) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (job_key(report['job_file']), report['start_time'], report['duration'],
+                                         int(bool(report['success'])), int(bool(report.get('dry_run'))), report.get('error'),
+                                         stats.get('file_size_transferred'), stats.get('tot_file_size'),
+                                         json.dumps(stats, sort_keys=True)))
+            run_id = cursor.lastrowid
+            for phase in report.get('phases', []):
+                if phase['phase'] != 'source':
+                    continue
+                connection.execute("INSERT INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+                                   (run_id, phase['source'], phase['duration'], int(not 'error' in phase),
+                                    phase.get('file_size_transferred'), phase.get('tot_file_size')))
+        return run_id
+
+    def runs(self, job_file, limit=10, successful=False):
+        """The latest runs of a job, newest first.
+
+        :param job_file: Path to job file.
+        :type job_file: str
+        :param limit: Maximum number of runs.
+        :type limit: int
+        :param successful: Only return successful runs that were not dry runs.
+        :type successful: bool
+        :returns: List of dicts with the columns of the ``runs`` table, ``stats`` decoded.
+        """
+        query = "SELECT * FROM runs WHERE job_file = ?"
+        if successful:
+            query += " AND success = 1 AND dry_run = 0"
+        rows = self.connect().execute(query + " ORDER BY start_time DESC LIMIT ?", (job_key(job_file), limit))
+        runs = []
+        for row in rows:
+            run = dict(zip(row.keys(), row))
+            run['stats'] = json.loads(run['stats']) if run['stats'] else {}
+            runs.append(run)
+        return runs
+
+    def source_runs(self, job_file, source, limit=10):
+        """The latest successful syncs of one source of a job, newest first.
+
+        :returns: List of dicts with the columns of the ``sources`` table and the run's ``start_time``.
+        """
+        rows = self.connect().execute(
+            "SELECT s.*, r.start_time FROM sources s JOIN runs r ON r.id = s.run_id "
+            "WHERE r.job_file = ? AND s.source = ? AND s.success = 1 AND r.dry_run = 0 "
+            "ORDER BY r.start_time DESC LIMIT ?", (job_key(job_file), source, limit))
+        return [dict(zip(row.keys(), row)) for row in rows]
+
+    def expected_duration(self, job_file, source, samples=5):
+        """Median duration of the latest successful syncs of a source.
+
+        :returns: float -- Seconds, or ``None`` if the source has no history.
+        """
+        return median([r['duration'] for r in self.source_runs(job_file, source, samples)])
+
+    def abnormal(self, job_file, duration, stats, factor=3., samples=10):
+        """Compare a run with the median of the latest successful runs of its job.
+
+        Call this before recording the run. At least three earlier runs are needed.
+
+        :param job_file: Path to job file.
+        :type job_file: str
+        :param duration: Duration of the run in seconds.
+        :type duration: float
+        :param stats: Stats of the run.
+        :type stats: dict
+        :param factor: How many times the median counts as abnormal.
+        :type factor: float
+        :returns: List of messages describing what was abnormal, empty if nothing was.
+        """
+        runs = self.runs(job_file, samples, successful=True)
+        if len(runs) < 3:
+            return []
+        messages = []
+        usual_duration = median([r['duration'] for r in runs])
+        if usual_duration and duration > factor*usual_duration:
+            messages.append("took {:.0f} s, {:.1f} times the usual {:.0f} s".format(
+                            duration, duration/usual_duration, usual_duration))
+        for key, name in [('file_size_transferred', 'transferred'), ('tot_file_size', 'total size')]:
+            usual = median([r[key] for r in runs if r[key] is not None])
+            value = stats.get(key)
+            if usual and value is not None and value > factor*usual:
+                messages.append("{} {:.1f} MB, {:.1f} times the usual {:.1f} MB".format(
+                                name, value/1048576., float(value)/usual, usual/1048576.))
+        return messages
@@ -1,15 +1,40 @@
 ﻿import utils
+import fileindex
+import excludes
+import history
+import manifest
+import verify
+import dedup
+import shards
+import snapshots
 import json
 import os
+import ntpath
 import logging
 import subprocess as sp
 import re
 import datetime
+import threading
+import tempfile
+import shutil
+import time
+import collections
+import contextlib
 
 logger = logging.getLogger(__name__)
 
+# Progress of a running job, passed to progress callbacks. Byte counts are floats,
+# rate is in bytes per second and eta in seconds (None if unknown).
+JobProgress = collections.namedtuple('JobProgress', ['source', 'source_bytes', 'job_bytes', 'expected_bytes', 'rate', 'eta'])
+
+
 class Job(object):
     """Parent class for backup jobs."""
+    # rsync options of the receiving side, the only ones passed on when replaying a batch;
+    # the sending side's options (excludes, filters, file lists) are recorded in the batch
+    batch_replay_options = ('--archive', '--recursive', '--relative', '--delete', '--partial-dir',
+                            '--link-dest', '--out-format', '--verbose', '--stats')
+
     def __init__(self,params):
         super(Job, self).__init__()
         logger.debug("Entering Job constructor.")
@@ -21,125 +46,868 @@ class Job(object):
             raise utils.JobDescriptionKeyError(e.message)
 
         try:
-            self.global_excludes = params['global_excludes']
+            self.global_excludes = excludes.split_patterns(params['global_excludes'])
         except KeyError:
             self.global_excludes = []
+        except (TypeError, AttributeError):
+            raise utils.JobDescriptionValueError('global_excludes must be a list of strings.')
+
+        try:
+            self.parallel_drives = int(params['parallel_drives'])
+        except KeyError:
+            self.parallel_drives = 1
+        except ValueError:
+            raise utils.JobDescriptionValueError('parallel_drives must be an integer.')
+
+        try:
+            self.retries = int(params.get('retries', 2))
+            self.retry_delay = float(params.get('retry_delay', 60))
+            self.retry_exit_codes = [int(c) for c in params.get('retry_exit_codes', [23, 24, 30])]
+        except (TypeError, ValueError):
+            raise utils.JobDescriptionValueError('retries, retry_delay and retry_exit_codes must be numbers.')
+
+        self.checkpoint = None
+        if params.get('checkpoint', False) and 'job_file' in params and not utils.config.get('dry_run', False):
+            filename, fileext = os.path.splitext(params['job_file'])
+            self.checkpoint = Checkpoint(filename + '.josync-job-checkpoint')
+
+        self.history = None
+        history_file = utils.config.get('history_file', 'josync-history.db')
+        if history_file and 'job_file' in params:
+            self.history = history.RunHistory(history_file)
+
+        self.verifier = None
+        if params.get('verify', False) and 'job_file' in params and not utils.config.get('dry_run', False):
+            filename, fileext = os.path.splitext(params['job_file'])
+            try:
+                self.verifier = verify.Verifier(verify.HashCache(filename + '.josync-job-hashes'),
+                                                float(params.get('verify_sample', 0.1)),
+                                                int(params.get('verify_workers', 2)))
+            except (TypeError, ValueError):
+                raise utils.JobDescriptionValueError('verify_sample and verify_workers must be numbers.')
+
+        self.batch_sources = params.get('batch_sources', False)
+        self.snapshot_set = params.get('snapshot_set', False)
+
+        self.index = None
+        self.full_run_days = params.get('full_run_days', 7)
+        self.index_workers = params.get('index_workers', 4)
+        if params.get('indexed', False) and 'job_file' in params:
+            filename, fileext = os.path.splitext(params['job_file'])
+            self.index = fileindex.FileIndex(filename + '.josync-job-index')
+
+        shard_by = params.get('shard_by', 'files')
+        if not shard_by in ('files', 'bytes'):
+            raise utils.JobDescriptionValueError('shard_by must be "files" or "bytes".')
+        plan_file = None
+        if 'job_file' in params:
+            filename, fileext = os.path.splitext(params['job_file'])
+            plan_file = filename + '.josync-job-shards'
+        self.shard_planner = shards.ShardPlanner(plan_file, shard_by, params.get('shard_rescan_days', 7))
+
+        try:
+            self.watch_debounce = float(params.get('watch_debounce', 5))
+            self.watch_max_delay = float(params.get('watch_max_delay', 60))
+            self.watch_max_paths = int(params.get('watch_max_paths', 10000))
+            self.watch_full_hours = float(params.get('watch_full_hours', 24))
+            self.watch_poll = float(params.get('watch_poll', 60))
+        except (TypeError, ValueError):
+            raise utils.JobDescriptionValueError('watch_debounce, watch_max_delay, watch_max_paths, watch_full_hours '
+                                                 'and watch_poll must be numbers.')
 
         self.rsync_base_options = ['--stats','--chmod=ugo=rwX','--compress']
+        # options of the current run only, set again by every run
+        self.run_options = []
         if not utils.config['is_pythonw']:
             self.rsync_base_options += ['--verbose']
 
-        target_drive, target_path = os.path.splitdrive(self.target)
+        # keep interrupted files at the target, so that a retry or the next run resumes them
+        partial_dir = params.get('partial_dir', '.josync-partial')
+        if partial_dir:
+            self.rsync_base_options += ['--partial-dir={}'.format(partial_dir)]
+
+        # the manifest is written from itemized changes
+        self.manifest = params.get('manifest', False) and 'job_file' in params
+        self.manifest_keep = params.get('manifest_keep', 30)
+        # dedup looks at the files that rsync reports as transferred
+        self.dedup = params.get('dedup', False) and not utils.config.get('dry_run', False)
+        self.itemize_changes = params.get('itemize_changes', False) or self.manifest or self.dedup
+        if self.itemize_changes:
+            self.rsync_base_options += ['--out-format={}'.format(utils.RsyncOutputParser.itemize_out_format)]
+        self.rsync_subscribers = []
+
+        self.job_file = params.get('job_file')
+        self.progress_callbacks = []
+        self.progress_lock = threading.Lock()
+        self.progress_state = {'finished_bytes': 0., 'running': {}, 'rate': None, 'time': None, 'bytes': 0.}
+        self.expected_bytes = None
+
+        # job files name drives like Windows does, also where paths have no drives
+        target_drive, target_path = ntpath.splitdrive(self.target)
         if utils.is_net_drive(target_drive):
             unc = utils.net_drives[target_drive]
             self.target = unc + target_path
             logger.debug("Replacing target drive {} with UNC path {}".format(target_drive, unc))
         self.cygtarget = utils.get_cygwin_path(self.target)
+        # directory the sources are synced to, below which their paths are recreated
+        self.target_root = self.target
+
+        self.secondary_targets = []
+        for secondary in params.get('secondary_targets', []):
+            secondary_drive, secondary_path = ntpath.splitdrive(secondary)
+            if utils.is_net_drive(secondary_drive):
+                secondary = utils.net_drives[secondary_drive] + secondary_path
+            if not os.path.isdir(secondary):
+                raise utils.TargetNotFoundError(secondary)
+            self.secondary_targets.append(utils.get_cygwin_path(secondary))
+        self.batch_dir = params.get('batch_dir')
+
+        self.deduplicator = None
+        if self.dedup:
+            self.deduplicator = dedup.Deduplicator(params.get('dedup_index', os.path.join(self.target, '.josync-dedup-index')),
+                                                   params.get('dedup_min_size', 1048576))
+            self.subscribe(self.deduplicator)
 
         if not os.path.isdir(self.target):
             raise utils.TargetNotFoundError(self.target)
 
+        drive_snapshots = params.get('snapshots', {})
+        if not isinstance(drive_snapshots, dict):
+            raise utils.JobDescriptionValueError('snapshots must be a dictionary of snapshot providers by drive.')
+
         self.sources = {}
         for s in self.raw_sources:
-            drive, path = os.path.splitdrive(s['path'])
+            drive, path = ntpath.splitdrive(s['path'])
+            try:
+                snapshot_spec = snapshots.source_spec(drive_snapshots, s, drive)
+            except ValueError as e:
+                raise utils.JobDescriptionValueError('Snapshot of {}: {}'.format(s['path'], e))
             if utils.is_net_drive(drive):
                 logger.warning("The source path {} is a mounted net drive (ignoring source).".format(drive+path))
-            elif not os.path.isdir(drive+path):
+            elif not os.path.isdir(snapshots.live_path(snapshot_spec, drive, path)):
                 logger.warning("The source directory {} does not exist (ignoring source).".format(drive+path))
             else:
                 relative_source = {
                     'path': path,
-                    'excludes': []
+                    'excludes': [],
+                    'snapshot': snapshot_spec
                 }
+                try:
+                    relative_source['shards'] = int(s.get('shards', 1))
+                except (TypeError, ValueError):
+                    raise utils.JobDescriptionValueError('shards of {} must be an integer.'.format(s['path']))
                 if 'excludes' in s:
-                    relative_source['excludes'] = s['excludes']
+                    try:
+                        relative_source['excludes'] = [p for p in excludes.split_patterns(s['excludes'])
+                                                       if not p in self.global_excludes]
+                    except (TypeError, AttributeError):
+                        raise utils.JobDescriptionValueError('excludes of {} must be a list of strings.'.format(s['path']))
                 if drive in self.sources:
                     self.sources[drive].append(relative_source)
                 else:
                     self.sources[drive] = [relative_source]
 
         self.stats = {}
-
+        self.stats_lock = threading.Lock()
 
 
     def run(self):
         raise NotImplementedError("Run method of job was not implemented.")
 
 
-    def excludes_to_options(self,excludes):
+    def excludes_to_options(self,exclude_list):
         """Convert a list of strings to a list of exclude options to rsync.
 
-        :param excludes: List of excludes.
+        Rsync calls of jobs pass their excludes in a file instead (see :meth:`run_rsync`).
+
+        :param exclude_list: List of excludes.
         """
         options = []
-        for excl in excludes:
+        for excl in excludes.split_patterns(exclude_list):
             options.append("--exclude={}".format(excl))
         return options
 
-    def run_rsync(self):
-        rsync_options = self.rsync_base_options + self.rsync_options
-        rsync_process = utils.Rsync(self.rsync_source,self.rsync_target,rsync_options)
-        rsync_process.wait()
+    def excludes_to_anchored_patterns(self,source_path,exclude_list):
+        """Convert excludes of one source to patterns anchored at the source path.
+
+        Used when several sources share one rsync call. Patterns not starting with
+        ``/`` match at the end of any path, so each becomes two anchored patterns:
+        one for the source directory itself and one for any directory below it.
+        Patterns starting with ``/`` are relative to the transfer root, which is the
+        same in both cases, and are kept as they are.
+
+        :param source_path: Path of the source relative to the transfer root, e.g. ``d/projects``.
+        :type source_path: str
+        :param exclude_list: List of excludes.
+        :returns: List of exclude patterns.
+        """
+        prefix = '/' + re.sub(r'([\\*?\[])', r'\\\1', source_path.strip('/'))
+        patterns = []
+        for excl in excludes.split_patterns(exclude_list):
+            if excl.startswith('/'):
+                patterns.append(excl)
+            else:
+                patterns.append('{}/{}'.format(prefix,excl))
+                patterns.append('{}/**/{}'.format(prefix,excl))
+        return patterns
+
+    def run_rsync(self,source,target,options,exclude_list=None):
+        """Run rsync and add the numbers from its stats output to ``self.stats``.
+
+        The output is parsed while rsync runs, and the events are passed on to
+        callbacks registered with :meth:`subscribe`.
+
+        :param source: rsync source argument.
+        :type source: str
+        :param target: rsync target argument.
+        :type target: str
+        :param options: Options in addition to ``self.rsync_base_options`` and ``self.run_options``.
+        :type options: list
+        :param exclude_list: Exclude patterns, passed to rsync in a temporary file with ``--exclude-from``.
+        :type exclude_list: list
+        :raises: utils.RsyncError
+        :returns: dict -- Stats of the rsync call.
+
+        rsync is run again after exit codes in ``retry_exit_codes`` (by default partial
+        transfers and timeouts), up to ``retries`` times, waiting ``retry_delay`` seconds
+        before the first retry and twice as long before each further one.
+
+        If the job has ``secondary_targets``, rsync records the transfer to the target in
+        a batch file, which is then replayed to the secondary targets (see :meth:`replay_batch`).
+        """
+        with excludes.ExcludeFilter(exclude_list or []).filter_file() as exclude_file:
+            if exclude_file is not None:
+                options = options + ['--exclude-from={}'.format(utils.get_cygwin_path(exclude_file))]
+            if not self.secondary_targets:
+                return self.run_rsync_retrying(source,target,options)
+
+            fd, batch_file = tempfile.mkstemp(suffix='.josync-batch', dir=self.batch_dir)
+            os.close(fd)
+            try:
+                stats = self.run_rsync_retrying(source,target,
+                                                options+['--write-batch={}'.format(utils.get_cygwin_path(batch_file))])
+                utils.run_in_parallel(self.replay_batch,
+                                      [(batch_file,source,secondary,options) for secondary in self.secondary_targets],
+                                      len(self.secondary_targets))
+            finally:
+                for filename in [batch_file, batch_file + '.sh']:
+                    if os.path.isfile(filename):
+                        os.remove(filename)
+            return stats
+
+    def run_rsync_retrying(self,source,target,options,primary=True):
+        """Run rsync for :meth:`run_rsync`, retrying after exit codes in ``retry_exit_codes``."""
+        attempt = 0
+        while True:
+            try:
+                return self.run_rsync_process(source,target,options,attempt,primary)
+            except utils.RsyncError as e:
+                if attempt >= self.retries or not e.returncode in self.retry_exit_codes:
+                    raise
+                delay = self.retry_delay*2**attempt
+                attempt += 1
+                logger.warning("rsync returned with exit code {}, retrying in {:.0f} s (attempt {} of {}).".format(
+                                e.returncode,delay,attempt,self.retries))
+                time.sleep(delay)
+
+    def replay_batch(self,batch_file,source,target,options):
+        """Apply the changes recorded in a batch file to a secondary target.
+
+        Replaying a batch only works if the secondary target was identical to the primary
+        target before the transfer. If it has drifted, rsync rejects the changes for the
+        drifted files, and the source is synced to the secondary target normally instead.
+
+        :param batch_file: Path to batch file written with ``--write-batch``.
+        :type batch_file: str
+        :param source: rsync source argument, for a normal sync.
+        :param target: rsync argument of the secondary target.
+        :type target: str
+        :param options: Options used to write the batch file.
+        :type options: list
+        """
+        if utils.config.get('dry_run', False):
+            logger.info("Dry run, not replaying changes to {}.".format(target))
+            return
+        replay_options = [o for o in self.rsync_base_options + self.run_options + options
+                          if o.split('=')[0] in self.batch_replay_options]
+        try:
+            self.run_rsync_process(None,target,replay_options+['--read-batch={}'.format(utils.get_cygwin_path(batch_file))],
+                                   primary=False,base_options=False)
+        except utils.RsyncError as e:
+            logger.warning("Replaying changes to {} failed with exit code {}, the target has drifted. "
+                           "Syncing it normally.".format(target,e.returncode))
+            self.run_rsync_retrying(source,target,options,primary=False)
+
+    def run_rsync_process(self,source,target,options,attempt=0,primary=True,base_options=True):
+        """Run one rsync process for :meth:`run_rsync`, with excludes already in ``options``.
+
+        Only rsync calls to the primary target report progress, pass events to subscribers
+        and count in ``self.stats``. With ``base_options`` false, ``options`` is the complete
+        list of options, without ``self.rsync_base_options`` and ``self.run_options``.
+        """
+        rsync_options = self.rsync_base_options + self.run_options + options if base_options else list(options)
+        parser = utils.RsyncOutputParser(sized=self.itemize_changes)
+        call_id = object()
+        if primary:
+            for callback in self.rsync_subscribers:
+                parser.subscribe(callback)
+            if self.progress_callbacks:
+                rsync_options += ['--info=progress2']
+                label = source if isinstance(source, basestring) else ', '.join(source)
+                parser.subscribe(lambda event: self.update_progress(call_id, label, event))
+
+        with utils.timed_phase('rsync' if primary else 'rsync_secondary', source=source, target=target, attempt=attempt) as record:
+            rsync_process = None
+            try:
+                rsync_process = utils.Rsync(source,target,rsync_options,parser=parser)
+                rsync_process.wait()
+            finally:
+                self.finish_progress(call_id, parser.stats.get('tot_file_size'))
+                if rsync_process is not None:
+                    record['exit_code'] = rsync_process.returncode
+                record.update(parser.stats)
+
+            if rsync_process.returncode != 0:
+                raise utils.RsyncError(rsync_process.returncode)
+            else:
+                logger.info("rsync finished successfully.")
+
+        if primary:
+            self.add_stats(parser.stats)
+        return parser.stats
+
+    def subscribe(self,callback):
+        """Register a callback receiving the parsed output of every rsync call of the job.
+
+        ``callback(event)`` is called with the events of :class:`utils.RsyncOutputParser`
+        from the thread reading rsync output, possibly interleaving events of several rsync processes.
+
+        :param callback: Function taking one event.
+        """
+        self.rsync_subscribers.append(callback)
+
+    def source_excludes(self,source):
+        """All exclude patterns applying to a source: the global excludes and its own.
+
+        :param source: Relative source on a drive.
+        :type source: dict
+        :returns: List of patterns.
+        """
+        return excludes.compile_excludes(self.global_excludes, source['excludes'])
+
+    def preview_excludes(self):
+        """Iterate over the paths of all sources that rsync would skip because of excludes.
+
+        Matches the live source directories, not a shadow copy, with :class:`excludes.ExcludeFilter`.
+
+        :returns: Iterator over 3-tuples of source, path relative to the transfer root and matching pattern.
+        """
+        for drive, sources in sorted(self.sources.items()):
+            for s in sources:
+                exclude_filter = excludes.ExcludeFilter(self.source_excludes(s))
+                prefix = drive[0] + s['path'].replace('\\','/')
+                for path, pattern in exclude_filter.pruned(snapshots.live_path(s['snapshot'], drive, s['path']), prefix):
+                    yield drive + s['path'], path, pattern
+
+    def add_progress_callback(self,callback):
+        """Register a callback receiving the progress of the job while rsync runs.
+
+        ``callback(progress)`` is called with a :class:`JobProgress` for every progress
+        update from rsync, from the thread reading rsync output. Registering a callback
+        makes rsync report progress with ``--info=progress2`` (rsync 3.1 or later).
+        The expected size of the job, used for the ETA, is the total file size of the
+        latest successful run in the job's run report file.
+
+        :param callback: Function taking one :class:`JobProgress`.
+        """
+        self.progress_callbacks.append(callback)
+        if self.expected_bytes is None and self.job_file is not None:
+            report = utils.read_last_run_report(utils.run_report_filename(self.job_file))
+            if report is not None:
+                self.expected_bytes = report.get('stats', {}).get('tot_file_size')
+
+    def update_progress(self,call_id,source,event):
+        """Update the job progress from a progress event of one rsync call and notify progress callbacks."""
+        if not isinstance(event, utils.ProgressUpdate):
+            return
+        state = self.progress_state
+        with self.progress_lock:
+            state['running'][call_id] = event.bytes
+            job_bytes = state['finished_bytes'] + sum(state['running'].values())
+
+            # smoothed rate of the whole job, which may run several rsync calls at once
+            now = time.time()
+            if state['time'] is None:
+                state['rate'] = event.rate
+                state['time'], state['bytes'] = now, job_bytes
+            elif now - state['time'] >= 1.:
+                rate = max(job_bytes - state['bytes'], 0)/(now - state['time'])
+                state['rate'] = rate if state['rate'] is None else 0.7*state['rate'] + 0.3*rate
+                state['time'], state['bytes'] = now, job_bytes
+            rate = state['rate']
+
+        expected = self.expected_bytes if self.expected_bytes is not None and self.expected_bytes >= job_bytes else None
+        eta = (expected - job_bytes)/rate if expected is not None and rate else None
+        progress = JobProgress(source, event.bytes, job_bytes, expected, rate, eta)
+        for callback in self.progress_callbacks:
+            try:
+                callback(progress)
+            except Exception as e:
+                logger.exception(e)
+
+    def finish_progress(self,call_id,total_bytes):
+        """Count the bytes of a finished rsync call as done."""
+        with self.progress_lock:
+            bytes_done = self.progress_state['running'].pop(call_id, 0.)
+            self.progress_state['finished_bytes'] += total_bytes if total_bytes is not None else bytes_done
+
+    @contextlib.contextmanager
+    def recording_manifest(self):
+        """Write the itemized changes of the rsync calls in this context to a new manifest of the run.
 
-        if rsync_process.returncode != 0:
-            # Appropriate exception type?
-            raise IOError("rsync returned with exit code {}.".format(rsync_process.returncode))
+        Does nothing unless the job parameter ``manifest`` is set. Only the newest
+        ``manifest_keep`` manifests of the job are kept.
+        """
+        if not self.manifest:
+            yield
+            return
+        manifest_writer = manifest.ManifestWriter(manifest.manifest_filename(self.job_file, datetime.datetime.now()))
+        self.subscribe(manifest_writer)
+        try:
+            yield
+        finally:
+            self.rsync_subscribers.remove(manifest_writer)
+            manifest_writer.close()
+            manifest.remove_old_manifests(self.job_file, self.manifest_keep)
+
+    def verify_source(self,drive,source,shadow_root):
+        """Compare a sample of the files of a synced source with the target, if the job verifies.
+
+        The shadow copy of the drive must still be mounted. The numbers of verified,
+        missing and differing files are added to ``self.stats``. Files are looked up at
+        the target where rsync puts them: below the drive letter and the source path with
+        ``--relative``, else in the target (source path ending with a slash) or in a
+        directory named like the source.
+
+        :param drive: Drive letter with colon.
+        :type drive: str
+        :param source: Relative source on the drive.
+        :type source: dict
+        :param shadow_root: Path where the shadow copy of the drive is mounted.
+        :type shadow_root: str
+        """
+        if self.verifier is None:
+            return
+        relative_path = source['path'].replace('\\','/').strip('/')
+        source_root = os.path.join(shadow_root, drive[0], relative_path)
+        if '--relative' in self.rsync_base_options:
+            target_root = os.path.join(self.target_root, drive[0], relative_path)
+        elif source['path'].endswith(('/','\\')):
+            target_root = self.target_root
         else:
-            logger.info("rsync finished successfully.")
-
-        # Parse rsync stats output, typically finde the numbers in lines like:
-        # Number of files: 211009
-        # Number of files transferred: 410
-        # Total file size: 903119614118 bytes
-        # Total transferred file size: 9046197739 bytes
-        pattern_dict = {
-            "num_files": re.compile("Number of files:\s+(\d+)"),
-            "files_transferred": re.compile("Number of files transferred:\s+(\d+)"),
-            "tot_file_size": re.compile("Total file size:\s+(\d+)"),
-            "file_size_transferred": re.compile("Total transferred file size:\s+(\d+)")
-        }
-        
-        for line in rsync_process.output_buffer:
-            for key,pattern in pattern_dict.items():
-                match = pattern.match(line)
-                if match:
-                    value = float(match.group(1))
-                    if key in self.stats:
-                        self.stats[key] += value
-                    else:
-                        self.stats[key] = value
+            target_root = os.path.join(self.target_root, relative_path.rsplit('/',1)[-1])
+        exclude_filter = excludes.ExcludeFilter(self.source_excludes(source))
+        with utils.timed_phase('verify', source=drive+source['path']) as record:
+            stats = self.verifier.verify(exclude_filter.included_files(source_root, drive[0] + '/' + relative_path),
+                                         target_root, drive+source['path'])
+            record.update(stats)
+        self.add_stats(stats)
+
+    def add_stats(self,stats):
+        """Add numbers to ``self.stats``. Safe to call from several threads.
+
+        :param stats: Dictionary of numbers to add.
+        :type stats: dict
+        """
+        with self.stats_lock:
+            for key,value in stats.items():
+                if key in self.stats:
+                    self.stats[key] += value
+                else:
+                    self.stats[key] = value
 
 
 class BaseSyncJob(Job):
     """Base class for sync-type jobs."""
+    # True if the job can sync only the paths changed since the last run
+    supports_index = False
+    # True if the job can sync single changed paths in watch mode
+    supports_watch = False
+
     def __init__(self,params):
         super(BaseSyncJob, self).__init__(params)
         self.rsync_base_options += ['--archive']
 
     def run(self):
-        """Run rsync to sync one or more sources with one target directory."""
-        self.rsync_base_options += self.excludes_to_options(self.global_excludes)
+        """Run rsync to sync one or more sources with one target directory.
 
-        for drive,sources in self.sources.items():
-            logger.info("Backing up sources on {}".format(drive))
-            with utils.volume_shadow(drive) as shadow_root:
-                for s in sources:
-                    logger.info("Backing up {}{} to {}".format(drive,s['path'],self.target))
-                    logger.debug("Drive root is found at {} and source path is {}.".format(shadow_root,s['path']))
+        Drives are backed up concurrently if the job parameter ``parallel_drives`` is larger than one.
+        With the job parameter ``snapshot_set``, all drives are snapshot before syncing, those with the
+        same snapshot provider together.
+        """
+        pending = self.order_sources(self.pending_sources())
+        if self.parallel_drives > 1:
+            logger.info("Backing up {} drive(s) with up to {} in parallel.".format(len(pending),self.parallel_drives))
+
+        with self.recording_manifest():
+            if self.snapshot_set and len(pending) > 1:
+                groups = []
+                for drive, sources in pending:
+                    for spec, spec_sources in group_by_snapshot(sources):
+                        group = [g for g in groups if g[0] == spec]
+                        if group:
+                            group[0][1].append((drive,spec_sources))
+                        else:
+                            groups.append((spec,[(drive,spec_sources)]))
+                with snapshots.snapshot_sets([(spec,[drive for drive,sources in group]) for spec,group in groups]) as roots:
+                    utils.run_in_parallel(self.sync_drive,
+                                          [(drive,sources,root) for (spec,group),root in zip(groups,roots)
+                                                                for drive,sources in group],
+                                          self.parallel_drives)
+            else:
+                utils.run_in_parallel(self.run_drive, pending, self.parallel_drives)
+
+        if self.deduplicator is not None:
+            with utils.timed_phase('dedup') as record:
+                stats = self.deduplicator.run(self.target_root)
+                record.update(stats)
+            self.add_stats(stats)
+
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+
+    def pending_sources(self):
+        """Sources of the job that were not completed by an interrupted earlier run.
+
+        :returns: dict -- Lists of relative sources by drive, like ``self.sources``.
+        """
+        if self.checkpoint is None:
+            return self.sources
+        pending = {}
+        for drive, sources in self.sources.items():
+            remaining = [s for s in sources if not self.checkpoint.is_completed(drive + s['path'])]
+            if len(remaining) < len(sources):
+                logger.info("Skipping {} source(s) on {} completed by the interrupted run of {}.".format(
+                             len(sources)-len(remaining), drive, self.checkpoint.interrupted_run_time()))
+            if remaining:
+                pending[drive] = remaining
+        return pending
+
+    def order_sources(self,sources):
+        """Order drives and their sources by how long they are expected to take, longest first.
 
+        Starting the longest drives first keeps parallel drives from ending with one long
+        drive running alone. Expected durations are the medians of earlier runs in the
+        run history; drives and sources without history count as longest.
+
+        :param sources: Lists of relative sources by drive.
+        :type sources: dict
+        :returns: List of 2-tuples of drive and list of sources, longest first.
+        """
+        if self.history is None:
+            return sorted(sources.items())
+
+        def expected(name):
+            duration = self.history.expected_duration(self.job_file, name)
+            return float('inf') if duration is None else duration
+
+        ordered = []
+        for drive, drive_sources in sources.items():
+            durations = dict((id(s), expected(drive + s['path'])) for s in drive_sources)
+            drive_sources = sorted(drive_sources, key=lambda s: durations[id(s)], reverse=True)
+            if self.batch_sources and len(drive_sources) > 1:
+                drive_duration = expected(drive)
+            else:
+                drive_duration = sum(durations.values())
+            ordered.append((drive_duration, drive, drive_sources))
+        ordered.sort(key=lambda o: (-o[0], o[1]))
+        logger.debug("Expected durations of drives: {}".format(', '.join('{} {:.0f} s'.format(d, e) for e, d, s in ordered)))
+        return [(drive, drive_sources) for drive_duration, drive, drive_sources in ordered]
+
+    def complete_source(self,drive,source):
+        """Record a source as completed in the checkpoint of the job."""
+        if self.checkpoint is not None:
+            self.checkpoint.complete(drive + source['path'])
+
+    def run_drive(self,drive,sources):
+        """Snapshot one drive and sync all its sources to the target.
+
+        Sources using different snapshot providers are synced from separate snapshots, one after the other.
+
+        :param drive: Drive letter with colon.
+        :type drive: str
+        :param sources: List of relative sources on the drive.
+        :type sources: list
+        """
+        for spec, spec_sources in group_by_snapshot(sources):
+            with snapshots.snapshot_set([drive],spec) as shadow_root:
+                self.sync_drive(drive,spec_sources,shadow_root)
+
+    def sync_drive(self,drive,sources,shadow_root):
+        """Sync all sources of a drive from its mounted shadow copy to the target.
+
+        :param drive: Drive letter with colon.
+        :type drive: str
+        :param sources: List of relative sources on the drive.
+        :type sources: list
+        :param shadow_root: Path where the shadow copy of the drive is mounted.
+        :type shadow_root: str
+        """
+        logger.info("Backing up sources on {}".format(drive))
+        # sharded sources are not batched
+        batched = [s for s in sources if s['shards'] <= 1]
+        if self.batch_sources and len(batched) > 1:
+            if '--relative' in self.rsync_base_options:
+                with utils.timed_phase('source', source=drive) as record:
+                    record.update(self.run_drive_batched(drive,batched,shadow_root))
+                for s in batched:
+                    self.verify_source(drive,s,shadow_root)
+                    self.complete_source(drive,s)
+                sources = [s for s in sources if s['shards'] > 1]
+            else:
+                logger.warning("Sources can only be batched for jobs using --relative (syncing one source at a time).")
+
+        for s in sources:
+            logger.info("Backing up {}{} to {}".format(drive,s['path'],self.target))
+            logger.debug("Drive root is found at {} and source path is {}.".format(shadow_root,s['path']))
+
+            with utils.timed_phase('source', source=drive+s['path']) as record:
+                if self.index is not None and self.supports_index:
+                    record.update(self.run_source_indexed(drive,s,shadow_root))
+                elif s['shards'] > 1 and '--relative' in self.rsync_base_options:
+                    record.update(self.run_source_sharded(drive,s,shadow_root))
+                else:
+                    if self.index is not None:
+                        logger.warning("Indexed syncing is only supported by sync jobs (syncing all files).")
+                    if s['shards'] > 1:
+                        logger.warning("Sources can only be sharded for jobs using --relative (syncing in one rsync call).")
                     drive_letter = drive[0]
-                    self.rsync_source = '{}/./{}{}'.format(
+                    rsync_source = '{}/./{}{}'.format(
                                     utils.get_cygwin_path(shadow_root),
                                     drive_letter,
                                     utils.get_cygwin_path(s['path']))
-                    self.rsync_target = self.cygtarget
-                    self.rsync_options = self.excludes_to_options(s['excludes'])
+                    record.update(self.run_rsync(rsync_source,self.cygtarget,[],self.source_excludes(s)))
+            self.verify_source(drive,s,shadow_root)
+            self.complete_source(drive,s)
+
+    def run_source_indexed(self,drive,source,shadow_root):
+        """Sync only the paths of a source that changed since its last successful sync.
 
-                    self.run_rsync()
+        The source is scanned and compared with the job's :class:`fileindex.FileIndex`.
+        Changed and new paths are passed to rsync with ``--files-from``, and deleted paths
+        are deleted at the target with ``--delete-missing-args``. Every ``full_run_days``
+        the source is synced normally instead, to catch changes missed by the index.
+
+        :param drive: Drive letter with colon.
+        :type drive: str
+        :param source: Relative source on the drive.
+        :type source: dict
+        :param shadow_root: Path where the shadow copy of the drive is mounted.
+        :type shadow_root: str
+        :returns: dict -- Stats of the rsync call, empty if nothing changed.
+        """
+        drive_letter = drive[0]
+        source_name = drive + source['path']
+        source_path = '{}{}'.format(drive_letter,utils.get_cygwin_path(source['path']))
+        cygshadow_root = utils.get_cygwin_path(shadow_root)
+        scan_root = os.path.join(shadow_root, drive_letter, source['path'].lstrip('/\\'))
+
+        with utils.timed_phase('index_scan', source=source_name):
+            self.index.scan(source_name, scan_root, source_path, self.index_workers)
+
+        exclude_list = self.source_excludes(source)
+        if self.index.needs_full_run(source_name, self.full_run_days):
+            logger.info("Full sync of {} to verify the index.".format(source_name))
+            stats = self.run_rsync('{}/./{}'.format(cygshadow_root,source_path),self.cygtarget,[],exclude_list)
+            self.index.commit(source_name, full_run=True)
+            return stats
+
+        stats = {}
+        fd, files_from = tempfile.mkstemp(suffix='.josync-files')
+        try:
+            changed = deleted = 0
+            with os.fdopen(fd,'wb') as f:
+                for path, is_deleted in self.index.changes(source_name):
+                    f.write(path.encode('utf-8') + b'\0')
+                    if is_deleted:
+                        deleted += 1
+                    else:
+                        changed += 1
+            logger.info("Index of {} lists {} changed and {} deleted path(s).".format(source_name,changed,deleted))
+
+            if changed or deleted:
+                rsync_options = ['--files-from={}'.format(utils.get_cygwin_path(files_from)),
+                                 '--from0','--delete-missing-args']
+                stats = self.run_rsync(cygshadow_root+'/',self.cygtarget,rsync_options,exclude_list)
+        finally:
+            os.remove(files_from)
+        self.index.commit(source_name)
+        return stats
+
+    def run_source_sharded(self,drive,source,shadow_root):
+        """Sync a large source with several rsync calls running at the same time.
+
+        The tree of the source is split into subtrees, which are distributed to ``shards``
+        shards of about equal numbers of files or bytes by the job's :class:`shards.ShardPlanner`.
+        A boundary call first syncs the source with all subtrees hidden and protected
+        (see :func:`shards.hiding_filter_file`). It transfers the files outside the subtrees
+        and deletes what is missing from the source outside the subtrees, such as subtrees
+        that were removed. Then every shard syncs its subtrees in one rsync call, which
+        deletes within them. The parent directories of the subtrees, which every shard
+        call lists again, are counted once in ``num_files``. Indexed syncing takes
+        precedence over sharding.
+
+        :param drive: Drive letter with colon.
+        :type drive: str
+        :param source: Relative source on the drive.
+        :type source: dict
+        :param shadow_root: Path where the shadow copy of the drive is mounted.
+        :type shadow_root: str
+        :returns: dict -- Summed stats of all rsync calls.
+        """
+        drive_letter = drive[0]
+        source_name = drive + source['path']
+        relative_path = source['path'].replace('\\','/').strip('/')
+        source_path = '{}{}'.format(drive_letter,utils.get_cygwin_path(source['path']))
+        rsync_source = '{}/./{}'.format(utils.get_cygwin_path(shadow_root),source_path)
+        exclude_list = self.source_excludes(source)
+
+        with utils.timed_phase('shard_plan', source=source_name) as record:
+            shard_list = self.shard_planner.plan(source_name, os.path.join(shadow_root, drive_letter, relative_path),
+                                                 drive_letter + '/' + relative_path,
+                                                 excludes.ExcludeFilter(exclude_list), source['shards'])
+            record['shards'] = len(shard_list)
+        if len(shard_list) < 2:
+            logger.info("{} cannot be split into shards (syncing in one rsync call).".format(source_name))
+            return self.run_rsync(rsync_source,self.cygtarget,[],exclude_list)
+
+        logger.info("Syncing {} in {} shards of {} subtree(s).".format(
+                     source_name,len(shard_list),sum(len(shard) for shard in shard_list)))
+        subtrees = [source_path.strip('/') + '/' + unit for shard in shard_list for unit in shard]
+        with shards.hiding_filter_file(subtrees) as filter_file:
+            stats_list = [self.run_rsync(rsync_source,self.cygtarget,
+                                         ['--filter=merge {}'.format(utils.get_cygwin_path(filter_file))],exclude_list)]
+        stats_list += utils.run_in_parallel(self.run_rsync,
+                                            [(['{}/{}'.format(rsync_source,unit) for unit in shard],self.cygtarget,[],exclude_list)
+                                             for shard in shard_list],
+                                            len(shard_list))
+
+        stats = {}
+        for shard_stats in stats_list:
+            for key,value in shard_stats.items():
+                stats[key] = stats.get(key, 0) + value
+        if 'num_files' in stats:
+            # the boundary call has counted the parent directories already
+            repeated = sum(len(shards.implied_dirs([source_path.strip('/') + '/' + unit for unit in shard]))
+                           for shard in shard_list)
+            stats['num_files'] -= repeated
+            self.add_stats({'num_files': -repeated})
+        return stats
+
+    def sync_changes(self,changes):
+        """Sync changed paths of sources, for watch mode (see :class:`watch.WatchRunner`).
+
+        Every drive with changes is snapshot as in a normal run, and the paths of each source
+        are synced from the snapshot with :meth:`sync_paths`. Neither the checkpoint, the
+        manifest nor verification are used, and files are deduplicated right away.
+
+        :param changes: Lists of 2-tuples of relative source and list of changed paths by drive.
+                        Paths are 2-tuples of path relative to the transfer root and ``True`` for new directories.
+        :type changes: dict
+        """
+        for drive, source_changes in sorted(changes.items()):
+            for spec, spec_sources in group_by_snapshot([s for s,paths in source_changes]):
+                with snapshots.snapshot_set([drive],spec) as shadow_root:
+                    for s, paths in source_changes:
+                        if not any(s is spec_source for spec_source in spec_sources):
+                            continue
+                        with utils.timed_phase('watch_sync', source=drive+s['path']) as record:
+                            record['paths'] = len(paths)
+                            record.update(self.sync_paths(shadow_root,paths,self.source_excludes(s)))
+
+        if self.deduplicator is not None:
+            with utils.timed_phase('dedup') as record:
+                stats = self.deduplicator.run(self.target_root)
+                record.update(stats)
+            self.add_stats(stats)
+
+    def sync_paths(self,shadow_root,paths,exclude_list):
+        """Sync single paths from a mounted shadow copy in one rsync call.
+
+        Paths are passed with ``--files-from``, and paths missing from the shadow copy are
+        deleted at the target with ``--delete-missing-args``. New directories are synced with
+        everything in them, which adds ``--recursive`` for all directories in the list.
+
+        :param shadow_root: Path where the shadow copy of the drive is mounted.
+        :type shadow_root: str
+        :param paths: List of 2-tuples of path relative to the transfer root and ``True`` for new directories.
+        :type paths: list
+        :param exclude_list: Exclude patterns applied to the paths.
+        :type exclude_list: list
+        :returns: dict -- Stats of the rsync call.
+        """
+        fd, files_from = tempfile.mkstemp(suffix='.josync-files')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                for path, new_dir in paths:
+                    f.write(path.encode('utf-8') + b'\0')
+            rsync_options = ['--files-from={}'.format(utils.get_cygwin_path(files_from)),
+                             '--from0','--delete-missing-args']
+            if any(new_dir for path, new_dir in paths):
+                rsync_options.append('--recursive')
+            return self.run_rsync(utils.get_cygwin_path(shadow_root)+'/',self.cygtarget,rsync_options,exclude_list)
+        finally:
+            os.remove(files_from)
+
+    def run_drive_batched(self,drive,sources,shadow_root):
+        """Sync all sources of a mounted drive in a single rsync call.
+
+        Per-source excludes are anchored at their source and passed in one exclude file with the global excludes.
+
+        :param drive: Drive letter with colon.
+        :type drive: str
+        :param sources: List of relative sources on the drive.
+        :type sources: list
+        :param shadow_root: Path where the shadow copy of the drive is mounted.
+        :type shadow_root: str
+        :returns: dict -- Stats of the rsync call.
+        """
+        logger.info("Backing up {} sources on {} to {} in one rsync call".format(len(sources),drive,self.target))
+        drive_letter = drive[0]
+        cygshadow_root = utils.get_cygwin_path(shadow_root)
+
+        rsync_sources = []
+        patterns = list(self.global_excludes)
+        for s in sources:
+            source_path = '{}{}'.format(drive_letter,utils.get_cygwin_path(s['path']))
+            rsync_sources.append('{}/./{}'.format(cygshadow_root,source_path))
+            patterns += self.excludes_to_anchored_patterns(source_path,s['excludes'])
+
+        return self.run_rsync(rsync_sources,self.cygtarget,[],patterns)
+
+
+def group_by_snapshot(sources):
+    """Group sources of a drive by their snapshot provider spec.
+
+    :param sources: List of relative sources on a drive.
+    :type sources: list
+    :returns: List of 2-tuples of spec and list of sources, in the order of the sources.
+    """
+    groups = []
+    for s in sources:
+        group = [g for g in groups if g[0] == s['snapshot']]
+        if group:
+            group[0][1].append(s)
+        else:
+            groups.append((s['snapshot'],[s]))
+    return groups
 
 
 class SyncJob(BaseSyncJob):
     """Simple backup syncing multiple sources to a target directory with full tree structure."""
+    supports_index = True
+    supports_watch = True
+
     def __init__(self,params):
         super(SyncJob, self).__init__(params)
         logger.debug("SyncJob constructor.")
@@ -154,14 +922,314 @@ class AdditiveJob(BaseSyncJob):
     def __init__(self,params):
         super(AdditiveJob, self).__init__(params)
         logger.debug("AdditiveJob constructor.")
-        for s in self.sources:
-            s['path'] += '/'
+        for sources in self.sources.values():
+            for s in sources:
+                s['path'] += '/'
+
+
+class TimelineJob(BaseSyncJob):
+    """Chronological backups where each run creates a dated snapshot of the sources at the target.
+
+    Files unchanged since the latest complete snapshot are hard linked to it (``--link-dest``),
+    so every run only costs the changed files. A run is written to a directory ending in
+    ``.incomplete`` which is renamed when the run is complete, and the name of the latest
+    complete snapshot is recorded in ``latest.josync-timeline`` at the target. Older
+    snapshots are thinned so that they get sparser as time passes.
+    """
+
+    snapshot_format = '%Y-%m-%d_%H%M%S'
+    incomplete_suffix = '.incomplete'
+    latest_filename = 'latest.josync-timeline'
+
+    def __init__(self,params):
+        super(TimelineJob, self).__init__(params)
+        logger.debug("TimelineJob constructor.")
+        if self.secondary_targets:
+            raise utils.JobDescriptionValueError('Timeline jobs do not support secondary_targets.')
+
+        # Delete option for resuming into an incomplete snapshot
+        # Relative option to create directory tree at target
+        self.rsync_base_options += ['--delete','--delete-excluded','--relative']
+
+        keep = {
+            'all_days': 1,
+            'daily_days': 30,
+            'weekly_days': 365,
+            'max_days': None
+        }
+        try:
+            keep.update(params.get('timeline_keep', {}))
+        except (TypeError, ValueError):
+            raise utils.JobDescriptionValueError('timeline_keep must be a dictionary.')
+        self.keep = keep
+
+    def run(self):
+        """Sync the sources to a new snapshot directory, linking unchanged files to the latest snapshot.
+
+        A dry run leaves the target as it is and compares the sources with the latest snapshot.
+
+        :raises: utils.TimelineError
+        """
+        now = datetime.datetime.now()
+        latest = self.get_latest_snapshot()
+        if utils.config.get('dry_run', False):
+            target = os.path.join(self.target, latest) if latest is not None else self.target
+            logger.info("Dry run, comparing the sources with {}.".format(target))
+            self.run_options = ['--link-dest={}'.format(utils.get_cygwin_path(target))] if latest is not None else []
+            self.cygtarget = utils.get_cygwin_path(target)
+            self.target_root = target
+            super(TimelineJob, self).run()
+            return
+
+        snapshot_name = self.new_snapshot_name(now)
+        snapshot_dir = os.path.join(self.target, snapshot_name + self.incomplete_suffix)
+
+        # resume from an interrupted run if there is one, otherwise start a new snapshot
+        incomplete = [d for d in os.listdir(self.target) if d.endswith(self.incomplete_suffix)]
+        if incomplete:
+            resumed_dir = os.path.join(self.target, sorted(incomplete)[-1])
+            logger.info("Resuming incomplete snapshot {} as {}".format(resumed_dir, snapshot_dir))
+            os.rename(resumed_dir, snapshot_dir)
+        else:
+            os.mkdir(snapshot_dir)
+
+        if latest is not None:
+            logger.info("Linking unchanged files to snapshot {}".format(latest))
+            self.run_options = ['--link-dest={}'.format(utils.get_cygwin_path(os.path.join(self.target, latest)))]
+        else:
+            logger.info("No complete snapshot found, making a full copy.")
+            self.run_options = []
+        self.cygtarget = utils.get_cygwin_path(snapshot_dir)
+        self.target_root = snapshot_dir
+
+        super(TimelineJob, self).run()
+
+        try:
+            os.rename(snapshot_dir, os.path.join(self.target, snapshot_name))
+        except OSError as e:
+            raise utils.TimelineError("Snapshot {} could not be completed and is left as {}: {}".format(
+                                      snapshot_name, snapshot_dir, e))
+        self.set_latest_snapshot(snapshot_name)
+        logger.info("Snapshot {} is complete.".format(snapshot_name))
+
+        self.thin_snapshots(now)
+
+    def new_snapshot_name(self, now):
+        """Name of a new snapshot, with a suffix ``-2``, ``-3``, ... if another run started in the same second.
+
+        :param now: Time of the run.
+        :type now: datetime.datetime
+        :returns: str -- Directory name neither taken by a snapshot nor by an incomplete one.
+        """
+        base = now.strftime(self.snapshot_format)
+        name = base
+        count = 1
+        while os.path.lexists(os.path.join(self.target, name)) or \
+                os.path.lexists(os.path.join(self.target, name + self.incomplete_suffix)):
+            count += 1
+            name = '{}-{}'.format(base, count)
+        return name
+
+    def snapshot_time(self, name):
+        """Time of a snapshot from its directory name, or ``None`` if the name is not one of a snapshot."""
+        try:
+            return datetime.datetime.strptime(re.sub(r'-\d+$', '', name), self.snapshot_format)
+        except ValueError:
+            return None
+
+    def get_snapshots(self):
+        """List complete snapshots at the target.
+
+        :returns: List of 2-tuples with directory name and datetime, oldest first.
+        """
+        snapshots = []
+        for name in os.listdir(self.target):
+            if not os.path.isdir(os.path.join(self.target, name)):
+                continue
+            created = self.snapshot_time(name)
+            if created is not None:
+                snapshots.append((name, created))
+        # snapshots of the same second in the order of their suffixes
+        return sorted(snapshots, key=lambda s: (s[1], len(s[0]), s[0]))
+
+    def get_latest_snapshot(self):
+        """Read the name of the latest complete snapshot.
+
+        :returns: str -- Directory name of the snapshot, or ``None`` if there is none.
+        """
+        latest_file = os.path.join(self.target, self.latest_filename)
+        if not os.path.isfile(latest_file):
+            return None
+        with open(latest_file) as f:
+            name = f.read().strip()
+        if not name or not os.path.isdir(os.path.join(self.target, name)):
+            logger.warning("The latest snapshot {} recorded in {} does not exist.".format(name, latest_file))
+            return None
+        return name
+
+    def set_latest_snapshot(self, name):
+        """Record the name of the latest complete snapshot.
+
+        :param name: Directory name of the snapshot.
+        :type name: str
+        """
+        utils.write_file_atomic(os.path.join(self.target, self.latest_filename), name + '\n')
+
+    def thin_snapshots(self, now):
+        """Delete old snapshots so that they get sparser with age.
+
+        All snapshots younger than ``all_days`` are kept, then one per day until
+        ``daily_days``, one per week until ``weekly_days`` and one per month after that.
+        Snapshots older than ``max_days`` are deleted, if set. The latest snapshot is
+        always kept.
+
+        :param now: Time of the current run.
+        :type now: datetime.datetime
+        """
+        latest = self.get_latest_snapshot()
+        kept_buckets = set()
+        for name, created in self.get_snapshots():
+            age = (now - created).total_seconds()/86400.
+            if age < self.keep['all_days']:
+                bucket = name
+            elif age < self.keep['daily_days']:
+                bucket = ('day', created.date())
+            elif age < self.keep['weekly_days']:
+                bucket = ('week',) + created.isocalendar()[:2]
+            else:
+                bucket = ('month', created.year, created.month)
+
+            too_old = self.keep['max_days'] is not None and age > self.keep['max_days']
+            if name == latest or (bucket not in kept_buckets and not too_old):
+                kept_buckets.add(bucket)
+                continue
+
+            logger.info("Thinning timeline: deleting snapshot {}".format(name))
+            shutil.rmtree(os.path.join(self.target, name))
+
+
+class Checkpoint(object):
+    """Record of the sources a job has completed, so that a re-run after a failure can skip them.
+
+    A checkpoint belongs to a single run. The sources completed by an interrupted run are
+    skipped by the next run only; that run starts a checkpoint of its own, so a source is
+    never skipped twice in a row, whatever the time between the runs. The checkpoint file
+    is removed when a run completes, so the run after a complete run syncs all sources.
+    """
+    def __init__(self, checkpoint_file):
+        super(Checkpoint, self).__init__()
+        self.checkpoint_file = checkpoint_file
+        self.lock = threading.Lock()
+        self.run = time.time()
+        self.interrupted_run = None
+        self.interrupted_completed = set()
+        self.completed = set()
+
+        if os.path.isfile(checkpoint_file):
+            try:
+                with open(checkpoint_file) as f:
+                    data = json.loads(f.read())
+                self.interrupted_run = data['run']
+                self.interrupted_completed = set(data['completed'])
+            except (IOError, ValueError, KeyError, TypeError) as e:
+                logger.warning("Could not read checkpoint {}: {}".format(checkpoint_file, e))
+            os.remove(checkpoint_file)
+
+    def interrupted_run_time(self):
+        return datetime.datetime.fromtimestamp(self.interrupted_run).strftime('%Y-%m-%d %H:%M')
+
+    def is_completed(self, source):
+        """True if the source was completed by the interrupted run this run follows."""
+        return source in self.interrupted_completed
+
+    def complete(self, source):
+        """Record a source as completed and write the checkpoint file."""
+        with self.lock:
+            self.completed.add(source)
+            utils.write_file_atomic(self.checkpoint_file,
+                                    json.dumps({'run': self.run, 'completed': sorted(self.completed)}))
+
+    def clear(self):
+        """Remove the checkpoint file after a complete run."""
+        with self.lock:
+            self.completed = set()
+            if os.path.isfile(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
+
+
+def format_bytes(n):
+    """Format a number of bytes for humans, e.g. ``12.3 MB``."""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(n) < 1024.:
+            return "{:.1f} {}".format(n, unit)
+        n /= 1024.
+    return "{:.1f} TB".format(n)
+
+
+class ProgressLogger(object):
+    """Progress callback logging the progress of a job at most every ``interval`` seconds."""
+    def __init__(self, interval=30):
+        super(ProgressLogger, self).__init__()
+        self.interval = interval
+        self.last_time = 0
+
+    def __call__(self, progress):
+        now = time.time()
+        if now - self.last_time < self.interval:
+            return
+        self.last_time = now
+
+        message = "Progress: {} done".format(format_bytes(progress.job_bytes))
+        if progress.expected_bytes:
+            message += " of about {} ({:.0f} %)".format(format_bytes(progress.expected_bytes),
+                                                        100*progress.job_bytes/progress.expected_bytes)
+        if progress.rate is not None:
+            message += ", {}/s".format(format_bytes(progress.rate))
+        if progress.eta is not None:
+            message += ", ETA {}".format(datetime.timedelta(seconds=int(progress.eta)))
+        logger.info(message)
+
+
+class ProgressStatusFile(object):
+    """Progress callback writing the progress of a job as JSON to a status file.
+
+    The file is written at most every ``interval`` seconds, and replaced in one step
+    so that readers never see a partial file. Call :meth:`finish` when the job has ended.
+    """
+    def __init__(self, status_file, job_file=None, interval=5):
+        super(ProgressStatusFile, self).__init__()
+        self.status_file = status_file
+        self.job_file = job_file
+        self.interval = interval
+        self.last_time = 0
+        self.write({'state': 'running'})
+
+    def __call__(self, progress):
+        now = time.time()
+        if now - self.last_time < self.interval:
+            return
+        self.last_time = now
+        status = progress._asdict()
+        status['state'] = 'running'
+        self.write(status)
+
+    def finish(self, success, stats=None):
+        self.write({'state': 'succeeded' if success else 'failed', 'stats': stats or {}})
+
+    def write(self, status):
+        status['job_file'] = self.job_file
+        status['time'] = datetime.datetime.now().isoformat()
+        try:
+            utils.write_file_atomic(self.status_file, json.dumps(status))
+        except (IOError, OSError) as e:
+            logger.warning("Could not write status file {}: {}".format(self.status_file, e))
 
 
 # enumerate all possible job types and their constructors
 job_types = {
     'sync': SyncJob,
-    'add': AdditiveJob
+    'add': AdditiveJob,
+    'timeline': TimelineJob
 }
 
 
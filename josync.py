@@ -4,56 +4,290 @@ import json
 import argparse
 import sys
 import os
+import ntpath
 import subprocess as sp
+import time
+import datetime
+import sqlite3
 
 import jobs
 import utils
+import logqueue
+import history
+import snapshots
+import watch
 
 logger = logging.getLogger(__name__)
 main_logger = logging.getLogger('josync_run')
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Scripted backup using rsync on Windows.')
-    parser.add_argument('jobfile',help='path to job file specifying josync job',type=str)
+    parser.add_argument('jobfile',help='path to job file specifying josync job, several to run them in one session',type=str,nargs='+')
     parser.add_argument('--debug',help='set all loggers to debug level',action='store_true')
     parser.add_argument('--nonotifications',help='disable notifications on backup failure',action='store_true')
     parser.add_argument('--dry-run',help='send --dry-run to rsync and do not actually transfer any files',action='store_true')
+    parser.add_argument('--refresh-environment',help='ignore cached config and net drives',action='store_true')
+    parser.add_argument('--progress',help='log progress, transfer rate and ETA while rsync runs',action='store_true')
+    parser.add_argument('--status-file',help='write progress of the job as JSON to this file',type=str,default=None)
+    parser.add_argument('--preview-excludes',help='list the paths skipped because of excludes and exit without syncing',action='store_true')
+    parser.add_argument('--watch',help='keep running and sync changed paths as they change, until interrupted',action='store_true')
 
     return parser
 
-def main():
-    parser = get_parser()
-    args = parser.parse_args()
-    jobfile = args.jobfile
+def configure_logging(log_name, debug=False):
+    """Configure logging from ``logging.josync-config``, writing details to the log of ``log_name``.
 
+    Logging that was configured before is stopped and replaced.
+
+    :param log_name: Job file (or other name) the details log is named after.
+    :type log_name: str
+    :param debug: Set all loggers to debug level.
+    :type debug: bool
+    """
+    logqueue.stop()
     with open('logging.josync-config') as f:
         log_config = json.loads(f.read())
     log_config['handlers']['details_file_handler']['filename'] = \
-        log_config['handlers']['details_file_handler']['filename'].format(jobfile.replace('.josync-job',''))
+        log_config['handlers']['details_file_handler']['filename'].format(log_name.replace('.josync-job',''))
     logging.config.dictConfig(log_config)
     logging.getLogger().setLevel(logging.INFO)
+    logqueue.start()
 
-    if args.debug:
+    if debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    if not jobfile.endswith('.josync-job'):
-        jobfile = jobfile + '.josync-job'
 
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    jobfiles = [f if f.endswith('.josync-job') else f + '.josync-job' for f in args.jobfile]
+
+    if len(jobfiles) > 1:
+        if args.watch:
+            parser.error('--watch takes a single job file.')
+        if not run_session(jobfiles, args):
+            sys.exit(1)
+        return
+    if args.watch:
+        if not run_watch(jobfiles[0], args):
+            sys.exit(1)
+        return
+
+    configure_logging(args.jobfile[0], args.debug)
+    log_session_start(args)
+    utils.initialize(use_cache=not args.refresh_environment)
+    utils.config['dry_run'] = args.dry_run
+
+    succeeded = run_job_file(jobfiles[0], args)
+    logger.info("Session ended.")
+    logqueue.stop()
+    if not succeeded:
+        sys.exit(1)
+
+
+def log_session_start(args):
     logger.info("************************************************************")
     logger.info("Session started. Josync version {}.".format(utils.version))
     if args.nonotifications:
         logger.info("Failure notifications are disabled.")
 
-    utils.initialize()
+
+def session_snapshot_groups(jobfiles):
+    """Local drives read by any of several jobs, grouped by snapshot provider.
+
+    Drives that the jobs snapshot with different providers are left out, so every job snapshots them itself.
+
+    :param jobfiles: Paths to job files.
+    :type jobfiles: list
+    :returns: List of 2-tuples of provider spec and list of drive letters with colon.
+    """
+    specs = {}
+    for jobfile in jobfiles:
+        try:
+            with open(jobfile) as f:
+                params = json.loads(f.read())
+            for s in params['sources']:
+                drive, path = ntpath.splitdrive(s['path'])
+                spec = snapshots.source_spec(params.get('snapshots', {}), s, drive)
+                if drive and not utils.is_net_drive(drive) and os.path.isdir(snapshots.live_path(spec, drive, path)):
+                    specs.setdefault(drive.lower(), (drive, []))[1].append(spec)
+        except (IOError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning("Could not read the sources of {}: {}".format(jobfile, e))
+
+    groups = []
+    for key, (drive, drive_specs) in sorted(specs.items()):
+        if any(spec != drive_specs[0] for spec in drive_specs):
+            logger.warning("Jobs snapshot {} with different providers, not sharing its snapshot.".format(drive))
+            continue
+        group = [g for g in groups if g[0] == drive_specs[0]]
+        if group:
+            group[0][1].append(drive)
+        else:
+            groups.append((drive_specs[0], [drive]))
+    return groups
+
+
+def run_session(jobfiles, args):
+    """Run several jobs one after the other, sharing one snapshot per drive.
+
+    The drives read by any of the jobs are snapshot before the first job starts
+    (see :func:`snapshots.shared_snapshots`), and the snapshots are deleted after
+    the last job ended. All jobs thereby back up the same point in time. Each job
+    still has its own details log, run report, history entry and failure
+    notifications. If the snapshots cannot be created, every job creates its own.
+    The phases outside the jobs, such as creating and deleting the shared snapshots,
+    go to the run report of the session, ``session.josync-job-report``.
+
+    :param jobfiles: Paths to job files.
+    :type jobfiles: list
+    :returns: bool -- True if all jobs succeeded.
+    """
+    start_time = time.time()
+    configure_logging('session', args.debug)
+    log_session_start(args)
+    utils.initialize(use_cache=not args.refresh_environment)
     utils.config['dry_run'] = args.dry_run
 
+    groups = session_snapshot_groups(jobfiles)
+    started = []
+    session_phases = []
+    error = None
+    succeeded = True
+    try:
+        if groups and not args.preview_excludes:
+            logger.info("Running {} job(s) sharing snapshots of {}.".format(
+                        len(jobfiles), ', '.join(drive for spec, drives in groups for drive in drives)))
+            with snapshots.shared_snapshots(groups):
+                for jobfile in jobfiles:
+                    started.append(jobfile)
+                    succeeded = run_session_job(jobfile, args, session_phases) and succeeded
+                configure_logging('session', args.debug)
+    except Exception as e:
+        error = e
+        configure_logging('session', args.debug)
+        if started:
+            logger.error("Shared snapshots could not be deleted: {}".format(e))
+        else:
+            logger.error("Shared snapshots could not be created, every job creates its own: {}".format(e))
+        logger.exception(e)
+
+    remaining = [f for f in jobfiles if not f in started]
+    for jobfile in remaining:
+        succeeded = run_session_job(jobfile, args, session_phases) and succeeded
+    if remaining:
+        configure_logging('session', args.debug)
+
+    with utils.phase_timings_lock:
+        utils.phase_timings[:0] = session_phases
+    write_run_report('session', start_time, None, error)
+    logger.info("Session ended.")
+    logqueue.stop()
+    return succeeded
+
+
+def run_session_job(jobfile, args, session_phases):
+    """Run one job of a session.
+
+    Phases recorded since the previous job belong to the session and are moved to
+    ``session_phases``, so that the run report of the job only has its own phases.
+
+    :param jobfile: Path to job file.
+    :type jobfile: str
+    :param args: Parsed command line arguments.
+    :param session_phases: Phases of the session.
+    :type session_phases: list
+    :returns: bool -- True if the job succeeded.
+    """
+    configure_logging(jobfile, args.debug)
+    log_session_start(args)
+    with utils.phase_timings_lock:
+        session_phases += utils.phase_timings
+        del utils.phase_timings[:]
+    succeeded = run_job_file(jobfile, args)
+    # the phases of the job are in its run report
+    with utils.phase_timings_lock:
+        del utils.phase_timings[:]
+    logger.info("Job ended.")
+    return succeeded
+
+
+def run_watch(jobfile, args):
+    """Keep a job running and sync the paths of its sources as they change, see :class:`watch.WatchRunner`.
+
+    The full runs of the job go through :func:`run_job_file`, with run reports, history
+    and failure notifications. Syncs of changed paths are logged to the details log.
+    Runs until interrupted.
+
+    :param jobfile: Path to job file.
+    :type jobfile: str
+    :param args: Parsed command line arguments.
+    :returns: bool -- False if the job cannot be watched.
+    """
+    configure_logging(jobfile, args.debug)
+    log_session_start(args)
+    utils.initialize(use_cache=not args.refresh_environment)
+    utils.config['dry_run'] = args.dry_run
+
+    try:
+        job = jobs.create_job_from_file(jobfile)
+        if not job.supports_watch:
+            raise utils.JobDescriptionValueError('Watch mode is only supported by sync jobs.')
+    except (utils.JobDescriptionKeyError, utils.JobDescriptionValueError,
+            utils.JsonSyntaxError, utils.TargetNotFoundError, IOError, ValueError) as e:
+        main_logger.error("Josync job {} cannot be watched: {}".format(jobfile,e))
+        logqueue.stop()
+        return False
+
+    def full_run():
+        with utils.phase_timings_lock:
+            del utils.phase_timings[:]
+        run_job_file(jobfile, args)
+
+    logger.info("Watching the sources of {} for changes.".format(jobfile))
+    try:
+        watch.WatchRunner(job, full_run).run()
+    except KeyboardInterrupt:
+        logger.info("Watching interrupted.")
+    logger.info("Session ended.")
+    logqueue.stop()
+    return True
+
+
+def run_job_file(jobfile, args):
+    """Create and run the job of a job file, then write its run report and add it to the run history.
+
+    Errors of the job are logged and do not propagate.
+
+    :param jobfile: Path to job file.
+    :type jobfile: str
+    :param args: Parsed command line arguments.
+    :returns: bool -- True if the job succeeded.
+    """
+    start_time = time.time()
+    job = None
+    error = None
+    status_file = None
+
     # parse job file and run job
     try:
         if not args.nonotifications:
             failure_notifier = utils.FailureNotifier(jobfile)
 
-        job = jobs.create_job_from_file(jobfile)
-        job.run()
+        if args.status_file:
+            status_file = jobs.ProgressStatusFile(args.status_file, jobfile)
+
+        with utils.timed_phase('create_job'):
+            job = jobs.create_job_from_file(jobfile)
+        if args.preview_excludes:
+            for source, path, pattern in job.preview_excludes():
+                print u"{}: {} (excluded by {})".format(source, path, pattern).encode('utf-8')
+            return True
+        if args.progress:
+            job.add_progress_callback(jobs.ProgressLogger())
+        if status_file is not None:
+            job.add_progress_callback(status_file)
+        with utils.timed_phase('run_job'):
+            job.run()
         try:
             transferred = job.stats['file_size_transferred']/1024.0
             total = job.stats['tot_file_size']/1024.0
@@ -66,22 +300,125 @@ def main():
             failure_notifier.record_successful_run()
 
     except utils.JobDescriptionKeyError as e:
+        error = e
         main_logger.error("The required job parameter '{}' was not found in the job file.".format(e))
     except utils.JobDescriptionValueError as e:
+        error = e
         main_logger.error("Error in job description: {}".format(e))
     except utils.JsonSyntaxError as e:
+        error = e
         main_logger.error("One of the JSON configuration files could not be parsed: {}".format(e))
     except utils.TargetNotFoundError as e:
+        error = e
         main_logger.error("The target directory {} does not exist for job {}.".format(e,jobfile))
         if not args.nonotifications:
             failure_notifier.notify()
+    except utils.TimelineError as e:
+        error = e
+        main_logger.error("Josync job {} failed: {}".format(jobfile,e))
+        if not args.nonotifications:
+            failure_notifier.notify()
     except Exception as e:
+        error = e
         main_logger.error("Josync job {} failed with an exception: {}".format(jobfile,e))
         logger.exception(e)
         if not args.nonotifications:
             failure_notifier.notify()
 
-    logger.info("Session ended.")
+    if status_file is not None:
+        status_file.finish(error is None, job.stats if job is not None else None)
+    report = write_run_report(jobfile, start_time, job, error)
+    record_history(report)
+    return error is None
+
+
+def write_run_report(jobfile, start_time, job, error):
+    """Write timings of all phases, stats and outcome of the run to the job's report file.
+
+    :param jobfile: Path to job file.
+    :type jobfile: str
+    :param start_time: Time when the run started, as returned by ``time.time()``.
+    :type start_time: float
+    :param job: The job, or ``None`` if it could not be created.
+    :param error: Exception that made the run fail, or ``None``.
+    """
+    end_time = time.time()
+    duration = end_time - start_time
+    stats = dict(job.stats) if job is not None else {}
+
+    phases = []
+    with utils.phase_timings_lock:
+        records = sorted(utils.phase_timings, key=lambda r: r['start'])
+    for record in records:
+        phase = dict(record)
+        phase['start'] = phase['start'] - start_time
+        if phase['duration'] > 0 and 'file_size_transferred' in phase:
+            phase['bytes_per_second'] = phase['file_size_transferred']/phase['duration']
+        if phase['duration'] > 0 and 'num_files' in phase:
+            phase['files_per_second'] = phase['num_files']/phase['duration']
+        phases.append(phase)
+
+    report = {
+        'job_file': jobfile,
+        'version': utils.version,
+        'start_time': datetime.datetime.fromtimestamp(start_time).isoformat(),
+        'duration': duration,
+        'success': error is None,
+        'error': str(error) if error is not None else None,
+        'dry_run': utils.config.get('dry_run', False),
+        'stats': stats,
+        'bytes_per_second': stats.get('file_size_transferred', 0)/duration if duration > 0 else None,
+        'files_per_second': stats.get('num_files', 0)/duration if duration > 0 else None,
+        'exit_codes': [r['exit_code'] for r in phases if r['phase'] == 'rsync' and 'exit_code' in r],
+        'snapshots': snapshot_latency(phases),
+        'phases': phases
+    }
+
+    try:
+        utils.write_run_report(utils.run_report_filename(jobfile), report)
+    except (IOError, TypeError, ValueError) as e:
+        logger.warning("Could not write run report: {}".format(e))
+    return report
+
+
+def snapshot_latency(phases):
+    """Seconds spent creating, mounting, unmounting and deleting snapshots, by snapshot provider.
+
+    :param phases: Phases of the run report.
+    :type phases: list
+    :returns: dict -- Dicts with the seconds of each step and the ``count`` of snapshots, by provider.
+    """
+    latency = {}
+    for phase in phases:
+        if not phase['phase'].startswith('snapshot_') or not 'provider' in phase:
+            continue
+        provider = latency.setdefault(phase['provider'], {'count': 0})
+        step = phase['phase'][len('snapshot_'):]
+        provider[step] = provider.get(step, 0) + phase['duration']
+        if step == 'delete':
+            provider['count'] += 1
+    return latency
+
+
+def record_history(report):
+    """Flag a run that was abnormally slow or large in the run summary, and add it to the run history.
+
+    :param report: Run report as returned by :func:`write_run_report`.
+    :type report: dict
+    """
+    history_file = utils.config.get('history_file', 'josync-history.db')
+    if not history_file:
+        return
+    try:
+        run_history = history.RunHistory(history_file)
+        if report['success'] and not report['dry_run']:
+            messages = run_history.abnormal(report['job_file'], report['duration'], report['stats'],
+                                            utils.config.get('history_abnormal_factor', 3.))
+            for message in messages:
+                main_logger.warning("Josync job {} was unusual: {}.".format(report['job_file'], message))
+        run_history.record(report)
+    except sqlite3.Error as e:
+        logger.warning("Could not record run in history {}: {}".format(history_file, e))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+import logging
+import logging.handlers
+import threading
+import Queue
+import atexit
+import time
+
+# handlers are moved here from the configured loggers by start()
+listener = None
+
+
+class QueueHandler(logging.Handler):
+    """Handler putting records on a queue, to be handled by a :class:`QueueListener`.
+
+    Logging then only costs the thread that logs the creation of the record, while
+    formatting and writing happen on the listener thread.
+
+    :param queue: Queue of the listener.
+    :param handlers: Handlers the records are passed to by the listener.
+    :type handlers: list
+    """
+    def __init__(self, queue, handlers):
+        super(QueueHandler, self).__init__()
+        self.queue = queue
+        self.handlers = handlers
+
+    def prepare(self, record):
+        # merge arguments into the message and format exceptions now, since they may change later
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait((self.handlers, self.prepare(record)))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Thread passing queued records to their handlers, in batches.
+
+    Up to ``batch_size`` records waiting in the queue are handled at once, and handlers
+    with a ``flush_batch`` method (see :class:`BatchedRotatingFileHandler`) are flushed
+    once per batch instead of once per record.
+    """
+    def __init__(self, queue, batch_size=500):
+        super(QueueListener, self).__init__()
+        self.queue = queue
+        self.batch_size = batch_size
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Handle all queued records and end the thread."""
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            flushed = set()
+            for item in batch:
+                if item is None:
+                    continue
+                handlers, record = item
+                for handler in handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                    if hasattr(handler, 'flush_batch'):
+                        flushed.add(handler)
+            for handler in flushed:
+                handler.flush_batch()
+
+            if None in batch:
+                return
+
+
+class BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotating file handler that only flushes when asked to with :meth:`flush_batch`.
+
+    Used with :class:`QueueListener`, which flushes once per batch of records. Without
+    the listener it flushes after every record, like :class:`logging.handlers.RotatingFileHandler`.
+    """
+    def flush(self):
+        if listener is None:
+            self.flush_batch()
+
+    def flush_batch(self):
+        logging.handlers.RotatingFileHandler.flush(self)
+
+    def close(self):
+        self.flush_batch()
+        logging.handlers.RotatingFileHandler.close(self)
+
+
+class RateLimitFilter(logging.Filter):
+    """Filter passing at most ``per_second`` records each second.
+
+    The first record passed after others were dropped notes how many were dropped.
+    Meant for chatty loggers such as the file names printed by rsync.
+
+    :param per_second: Maximum number of records per second, no limit if 0.
+    :type per_second: int
+    """
+    def __init__(self, per_second=20):
+        super(RateLimitFilter, self).__init__()
+        self.per_second = per_second
+        self.second = None
+        self.count = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.per_second:
+            return True
+        second = int(record.created)
+        with self.lock:
+            if second != self.second:
+                self.second = second
+                self.count = 0
+            self.count += 1
+            if self.count > self.per_second:
+                self.dropped += 1
+                return False
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            record.msg = "[{} lines not shown] {}".format(dropped, record.msg)
+        return True
+
+
+def start():
+    """Move the handlers of all configured loggers to a listener thread.
+
+    Call after configuring logging. Every logger with handlers gets a single
+    :class:`QueueHandler` instead, which passes its records to the original handlers
+    on the listener thread. :func:`stop` is called at exit.
+    """
+    global listener
+    if listener is not None:
+        return
+    queue = Queue.Queue()
+    listener = QueueListener(queue)
+
+    root = logging.getLogger()
+    loggers = [root] + [l for l in root.manager.loggerDict.values() if isinstance(l, logging.Logger)]
+    for logger in loggers:
+        if not logger.handlers:
+            continue
+        handlers = list(logger.handlers)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(QueueHandler(queue, handlers))
+
+    listener.start()
+
+
+def stop():
+    """Write all queued records and put the original handlers back on their loggers."""
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    listener = None
+
+    root = logging.getLogger()
+    loggers = [root] + [l for l in root.manager.loggerDict.values() if isinstance(l, logging.Logger)]
+    for logger in loggers:
+        for handler in list(logger.handlers):
+            if isinstance(handler, QueueHandler):
+                logger.removeHandler(handler)
+                for original in handler.handlers:
+                    logger.addHandler(original)
+                    original.flush()
+
+
+# once, however often logging is started and stopped
+atexit.register(stop)
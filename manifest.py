@@ -0,0 +1,198 @@
+import os
+import glob
+import json
+import zlib
+import struct
+import hashlib
+import logging
+import threading
+import datetime
+import collections
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """Set of strings answering "maybe in the set" or "certainly not", in a fixed number of bits.
+
+    :param bits: Number of bits, rounded up to whole bytes.
+    :type bits: int
+    :param hashes: Number of bits set per string.
+    :type hashes: int
+    """
+    def __init__(self, bits, hashes=7, data=None):
+        super(BloomFilter, self).__init__()
+        self.bits = ((bits + 7)//8)*8
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray(self.bits//8)
+
+    def positions(self, key):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key.encode('utf-8')).digest())
+        return [(h1 + i*h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.data[p//8] |= 1 << (p % 8)
+
+    def __contains__(self, key):
+        return all(self.data[p//8] & (1 << (p % 8)) for p in self.positions(key))
+
+
+def manifest_filename(job_file, start_time):
+    """Name of the manifest of a run, next to the job's log.
+
+    :param job_file: Path to job file.
+    :type job_file: str
+    :param start_time: Start of the run.
+    :type start_time: datetime.datetime
+    """
+    return '{}-{}.josync-manifest.gz'.format(job_file.replace('.josync-job',''), start_time.strftime('%Y-%m-%d_%H%M%S'))
+
+
+def find_manifests(job_file):
+    """Manifests of the runs of a job, newest first.
+
+    :param job_file: Path to job file.
+    :type job_file: str
+    :returns: List of paths to manifest files.
+    """
+    return sorted(glob.glob('{}-[0-9][0-9][0-9][0-9]-*.josync-manifest.gz'.format(job_file.replace('.josync-job',''))), reverse=True)
+
+
+class ManifestWriter(object):
+    """Writes the itemized changes of a run to a gzip compressed manifest, while rsync runs.
+
+    Subscribe an instance to a job with :meth:`jobs.Job.subscribe`. Each changed or
+    deleted path becomes one line ``change<TAB>size<TAB>path`` (size is empty if not
+    known), with paths relative to the rsync transfer root, e.g. ``d/projects/notes.txt``.
+
+    Entries are compressed in blocks of ``block_size`` lines, each a separate gzip
+    member, so the file can be read with any gzip tool, while memory use is bounded
+    by one block. For every block an index file (the manifest name plus ``.idx``)
+    records its offset in the file and a Bloom filter of its paths, so that
+    :class:`Manifest` only needs to decompress the blocks that may contain a path.
+
+    :param manifest_file: Path to manifest file.
+    :type manifest_file: str
+    :param block_size: Number of lines per block.
+    :type block_size: int
+    """
+    def __init__(self, manifest_file, block_size=10000):
+        super(ManifestWriter, self).__init__()
+        self.manifest_file = manifest_file
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.lines = []
+        self.bloom = BloomFilter(10*block_size)
+        self.offset = 0
+        self.entries = 0
+        self.f = open(manifest_file, 'wb')
+        self.index = open(manifest_file + '.idx', 'w')
+
+    def __call__(self, event):
+        if not isinstance(event, utils.ItemizedChange):
+            return
+        path = event.path.decode('utf-8', 'replace') if isinstance(event.path, bytes) else event.path
+        line = u'{}\t{}\t{}\n'.format(event.change.strip(), int(event.size) if event.size is not None else '', path)
+        with self.lock:
+            self.lines.append(line.encode('utf-8'))
+            self.bloom.add(path.rstrip(u'/'))
+            if len(self.lines) >= self.block_size:
+                self.write_block()
+
+    def write_block(self):
+        if not self.lines:
+            return
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(b''.join(self.lines)) + compressor.flush()
+        self.f.write(data)
+        self.index.write(json.dumps({'offset': self.offset, 'length': len(data), 'entries': len(self.lines),
+                                     'bloom_bits': self.bloom.bits, 'bloom_hashes': self.bloom.hashes,
+                                     'bloom': bytes(self.bloom.data).encode('base64').replace('\n', '')}) + '\n')
+        self.offset += len(data)
+        self.entries += len(self.lines)
+        self.lines = []
+        self.bloom = BloomFilter(10*self.block_size)
+
+    def close(self):
+        """Write the last block and close the files."""
+        with self.lock:
+            if self.f.closed:
+                return
+            self.write_block()
+            self.f.close()
+            self.index.close()
+        logger.info("Wrote {} changed path(s) to manifest {}.".format(self.entries, self.manifest_file))
+
+
+ManifestEntry = collections.namedtuple('ManifestEntry', ['path', 'change', 'size'])
+
+
+class Manifest(object):
+    """Reads a manifest written by :class:`ManifestWriter`.
+
+    :param manifest_file: Path to manifest file.
+    :type manifest_file: str
+    """
+    def __init__(self, manifest_file):
+        super(Manifest, self).__init__()
+        self.manifest_file = manifest_file
+        self.blocks = []
+        index_file = manifest_file + '.idx'
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                for line in f:
+                    block = json.loads(line)
+                    block['bloom'] = BloomFilter(block['bloom_bits'], block['bloom_hashes'], block['bloom'].decode('base64'))
+                    self.blocks.append(block)
+
+    def start_time(self):
+        """Start of the run, from the manifest name."""
+        stamp = os.path.basename(self.manifest_file)[:-len('.josync-manifest.gz')].rsplit('-', 3)[-3:]
+        return datetime.datetime.strptime('-'.join(stamp), '%Y-%m-%d_%H%M%S')
+
+    def parse_block(self, data):
+        for line in zlib.decompress(data, 16 + zlib.MAX_WBITS).decode('utf-8').splitlines():
+            change, size, path = line.split(u'\t', 2)
+            yield ManifestEntry(path, change, int(size) if size else None)
+
+    def __iter__(self):
+        """Iterate over all entries, one block at a time."""
+        with open(self.manifest_file, 'rb') as f:
+            for block in self.blocks:
+                f.seek(block['offset'])
+                for entry in self.parse_block(f.read(block['length'])):
+                    yield entry
+
+    def lookup(self, path):
+        """Find the entry of a path, decompressing only the blocks that may contain it.
+
+        :param path: Path relative to the transfer root, e.g. ``d/projects/notes.txt``.
+        :type path: unicode
+        :returns: :class:`ManifestEntry`, or ``None`` if the path was not touched in the run.
+        """
+        path = (path.decode('utf-8') if isinstance(path, bytes) else path).strip(u'/')
+        with open(self.manifest_file, 'rb') as f:
+            for block in self.blocks:
+                if not path in block['bloom']:
+                    continue
+                f.seek(block['offset'])
+                for entry in self.parse_block(f.read(block['length'])):
+                    if entry.path.rstrip(u'/') == path:
+                        return entry
+        return None
+
+    def touched(self, path):
+        """True if the path was transferred, changed or deleted in the run."""
+        return self.lookup(path) is not None
+
+
+def remove_old_manifests(job_file, keep):
+    """Delete all but the newest ``keep`` manifests of a job."""
+    for manifest_file in find_manifests(job_file)[keep:]:
+        for filename in [manifest_file, manifest_file + '.idx']:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        logger.debug("Removed old manifest {}".format(manifest_file))
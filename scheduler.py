@@ -0,0 +1,262 @@
+import logging
+import json
+import argparse
+import sys
+import os
+import ntpath
+import glob
+import time
+import datetime
+import threading
+import subprocess as sp
+
+import utils
+import logqueue
+import josync
+
+logger = logging.getLogger(__name__)
+main_logger = logging.getLogger('josync_run')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Run a directory of Josync jobs on a schedule.')
+    parser.add_argument('jobdir',help='directory with .josync-job files',type=str)
+    parser.add_argument('--workers',help='maximum number of jobs running at the same time (default 4)',type=int,default=4)
+    parser.add_argument('--per-source-device',help='maximum number of running jobs using a device a job reads from (default 1)',type=int,default=1)
+    parser.add_argument('--per-target-device',help='maximum number of running jobs using a device a job writes to (default 1)',type=int,default=1)
+    parser.add_argument('--poll',help='seconds between checking for due jobs (default 60)',type=int,default=60)
+    parser.add_argument('--once',help='run the jobs that are due and exit',action='store_true')
+    parser.add_argument('--debug',help='set all loggers to debug level',action='store_true')
+    parser.add_argument('--nonotifications',help='disable notifications on backup failure',action='store_true')
+    parser.add_argument('--dry-run',help='send --dry-run to rsync and do not actually transfer any files',action='store_true')
+
+    return parser
+
+
+class ScheduledJob(object):
+    """A job file known to the scheduler, with the devices it reads from and writes to."""
+    def __init__(self, job_file, devices):
+        super(ScheduledJob, self).__init__()
+        self.job_file = job_file
+
+        with open(job_file) as f:
+            params = json.loads(f.read())
+
+        try:
+            target = params['target']
+            sources = params['sources']
+        except KeyError as e:
+            raise utils.JobDescriptionKeyError(e.message)
+
+        self.source_devices = set(get_device(s['path'], devices) for s in sources)
+        self.target_device = get_device(target, devices)
+
+        notification_options = params.get('failure_notification', {})
+        self.hours_since_success = notification_options.get('hours_since_success') or None
+        self.interval_hours = params.get('interval_hours', self.hours_since_success or 24)
+        self.retry_hours = params.get('retry_hours', 1)
+
+        filename, fileext = os.path.splitext(job_file)
+        self.success_filename = filename + ".josync-job-success"
+        self.last_attempt = None
+
+    def last_success(self):
+        """Time of the last successful run, from the job's success marker file."""
+        if os.path.isfile(self.success_filename):
+            return utils.get_file_modification_date(self.success_filename)
+        return None
+
+    def is_due(self, now):
+        """True if the interval since the last successful run (and the last attempt) has passed."""
+        if self.last_attempt is not None and \
+            (now - self.last_attempt).total_seconds()/3600. < min(self.retry_hours, self.interval_hours):
+            return False
+        last_success = self.last_success()
+        if last_success is None:
+            return True
+        return (now - last_success).total_seconds()/3600. >= self.interval_hours
+
+    def overdue(self, now):
+        """How overdue the job is, as the fraction of ``hours_since_success`` (or the interval) that has passed."""
+        last_success = self.last_success()
+        if last_success is None:
+            return float('inf')
+        hours = (now - last_success).total_seconds()/3600.
+        return hours/(self.hours_since_success or self.interval_hours)
+
+
+def get_device(path, devices):
+    """Name the device of a path, used to limit concurrent jobs per device.
+
+    Drive letters are looked up in the ``devices`` setting, which may map several
+    drive letters (partitions) to the same physical disk. Mapped net drives and UNC
+    paths are identified by their share.
+
+    :param path: Path of a source or target.
+    :type path: str
+    :param devices: Dictionary from lower case drive letter (with colon) to device name.
+    :type devices: dict
+    :returns: str -- Device name.
+    """
+    drive, rest = ntpath.splitdrive(path)
+    drive = drive.lower()
+    if utils.is_net_drive(drive):
+        drive = utils.net_drives[drive].lower()
+    if drive.startswith('\\\\') or drive.startswith('//'):
+        return '\\\\'.join(drive.replace('/','\\').strip('\\').split('\\')[:2])
+    return devices.get(drive, drive)
+
+
+class Scheduler(object):
+    """Runs josync jobs from a directory on a pool of workers.
+
+    Jobs are started in order of how overdue they are, as long as no more than the
+    allowed number of jobs are using any of their source or target devices. Jobs reading
+    from a device and jobs writing to it count alike, so that a job does not start
+    reading from a disk that another job is writing to, or the other way round. Each job
+    runs as a separate ``josync.py`` process, keeping logging, reports and failure
+    notifications per job.
+    """
+    def __init__(self, job_dir, workers=4, per_source_device=1, per_target_device=1, josync_options=None):
+        super(Scheduler, self).__init__()
+        self.job_dir = job_dir
+        self.workers = workers
+        self.per_source_device = per_source_device
+        self.per_target_device = per_target_device
+        self.josync_options = josync_options if josync_options is not None else []
+
+        self.jobs = {}
+        self.running = {}
+        # running jobs reading from or writing to each device
+        self.device_usage = {}
+        # job files whose latest run failed
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def load_jobs(self):
+        """Read all job files in the job directory, keeping the state of known jobs."""
+        devices = dict((k.lower(), v) for k, v in utils.config.get('devices', {}).items())
+        job_files = glob.glob(os.path.join(self.job_dir, '*.josync-job'))
+        for job_file in job_files:
+            try:
+                job = ScheduledJob(job_file, devices)
+            except (IOError, ValueError, utils.JobDescriptionKeyError) as e:
+                logger.error("Could not read job file {}: {}".format(job_file, e))
+                continue
+            if job_file in self.jobs:
+                job.last_attempt = self.jobs[job_file].last_attempt
+            self.jobs[job_file] = job
+        for job_file in list(self.jobs.keys()):
+            if not job_file in job_files:
+                del self.jobs[job_file]
+        logger.debug("Scheduler knows {} job(s).".format(len(self.jobs)))
+
+    def can_start(self, job):
+        if len(self.running) >= self.workers or job.job_file in self.running:
+            return False
+        for device in job.source_devices:
+            if self.device_usage.get(device, 0) >= self.per_source_device:
+                return False
+        return self.device_usage.get(job.target_device, 0) < self.per_target_device
+
+    def acquire(self, job, delta):
+        for device in set(job.source_devices) | set([job.target_device]):
+            self.device_usage[device] = self.device_usage.get(device, 0) + delta
+
+    def start_due_jobs(self):
+        """Start due jobs, most overdue first, as far as workers and devices allow.
+
+        :returns: int -- Number of due jobs that are waiting to be started.
+        """
+        now = datetime.datetime.now()
+        with self.lock:
+            due = [j for j in self.jobs.values() if not j.job_file in self.running and j.is_due(now)]
+            due.sort(key=lambda j: j.overdue(now), reverse=True)
+            waiting = 0
+            for job in due:
+                if not self.can_start(job):
+                    waiting += 1
+                    continue
+                job.last_attempt = now
+                self.acquire(job, 1)
+                t = threading.Thread(target=self.run_job, args=(job,))
+                self.running[job.job_file] = t
+                t.start()
+        return waiting
+
+    def run_job(self, job):
+        """Run a job as a separate josync process and release its devices when done.
+
+        A failed job is retried after its ``retry_hours``, and is listed in ``self.failed``
+        until it succeeds.
+        """
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'josync.py')] + \
+                  self.josync_options + [job.job_file]
+        logger.info("Starting job {} (sources on {}, target on {}).".format(
+            job.job_file, ', '.join(sorted(job.source_devices)), job.target_device))
+        returncode = None
+        try:
+            returncode = sp.call(command, startupinfo=utils.config.get('subprocess_startupinfo'))
+        except OSError as e:
+            logger.error("Could not start job {}: {}".format(job.job_file, e))
+        finally:
+            if returncode == 0:
+                logger.info("Job {} finished successfully.".format(job.job_file))
+            elif returncode is not None:
+                logger.error("Job {} failed with exit code {}, retrying in {} hour(s).".format(
+                    job.job_file, returncode, min(job.retry_hours, job.interval_hours)))
+            with self.lock:
+                if returncode == 0:
+                    self.failed.discard(job.job_file)
+                else:
+                    self.failed.add(job.job_file)
+                self.acquire(job, -1)
+                del self.running[job.job_file]
+
+    def run(self, poll_seconds=60, once=False):
+        """Schedule jobs until interrupted, or until no due jobs remain if ``once`` is set."""
+        logger.info("Scheduler started for {} with {} worker(s).".format(self.job_dir, self.workers))
+        while True:
+            self.load_jobs()
+            waiting = self.start_due_jobs()
+            if once and not waiting and not self.running:
+                break
+            time.sleep(poll_seconds if not once else 1)
+        logger.info("Scheduler finished.")
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    josync.configure_logging('scheduler', args.debug)
+
+    logger.info("************************************************************")
+    logger.info("Scheduler session started. Josync version {}.".format(utils.version))
+
+    utils.initialize()
+
+    josync_options = []
+    for option in ['debug', 'nonotifications', 'dry_run']:
+        if getattr(args, option):
+            josync_options.append('--' + option.replace('_', '-'))
+
+    scheduler = Scheduler(args.jobdir, args.workers, args.per_source_device, args.per_target_device, josync_options)
+    try:
+        scheduler.run(args.poll, args.once)
+    except KeyboardInterrupt:
+        logger.info("Scheduler interrupted, waiting for running jobs to finish.")
+        for t in list(scheduler.running.values()):
+            t.join()
+
+    if scheduler.failed:
+        logger.error("The latest run of {} job(s) failed: {}".format(
+            len(scheduler.failed), ', '.join(sorted(scheduler.failed))))
+    logger.info("Session ended.")
+    logqueue.stop()
+    if scheduler.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import time
+import logging
+import tempfile
+import threading
+import contextlib
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# a source is split into at most this many subtrees per shard
+max_units_per_shard = 8
+
+
+def scan_tree(root, prefix='', exclude_filter=None):
+    """Count the files and bytes below every directory of a tree, skipping excluded paths.
+
+    Symbolic links count as files, and are not followed.
+
+    :param root: Directory to walk.
+    :type root: str
+    :param prefix: Path of ``root`` relative to the transfer root, for matching excludes.
+    :type prefix: str
+    :param exclude_filter: Excludes of the source.
+    :type exclude_filter: :class:`excludes.ExcludeFilter`
+    :returns: 2-tuple of dict of ``[files, bytes]`` below each directory and dict of lists of
+              its subdirectories, both by path relative to ``root`` with forward slashes (``''`` for ``root``).
+    """
+    root = unicode(root)
+    prefix = unicode(prefix).replace(u'\\', u'/').strip(u'/')
+    weights = {}
+    children = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative = os.path.relpath(dirpath, root).replace('\\', '/')
+        relative = '' if relative == '.' else relative
+        weight = [0, 0]
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            excluded = exclude_filter is not None and \
+                exclude_filter.match((prefix + '/' + relative + '/' + name).replace('//', '/').lstrip('/'), True) is not None
+            if excluded or os.path.islink(path):
+                dirnames.remove(name)
+                if not excluded:
+                    filenames.append(name)
+        for name in filenames:
+            if exclude_filter is not None and \
+                    exclude_filter.match((prefix + '/' + relative + '/' + name).replace('//', '/').lstrip('/'), False) is not None:
+                continue
+            try:
+                weight[1] += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                continue
+            weight[0] += 1
+        weights[relative] = weight
+        children[relative] = [(relative + '/' + name).lstrip('/') for name in dirnames]
+
+    # add up the subtrees, deepest directories first
+    for relative in sorted(weights, key=lambda r: r.count('/') if r else -1, reverse=True):
+        if relative:
+            parent = relative.rsplit('/', 1)[0] if '/' in relative else ''
+            weights[parent][0] += weights[relative][0]
+            weights[parent][1] += weights[relative][1]
+    return weights, children
+
+
+def split_tree(weights, children, shards, by='files'):
+    """Split a tree into subtrees of at most about ``1/shards`` of its weight.
+
+    The heaviest subtree is replaced by its subdirectories until no subtree is heavier than
+    its share, none of the heavy ones have subdirectories or there are enough subtrees.
+    Files directly in a split directory belong to no subtree.
+
+    :param weights: Files and bytes below each directory, as returned by :func:`scan_tree`.
+    :type weights: dict
+    :param children: Subdirectories of each directory, as returned by :func:`scan_tree`.
+    :type children: dict
+    :param shards: Number of shards.
+    :type shards: int
+    :param by: Balance by ``'files'`` or ``'bytes'``.
+    :type by: str
+    :returns: List of 2-tuples of subtree path and weight, empty if the root could not be split.
+    """
+    key = 1 if by == 'bytes' else 0
+    share = weights[''][key]/float(shards)
+    units = ['']
+    while len(units) < max_units_per_shard*shards:
+        splittable = [u for u in units if children[u] and weights[u][key] > share]
+        if not splittable:
+            break
+        largest = max(splittable, key=lambda u: weights[u][key])
+        units.remove(largest)
+        units += children[largest]
+    if '' in units:
+        return []
+    # empty subtrees are left to the boundary call
+    return [(u, weights[u][key]) for u in units if weights[u][key] > 0]
+
+
+def assign_units(units, shards):
+    """Distribute weighted subtrees to shards, heaviest first to the lightest shard.
+
+    :param units: List of 2-tuples of subtree path and weight.
+    :type units: list
+    :param shards: Number of shards.
+    :type shards: int
+    :returns: List of non-empty lists of subtree paths.
+    """
+    bins = [[0, []] for i in range(shards)]
+    for path, weight in sorted(units, key=lambda u: (-u[1], u[0])):
+        lightest = min(bins, key=lambda b: b[0])
+        lightest[0] += weight
+        lightest[1].append(path)
+    return [sorted(paths) for weight, paths in bins if paths]
+
+
+def anchored_dir_pattern(path):
+    """rsync pattern matching exactly one directory, given by its path relative to the transfer root."""
+    return u'/{}/'.format(re.sub(r'([\\*?\[])', r'\\\1', path.strip('/')))
+
+
+def implied_dirs(paths):
+    """Parent directories that rsync lists along with paths synced with ``--relative``.
+
+    :param paths: Paths relative to the transfer root.
+    :type paths: list
+    :returns: set -- Paths of the parent directories.
+    """
+    parents = set()
+    for path in paths:
+        parent = path.strip('/').rsplit('/', 1)[0] if '/' in path.strip('/') else ''
+        while parent and not parent in parents:
+            parents.add(parent)
+            parent = parent.rsplit('/', 1)[0] if '/' in parent else ''
+    return parents
+
+
+@contextlib.contextmanager
+def hiding_filter_file(paths):
+    """Write rsync filter rules skipping directories at the source and keeping them at the target.
+
+    Every directory gets a hide rule (``H``), so that the sending rsync leaves it out, and a
+    protect rule (``P``), so that neither ``--delete`` nor ``--delete-excluded`` removes
+    it at the target. Pass the file with ``--filter=merge FILE`` before any excludes.
+
+    :param paths: Paths of directories relative to the transfer root.
+    :type paths: list
+    :returns: Path of the file.
+    """
+    fd, path = tempfile.mkstemp(suffix='.josync-filter')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for directory in paths:
+                pattern = anchored_dir_pattern(directory)
+                f.write(u'H {}\nP {}\n'.format(pattern, pattern).encode('utf-8'))
+        yield path
+    finally:
+        os.remove(path)
+
+
+class ShardPlanner(object):
+    """Plans how the tree of a source is split into shards synced by concurrent rsync calls.
+
+    A source is scanned with :func:`scan_tree` and split into subtrees (see :func:`split_tree`),
+    which are then distributed to shards of about equal weight. The subtrees and their
+    weights are kept in a JSON file and reused by later runs for ``rescan_days``, so the
+    tree is only scanned now and then. Subtrees that no longer exist are dropped, and new
+    directories next to the subtrees are picked up by the boundary call (see
+    :meth:`jobs.BaseSyncJob.run_source_sharded`), so an old plan is less balanced but never wrong.
+
+    :param plan_file: Path to file keeping the plans of all sources of a job, or ``None`` to scan on every run.
+    :type plan_file: str
+    :param by: Balance by ``'files'`` or ``'bytes'``.
+    :type by: str
+    :param rescan_days: Days after which a source is scanned again.
+    :type rescan_days: float
+    """
+    def __init__(self, plan_file, by='files', rescan_days=7):
+        super(ShardPlanner, self).__init__()
+        self.plan_file = plan_file
+        self.by = by
+        self.rescan_days = rescan_days
+        self.lock = threading.Lock()
+
+    def read_plans(self):
+        if self.plan_file is None:
+            return {}
+        try:
+            with open(self.plan_file) as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def plan(self, source_name, root, prefix, exclude_filter, shards):
+        """Split a source into shards.
+
+        :param source_name: Name of the source (drive and path).
+        :type source_name: str
+        :param root: Directory of the source in the shadow copy.
+        :type root: str
+        :param prefix: Path of ``root`` relative to the transfer root.
+        :type prefix: str
+        :param exclude_filter: Excludes of the source.
+        :type exclude_filter: :class:`excludes.ExcludeFilter`
+        :param shards: Number of shards.
+        :type shards: int
+        :returns: List of shards, each a list of subtree paths relative to ``root``.
+                  Empty if the source cannot be split.
+        """
+        with self.lock:
+            plan = self.read_plans().get(source_name)
+        if plan is None or plan.get('by') != self.by or plan.get('shards') != shards or \
+                time.time() - plan.get('time', 0) > self.rescan_days*86400:
+            logger.info("Scanning {} to split it into {} shards.".format(source_name, shards))
+            weights, children = scan_tree(root, prefix, exclude_filter)
+            plan = {'time': time.time(), 'by': self.by, 'shards': shards,
+                    'units': split_tree(weights, children, shards, self.by)}
+            if self.plan_file is not None:
+                with self.lock:
+                    plans = self.read_plans()
+                    plans[source_name] = plan
+                    try:
+                        utils.write_file_atomic(self.plan_file, json.dumps(plans, sort_keys=True))
+                    except (IOError, OSError) as e:
+                        logger.warning("Could not save shard plan to {}: {}".format(self.plan_file, e))
+
+        units = [(path, weight) for path, weight in plan['units'] if os.path.isdir(os.path.join(root, path))]
+        return assign_units(units, shards)
@@ -0,0 +1,460 @@
+import os
+import re
+import json
+import time
+import shutil
+import logging
+import tempfile
+import contextlib
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+# snapshots shared by the jobs of a session: provider key and root by drive, see shared_snapshots()
+shared = {}
+
+# matches the start of each snapshot in vshadow output, e.g.
+# * SNAPSHOT ID = {1c9bdc4a-d0ab-4a4f-b2c0-4f7e2ef6c1a0} ...
+snapshot_id_pattern = re.compile(r"\* SNAPSHOT ID = (\{[0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12}\})")
+# matches the volume of a snapshot, e.g.
+#    - Original Volume name: \\?\Volume{b2f6ba8c-...}\ [D:\]
+snapshot_volume_pattern = re.compile(r"Original Volume name:.*\[([A-Za-z]):\\?\]")
+
+
+def parse_vshadow_snapshots(vshadow_output, drives):
+    """Find the snapshot GUID of each drive in the output of ``vshadow -p``.
+
+    :param vshadow_output: Output from vshadow.
+    :type vshadow_output: str
+    :param drives: Drives that were shadow copied, in the order given to vshadow.
+    :type drives: list
+    :returns: List of 2-tuples with drive and snapshot GUID.
+    :raises: OSError
+    """
+    matches = list(snapshot_id_pattern.finditer(vshadow_output))
+    if len(matches) != len(drives):
+        raise OSError("vshadow reported {} snapshot(s) for {} drive(s).".format(len(matches),len(drives)))
+
+    guids = {}
+    for i, match in enumerate(matches):
+        end = matches[i+1].start() if i+1 < len(matches) else len(vshadow_output)
+        volume_match = snapshot_volume_pattern.search(vshadow_output, match.end(), end)
+        if volume_match:
+            guids[volume_match.group(1).lower()] = match.group(1)
+
+    if sorted(guids.keys()) == sorted(d[0].lower() for d in drives):
+        return [(d, guids[d[0].lower()]) for d in drives]
+    # volumes were not listed, assume the snapshots are in the order of the drives
+    logger.debug("Could not match snapshots to volumes from vshadow output, assuming drive order.")
+    return [(d, match.group(1)) for d, match in zip(drives, matches)]
+
+
+def link_directory(target, path):
+    """Make ``path`` point to the directory ``target``: a junction on Windows, a symbolic link elsewhere."""
+    if hasattr(os, 'symlink'):
+        os.symlink(target, path)
+        return
+    returncode, output = utils.shell_execute(['cmd', '/c', 'mklink', '/J', path, target])
+    if returncode != 0:
+        raise OSError("Could not link {} to {}: {}".format(path, target, output))
+
+
+def remove_mount_point(path):
+    """Remove an empty mount point directory, or a link made by :func:`link_directory`."""
+    if os.path.islink(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        # also removes a junction, leaving its target alone
+        os.rmdir(path)
+
+
+def run_command(command, action):
+    returncode, output = utils.shell_execute(command)
+    if returncode != 0:
+        logger.error("{} failed with exit code {}.\n{}".format(' '.join(command), returncode, output))
+        raise OSError("Could not {}. Return code: {}".format(action, returncode))
+    return output
+
+
+class SnapshotProvider(object):
+    """Base class of the ways to get a consistent view of a volume while it is synced.
+
+    Providers are selected in the job file by a spec, either a provider name or a dict
+    with the name as ``provider`` and further options (see :func:`normalize_spec`).
+    Subclasses implement :meth:`create`, :meth:`mount` and :meth:`delete`.
+
+    :param options: Options of the spec, without ``provider``.
+    :type options: dict
+    """
+    name = None
+    # options a spec of the provider must have
+    required_options = ()
+
+    def __init__(self, options=None):
+        super(SnapshotProvider, self).__init__()
+        self.options = options or {}
+
+    def volume_path(self, drive):
+        """Directory of the live volume of a drive: option ``path``, or the drive itself."""
+        return self.options.get('path', drive + '/')
+
+    def create(self, drives):
+        """Snapshot drives.
+
+        :param drives: Drive letters with colon.
+        :type drives: list
+        :returns: List of snapshots, one per drive, passed to :meth:`mount` and :meth:`delete`.
+        :raises: OSError
+        """
+        raise NotImplementedError("Snapshot provider {} cannot create snapshots.".format(self.name))
+
+    def mount(self, drive, snapshot, path):
+        """Make the contents of a snapshot available at ``path``, which does not exist yet."""
+        raise NotImplementedError("Snapshot provider {} cannot mount snapshots.".format(self.name))
+
+    def unmount(self, drive, snapshot, path):
+        """Undo :meth:`mount`, if needed before the snapshot can be deleted."""
+        pass
+
+    def delete(self, drive, snapshot):
+        """Delete a snapshot.
+
+        :raises: OSError
+        """
+        raise NotImplementedError("Snapshot provider {} cannot delete snapshots.".format(self.name))
+
+    @contextlib.contextmanager
+    def snapshot_set(self, drives):
+        """snapshot_set(drives)
+        Snapshot drives and mount them in a temporary directory, one subdirectory per drive letter.
+
+        The time taken to create, mount, unmount and delete the snapshots is recorded in
+        phases ``snapshot_create``, ``snapshot_mount``, ``snapshot_unmount`` and
+        ``snapshot_delete`` with the name of the provider.
+
+        :param drives: Drives to snapshot.
+        :type drives: list
+        :yields: str -- Path to temp folder where the snapshots are mounted.
+        :raises: OSError
+        """
+        drives = list(drives)
+        logger.info("Creating {} snapshot(s) of volume(s) {}".format(self.name, ', '.join(drives)))
+        with utils.timed_phase('snapshot_create', provider=self.name, drives=drives) as record:
+            snapshots = self.create(drives)
+        create_duration = record['duration']
+
+        root = None
+        mounted = []
+        try:
+            root = tempfile.mkdtemp()
+            for drive, snapshot in zip(drives, snapshots):
+                path = os.path.join(root, drive[0])
+                with utils.timed_phase('snapshot_mount', provider=self.name, drive=drive):
+                    self.mount(drive, snapshot, path)
+                mounted.append((drive, snapshot, path))
+                logger.info("Snapshot {} of {} mounted at {}".format(snapshot, drive, path))
+
+            yield root
+
+        finally:
+            start = time.time()
+            failed = []
+            for drive, snapshot, path in mounted:
+                try:
+                    with utils.timed_phase('snapshot_unmount', provider=self.name, drive=drive):
+                        self.unmount(drive, snapshot, path)
+                except OSError as e:
+                    logger.error("Could not unmount snapshot {} of {}: {}".format(snapshot, drive, e))
+                    failed.append(snapshot)
+            for drive, snapshot in zip(drives, snapshots):
+                logger.info("Deleting snapshot {} of volume {}".format(snapshot, drive))
+                try:
+                    with utils.timed_phase('snapshot_delete', provider=self.name, drive=drive):
+                        self.delete(drive, snapshot)
+                except OSError as e:
+                    logger.error("Could not delete snapshot {} of {}: {}".format(snapshot, drive, e))
+                    failed.append(snapshot)
+            logger.info("{} snapshot(s) of {} took {:.1f} s to create and {:.1f} s to delete.".format(
+                        self.name, ', '.join(drives), create_duration, time.time() - start))
+            if failed:
+                raise OSError("Could not delete snapshot(s): {}".format(', '.join(str(s) for s in failed)))
+            if root:
+                for drive in drives:
+                    remove_mount_point(os.path.join(root, drive[0]))
+                os.rmdir(root)
+
+
+class VssProvider(SnapshotProvider):
+    """Volume shadow copies made with ``vshadow.exe`` (config ``vshadow_bin``).
+
+    All drives of a set are shadow copied by a single vshadow call, so the copies share one point in time.
+    """
+    name = 'vss'
+
+    def vshadow(self):
+        vshadow = utils.config.get('vshadow_bin', '')
+        if not os.path.isfile(vshadow):
+            raise OSError("vshadow.exe could not be found at {}.".format(vshadow))
+        return vshadow
+
+    def create(self, drives):
+        returncode, output = utils.shell_execute([self.vshadow(), '-p', '-nw'] + drives)
+        if not returncode == 0 or not snapshot_id_pattern.search(output):
+            raise OSError("vhadow did not produce a GUID. Return code: {} (hint: try running as administrator)".format(returncode))
+        return [guid for drive, guid in parse_vshadow_snapshots(output, drives)]
+
+    def mount(self, drive, snapshot, path):
+        os.mkdir(path)
+        run_command([self.vshadow(), '-el={},{}'.format(snapshot, path)], "mount shadow copy {}".format(snapshot))
+
+    def delete(self, drive, snapshot):
+        run_command([self.vshadow(), '-ds={}'.format(snapshot)], "delete shadow copy {}".format(snapshot))
+
+
+class LvmProvider(SnapshotProvider):
+    """LVM snapshots of a logical volume, mounted read-only.
+
+    Options: ``volume``, the logical volume (e.g. ``/dev/vg0/data``), ``path``, where it
+    is mounted, ``size`` of the snapshot (default ``1G``) and ``mount_options`` (default
+    ``ro``, add ``nouuid`` for XFS).
+    """
+    name = 'lvm'
+    required_options = ('volume', 'path')
+
+    def create(self, drives):
+        volume = self.options['volume']
+        snapshots = []
+        try:
+            for drive in drives:
+                name = 'josync-{}-{}'.format(drive[0], os.getpid())
+                run_command(['lvcreate', '--snapshot', '--size', self.options.get('size', '1G'), '--name', name, volume],
+                            "create LVM snapshot of {}".format(volume))
+                snapshots.append(os.path.join(os.path.dirname(volume), name))
+        except OSError:
+            for snapshot in snapshots:
+                self.delete(None, snapshot)
+            raise
+        return snapshots
+
+    def mount(self, drive, snapshot, path):
+        os.mkdir(path)
+        run_command(['mount', '-o', self.options.get('mount_options', 'ro'), snapshot, path],
+                    "mount LVM snapshot {}".format(snapshot))
+
+    def unmount(self, drive, snapshot, path):
+        run_command(['umount', path], "unmount LVM snapshot {}".format(snapshot))
+
+    def delete(self, drive, snapshot):
+        run_command(['lvremove', '-f', snapshot], "delete LVM snapshot {}".format(snapshot))
+
+
+class BtrfsProvider(SnapshotProvider):
+    """Read-only btrfs snapshots of a subvolume.
+
+    Options: ``path``, where the subvolume is mounted, and ``snapshot_dir``, a directory
+    on the same file system for the snapshots (default: next to the subvolume).
+    """
+    name = 'btrfs'
+    required_options = ('path',)
+
+    def create(self, drives):
+        subvolume = self.options['path'].rstrip('/')
+        snapshot_dir = self.options.get('snapshot_dir', os.path.dirname(subvolume))
+        snapshots = []
+        try:
+            for drive in drives:
+                snapshot = os.path.join(snapshot_dir, '{}.josync-snapshot-{}-{}'.format(
+                                        os.path.basename(subvolume), drive[0], os.getpid()))
+                run_command(['btrfs', 'subvolume', 'snapshot', '-r', subvolume, snapshot],
+                            "create btrfs snapshot of {}".format(subvolume))
+                snapshots.append(snapshot)
+        except OSError:
+            for snapshot in snapshots:
+                self.delete(None, snapshot)
+            raise
+        return snapshots
+
+    def mount(self, drive, snapshot, path):
+        link_directory(snapshot, path)
+
+    def delete(self, drive, snapshot):
+        run_command(['btrfs', 'subvolume', 'delete', snapshot], "delete btrfs snapshot {}".format(snapshot))
+
+
+class NoneProvider(SnapshotProvider):
+    """No snapshot: the live volume is linked into place and synced as it is.
+
+    Costs nothing, but files changing during the sync may be copied in an inconsistent
+    state, so it is meant for static data. Option: ``path``, the directory to sync
+    instead of the drive (e.g. a Linux mount point).
+    """
+    name = 'none'
+
+    def create(self, drives):
+        return [self.volume_path(drive) for drive in drives]
+
+    def mount(self, drive, snapshot, path):
+        link_directory(os.path.abspath(snapshot), path)
+
+    def delete(self, drive, snapshot):
+        pass
+
+
+class FakeProvider(SnapshotProvider):
+    """Snapshots copying the whole volume to a temporary directory, for tests.
+
+    A slow but real point-in-time copy, so that tests can change the volume while it is
+    synced. Options: ``path``, the directory standing in for the drive, and ``delay``,
+    seconds added to creating and deleting each snapshot to simulate latency.
+    """
+    name = 'fake'
+
+    def create(self, drives):
+        snapshots = []
+        for drive in drives:
+            snapshot = os.path.join(tempfile.mkdtemp(prefix='josync-fake-snapshot-'), drive[0])
+            shutil.copytree(self.volume_path(drive), snapshot, symlinks=True)
+            snapshots.append(snapshot)
+            time.sleep(self.options.get('delay', 0))
+        return snapshots
+
+    def mount(self, drive, snapshot, path):
+        link_directory(snapshot, path)
+
+    def delete(self, drive, snapshot):
+        shutil.rmtree(os.path.dirname(snapshot))
+        time.sleep(self.options.get('delay', 0))
+
+
+providers = {
+    'vss': VssProvider,
+    'lvm': LvmProvider,
+    'btrfs': BtrfsProvider,
+    'none': NoneProvider,
+    'fake': FakeProvider
+}
+
+
+def normalize_spec(spec=None):
+    """Check a provider spec and return it as a dict.
+
+    :param spec: Provider name, dict with the name as ``provider`` and options of the provider,
+                 or ``None`` for the config option ``snapshot_provider`` (default ``vss``).
+    :returns: dict -- The spec.
+    :raises: ValueError
+    """
+    if spec is None:
+        spec = utils.config.get('snapshot_provider', 'vss')
+    if isinstance(spec, basestring):
+        spec = {'provider': spec}
+    if not isinstance(spec, dict) or not spec.get('provider') in providers:
+        raise ValueError("Unknown snapshot provider {}, use one of {}.".format(spec, ', '.join(sorted(providers))))
+    missing = [o for o in providers[spec['provider']].required_options if not o in spec]
+    if missing:
+        raise ValueError("Snapshot provider {} needs the option(s) {}.".format(spec['provider'], ', '.join(missing)))
+    return dict(spec)
+
+
+def source_spec(drive_specs, source, drive):
+    """Spec of the provider to snapshot a source with.
+
+    :param drive_specs: Job parameter ``snapshots``, specs by drive.
+    :type drive_specs: dict
+    :param source: Source from the job file.
+    :type source: dict
+    :param drive: Drive of the source.
+    :type drive: str
+    :returns: dict -- The source's ``snapshot``, else the spec of its drive, else the default.
+    :raises: ValueError
+    """
+    if 'snapshot' in source:
+        return normalize_spec(source['snapshot'])
+    for key, spec in drive_specs.items():
+        if key.rstrip('/\\').lower() == drive.lower():
+            return normalize_spec(spec)
+    return normalize_spec()
+
+
+def spec_key(spec):
+    """String identifying a spec, to group drives snapshot the same way."""
+    return json.dumps(normalize_spec(spec), sort_keys=True)
+
+
+def get_provider(spec=None):
+    """Create the provider of a spec, see :func:`normalize_spec`."""
+    options = normalize_spec(spec)
+    return providers[options.pop('provider')](options)
+
+
+def live_path(spec, drive, path):
+    """Path of a source on its live volume, e.g. to check that it exists."""
+    return get_provider(spec).volume_path(drive).rstrip('/\\') + path
+
+
+@contextlib.contextmanager
+def snapshot_set(drives, spec=None):
+    """snapshot_set(drives, spec=None)
+    Snapshot drives with one provider and mount them in a temporary directory.
+
+    Each drive is mounted at a subdirectory named by its drive letter. If all drives
+    are part of the same set of :func:`shared_snapshots`, that set is used instead.
+
+    :param drives: Drives to snapshot.
+    :type drives: list
+    :param spec: Provider spec, see :func:`normalize_spec`.
+    :yields: str -- Path to temp folder where the snapshots are mounted.
+    :raises: OSError
+    """
+    drives = list(drives)
+    key = spec_key(spec)
+    entries = [shared.get(d.lower()) for d in drives]
+    if entries and all(e is not None and e[0] == key and e[1] == entries[0][1] for e in entries):
+        logger.info("Using shared snapshots of volume(s) {} at {}".format(', '.join(drives), entries[0][1]))
+        yield entries[0][1]
+        return
+
+    with get_provider(spec).snapshot_set(drives) as root:
+        yield root
+
+
+@contextlib.contextmanager
+def snapshot_sets(groups):
+    """snapshot_sets(groups)
+    Snapshot several groups of drives, each with its own provider.
+
+    :param groups: List of 2-tuples of provider spec and list of drives.
+    :type groups: list
+    :yields: list -- Path where the snapshots of each group are mounted.
+    """
+    if not groups:
+        yield []
+        return
+    spec, drives = groups[0]
+    with snapshot_set(drives, spec) as root:
+        with snapshot_sets(groups[1:]) as roots:
+            yield [root] + roots
+
+
+@contextlib.contextmanager
+def shared_snapshots(groups):
+    """shared_snapshots(groups)
+    Snapshot drives to be shared by all jobs run in the context.
+
+    While the context is active, :func:`snapshot_set` returns the shared snapshots
+    for these drives instead of creating new ones, so the jobs read each drive at the
+    same point in time and the snapshots are only created and deleted once.
+
+    :param groups: List of 2-tuples of provider spec and list of drives.
+    :type groups: list
+    :yields: list -- Path where the snapshots of each group are mounted.
+    :raises: OSError
+    """
+    with snapshot_sets(groups) as roots:
+        for (spec, drives), root in zip(groups, roots):
+            for drive in drives:
+                shared[drive.lower()] = (spec_key(spec), root)
+        try:
+            yield roots
+        finally:
+            shared.clear()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import excludes
+
+
+class TestPatternToRegex(unittest.TestCase):
+    def matches(self, pattern, path):
+        return excludes.pattern_to_regex(pattern).search(path) is not None
+
+    def test_unanchored_pattern_matches_last_component(self):
+        self.assertTrue(self.matches('*.tmp', 'a.tmp'))
+        self.assertTrue(self.matches('*.tmp', 'docs/deep/a.tmp'))
+        self.assertFalse(self.matches('*.tmp', 'a.tmp/file'))
+        self.assertFalse(self.matches('cache', 'mycache'))
+
+    def test_unanchored_pattern_with_slash_matches_end_of_path(self):
+        self.assertTrue(self.matches('build/out', 'build/out'))
+        self.assertTrue(self.matches('build/out', 'project/build/out'))
+        self.assertFalse(self.matches('build/out', 'rebuild/out'))
+
+    def test_anchored_pattern_matches_from_root(self):
+        self.assertTrue(self.matches('/cache', 'cache'))
+        self.assertFalse(self.matches('/cache', 'home/cache'))
+        self.assertTrue(self.matches('/home/*/cache', 'home/user/cache'))
+        self.assertFalse(self.matches('/home/*/cache', 'home/a/b/cache'))
+
+    def test_single_star_stops_at_slash(self):
+        self.assertTrue(self.matches('/a/*.log', 'a/x.log'))
+        self.assertFalse(self.matches('/a/*.log', 'a/b/x.log'))
+
+    def test_double_star_crosses_slashes(self):
+        self.assertTrue(self.matches('/a/**.log', 'a/x.log'))
+        self.assertTrue(self.matches('/a/**.log', 'a/b/c/x.log'))
+        self.assertTrue(self.matches('src/**/tmp', 'project/src/a/b/tmp'))
+        self.assertFalse(self.matches('/a/**.log', 'b/a/x.log'))
+
+    def test_question_mark_and_character_class(self):
+        self.assertTrue(self.matches('file?.txt', 'file1.txt'))
+        self.assertFalse(self.matches('file?.txt', 'file/.txt'))
+        self.assertTrue(self.matches('[ab]*.txt', 'b1.txt'))
+        self.assertFalse(self.matches('[!ab]*.txt', 'b1.txt'))
+        self.assertTrue(self.matches('[!ab]*.txt', 'c1.txt'))
+
+    def test_escaped_and_special_characters(self):
+        self.assertTrue(self.matches('a\\*b', 'a*b'))
+        self.assertFalse(self.matches('a\\*b', 'axb'))
+        self.assertTrue(self.matches('notes (1).txt', 'notes (1).txt'))
+        self.assertTrue(self.matches('[x', '[x'))
+
+    def test_directory_contents(self):
+        self.assertTrue(self.matches('/cache/***', 'cache'))
+        self.assertTrue(self.matches('/cache/***', 'cache/a/b'))
+        self.assertFalse(self.matches('/cache/***', 'cached'))
+
+
+class TestExcludeFilter(unittest.TestCase):
+    def test_directory_only_pattern(self):
+        exclude_filter = excludes.ExcludeFilter(['tmp/'])
+        self.assertEqual(exclude_filter.match('a/tmp', True), 'tmp/')
+        self.assertEqual(exclude_filter.match('a/tmp', False), None)
+
+    def test_first_matching_pattern_is_reported(self):
+        exclude_filter = excludes.ExcludeFilter(['*.log', 'debug.*', '*.log'])
+        self.assertEqual(len(exclude_filter), 2)
+        self.assertEqual(exclude_filter.match('debug.log'), '*.log')
+        self.assertEqual(exclude_filter.match('debug.txt'), 'debug.*')
+        self.assertEqual(exclude_filter.match('readme.txt'), None)
+
+    def test_excluded_parent_directory(self):
+        exclude_filter = excludes.ExcludeFilter(['/build/', 'node_modules'])
+        self.assertTrue(exclude_filter.is_excluded('build/out/a.o'))
+        self.assertFalse(exclude_filter.is_excluded('src/build/a.o'))
+        self.assertTrue(exclude_filter.is_excluded('web/node_modules/x/index.js'))
+        self.assertFalse(exclude_filter.is_excluded('src/main.c'))
+
+    def test_filter_file(self):
+        exclude_filter = excludes.ExcludeFilter(['+plus', '#hash', u'caf\xe9/'])
+        with exclude_filter.filter_file() as path:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read().decode('utf-8'), u'- +plus\n- #hash\n- caf\xe9/\n')
+        self.assertFalse(os.path.exists(path))
+
+    def test_no_filter_file_without_patterns(self):
+        with excludes.ExcludeFilter([]).filter_file() as path:
+            self.assertEqual(path, None)
+
+
+class TestPruned(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='josync-test-')
+        for path in ['src/main.c', 'src/main.o', 'build/out/a.o', 'docs/tmp/x.txt', 'docs/tmp.txt']:
+            path = os.path.join(self.workdir, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_pruned_and_included(self):
+        exclude_filter = excludes.ExcludeFilter(['*.o', '/d/proj/build', 'tmp/'])
+        self.assertEqual(sorted(exclude_filter.pruned(self.workdir, 'd/proj')),
+                         [('d/proj/build', '/d/proj/build'), ('d/proj/docs/tmp', 'tmp/'), ('d/proj/src/main.o', '*.o')])
+        self.assertEqual(sorted(relative for relative, path in exclude_filter.included_files(self.workdir, 'd/proj')),
+                         ['docs/tmp.txt', 'src/main.c'])
+
+
+class TestSplitPatterns(unittest.TestCase):
+    def test_split_patterns(self):
+        self.assertEqual(excludes.split_patterns(['*.pyc; *.pyo', '', ' *.pyc ', 'a;;b']),
+                         ['*.pyc', '*.pyo', 'a', 'b'])
+
+    def test_global_excludes_first(self):
+        self.assertEqual(excludes.compile_excludes(['*.tmp'], ['cache', '*.tmp']), ['*.tmp', 'cache'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import utils
+
+
+class ParserTestCase(unittest.TestCase):
+    """Feeds lines to :class:`utils.RsyncOutputParser` and collects its events."""
+    sized = True
+
+    def setUp(self):
+        self.parser = utils.RsyncOutputParser(sized=self.sized)
+        self.events = []
+        self.parser.subscribe(self.events.append)
+
+    def feed(self, *lines):
+        for line in lines:
+            self.parser.feed(line)
+        return self.events
+
+
+class TestItemizedChanges(ParserTestCase):
+    def test_sized_file(self):
+        self.assertEqual(self.feed(">f+++++++++ 1024 docs/file.txt"),
+                         [utils.ItemizedChange('docs/file.txt', '>f+++++++++', 1024.)])
+
+    def test_spaces_in_path(self):
+        self.assertEqual(self.feed(">f.st...... 2048 my docs/a  file .txt"),
+                         [utils.ItemizedChange('my docs/a  file .txt', '>f.st......', 2048.)])
+
+    def test_path_starting_with_a_number(self):
+        self.assertEqual(self.feed(">f+++++++++ 5 12 apples.txt"),
+                         [utils.ItemizedChange('12 apples.txt', '>f+++++++++', 5.)])
+
+    def test_symlink_target_is_dropped(self):
+        self.assertEqual(self.feed("cL+++++++++ 14 my links/current -> ../releases/v 2"),
+                         [utils.ItemizedChange('my links/current', 'cL+++++++++', 14.)])
+
+    def test_arrow_in_file_name_is_kept(self):
+        self.assertEqual(self.feed(">f+++++++++ 10 notes -> later.txt"),
+                         [utils.ItemizedChange('notes -> later.txt', '>f+++++++++', 10.)])
+
+    def test_directory(self):
+        self.assertEqual(self.feed("cd+++++++++ 4096 new dir/"),
+                         [utils.ItemizedChange('new dir/', 'cd+++++++++', 4096.)])
+
+    def test_deletion(self):
+        self.assertEqual(self.feed("*deleting   old stuff/file.txt"),
+                         [utils.ItemizedChange('old stuff/file.txt', '*deleting', None)])
+
+    def test_no_change_is_not_itemized(self):
+        event, = self.feed("sending incremental file list")
+        self.assertEqual(event, utils.OutputLine("sending incremental file list"))
+
+
+class TestUnsizedItemizedChanges(ParserTestCase):
+    sized = False
+
+    def test_number_belongs_to_path(self):
+        self.assertEqual(self.feed(">f+++++++++ 2024 report.pdf"),
+                         [utils.ItemizedChange('2024 report.pdf', '>f+++++++++', None)])
+
+    def test_symlink_target_is_dropped(self):
+        self.assertEqual(self.feed("cL+++++++++ my link -> some target"),
+                         [utils.ItemizedChange('my link', 'cL+++++++++', None)])
+
+
+class TestProgressAndStats(ParserTestCase):
+    def test_progress_lines_split_by_carriage_return(self):
+        events = self.feed("      32,768  50%  1.00MB/s    0:00:01\r      65,536 100%  2.00MB/s    0:00:00 (xfr#1, to-chk=0/3)")
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0].bytes, 32768)
+        self.assertEqual(events[0].files_transferred, None)
+        self.assertEqual(events[1], utils.ProgressUpdate(65536, 100, 2.*1024**2, 0, 1, 0, 3))
+
+    def test_stats_are_kept(self):
+        self.feed("Number of files: 1,234 (reg: 1,000, dir: 234)",
+                  "Number of regular files transferred: 12",
+                  "Total file size: 5,678,901 bytes",
+                  "Total transferred file size: 1.234 bytes")
+        self.assertEqual(self.parser.stats, {'num_files': 1234, 'files_transferred': 12,
+                                             'tot_file_size': 5678901, 'file_size_transferred': 1234})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import excludes
+import shards
+
+
+class TreeTestCase(unittest.TestCase):
+    """Builds a small tree in a temporary directory: file paths with their sizes."""
+    files = {
+        'top.txt': 1,
+        'a/1.txt': 10,
+        'a/2.txt': 10,
+        'a/x/3.txt': 10,
+        'a/x/4.txt': 10,
+        'a/y/5.txt': 10,
+        'b/6.txt': 100,
+        'b/7.tmp': 1000,
+        'c/cache/8.txt': 10,
+    }
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='josync-test-')
+        self.root = os.path.join(self.workdir, 'src')
+        for path, size in self.files.items():
+            path = os.path.join(self.root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write('x'*size)
+        os.mkdir(os.path.join(self.root, 'empty'))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+
+class TestScanTree(TreeTestCase):
+    def test_weights_add_up(self):
+        weights, children = shards.scan_tree(self.root)
+        self.assertEqual(weights[''], [9, 1161])
+        self.assertEqual(weights['a'], [5, 50])
+        self.assertEqual(weights['a/x'], [2, 20])
+        self.assertEqual(weights['empty'], [0, 0])
+        self.assertEqual(sorted(children['']), ['a', 'b', 'c', 'empty'])
+        self.assertEqual(sorted(children['a']), ['a/x', 'a/y'])
+
+    def test_excludes_are_skipped(self):
+        exclude_filter = excludes.ExcludeFilter(['*.tmp', '/d/src/c/cache/'])
+        weights, children = shards.scan_tree(self.root, 'd/src', exclude_filter)
+        self.assertEqual(weights[''], [7, 151])
+        self.assertEqual(weights['b'], [1, 100])
+        self.assertEqual(children['c'], [])
+        self.assertFalse('c/cache' in weights)
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'needs symbolic links')
+    def test_symlinks_count_as_files(self):
+        os.symlink(os.path.join(self.root, 'a'), os.path.join(self.root, 'b', 'link'))
+        weights, children = shards.scan_tree(self.root)
+        self.assertEqual(weights['b'][0], 3)
+        self.assertEqual(children['b'], [])
+
+
+class TestSplitTree(TreeTestCase):
+    def test_split_by_files(self):
+        weights, children = shards.scan_tree(self.root)
+        units = shards.split_tree(weights, children, 2)
+        # a is split further, files directly in it and in the root are left to the boundary call
+        self.assertEqual(sorted(units), [('a/x', 2), ('a/y', 1), ('b', 2), ('c', 1)])
+
+    def test_split_by_bytes(self):
+        weights, children = shards.scan_tree(self.root)
+        units = shards.split_tree(weights, children, 2, by='bytes')
+        self.assertEqual(sorted(units), [('a', 50), ('b', 1100), ('c', 10)])
+
+    def test_unsplittable_root(self):
+        weights = {'': [3, 30]}
+        self.assertEqual(shards.split_tree(weights, {'': []}, 4), [])
+
+
+class TestAssignUnits(unittest.TestCase):
+    def test_heaviest_first_to_lightest_shard(self):
+        units = [('a', 5), ('b', 4), ('c', 3), ('d', 3), ('e', 1)]
+        self.assertEqual(shards.assign_units(units, 2), [['a', 'd'], ['b', 'c', 'e']])
+
+    def test_no_empty_shards(self):
+        self.assertEqual(shards.assign_units([('a', 1)], 3), [['a']])
+
+
+class TestImpliedDirs(unittest.TestCase):
+    def test_parents_once(self):
+        self.assertEqual(shards.implied_dirs(['a/b/c', 'a/b/d', '/a/e/', 'f']),
+                         set(['a', 'a/b']))
+
+    def test_no_parents(self):
+        self.assertEqual(shards.implied_dirs(['a', 'b/']), set())
+
+
+class TestFilterFile(unittest.TestCase):
+    def test_anchored_dir_pattern_escapes_wildcards(self):
+        self.assertEqual(shards.anchored_dir_pattern('/a/b/'), '/a/b/')
+        self.assertEqual(shards.anchored_dir_pattern('a/[x]*?'), '/a/\\[x]\\*\\?/')
+
+    def test_hide_and_protect(self):
+        with shards.hiding_filter_file(['d/src/a', u'd/src/caf\xe9']) as path:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read().decode('utf-8'),
+                                 u'H /d/src/a/\nP /d/src/a/\nH /d/src/caf\xe9/\nP /d/src/caf\xe9/\n')
+        self.assertFalse(os.path.exists(path))
+
+
+class TestShardPlanner(TreeTestCase):
+    def test_plan_is_reused(self):
+        plan_file = os.path.join(self.workdir, 'job.josync-job-shards')
+        planner = shards.ShardPlanner(plan_file)
+        first = planner.plan('d:/src', self.root, 'd/src', None, 2)
+        self.assertEqual(sorted(sum(first, [])), ['a/x', 'a/y', 'b', 'c'])
+        with open(plan_file) as f:
+            self.assertEqual(json.loads(f.read())['d:/src']['shards'], 2)
+
+        # the saved plan is used without scanning, and subtrees gone from the source are dropped
+        shutil.rmtree(os.path.join(self.root, 'c'))
+        os.mkdir(os.path.join(self.root, 'new'))
+        second = planner.plan('d:/src', self.root, 'd/src', None, 2)
+        self.assertEqual(sorted(sum(second, [])), ['a/x', 'a/y', 'b'])
+
+    def test_rescan_with_other_shard_count(self):
+        plan_file = os.path.join(self.workdir, 'job.josync-job-shards')
+        planner = shards.ShardPlanner(plan_file)
+        planner.plan('d:/src', self.root, 'd/src', None, 2)
+        self.assertEqual(len(planner.plan('d:/src', self.root, 'd/src', None, 3)), 3)
+        with open(plan_file) as f:
+            self.assertEqual(json.loads(f.read())['d:/src']['shards'], 3)
+
+    def test_single_shard_is_not_split(self):
+        self.assertEqual(shards.ShardPlanner(None).plan('d:/src', self.root, 'd/src', None, 1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
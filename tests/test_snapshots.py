@@ -0,0 +1,172 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import utils
+import josync
+import snapshots
+
+tools_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools')
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """Runs providers against a fake drive D: in a temporary directory, with the stand-in vshadow."""
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='josync-test-')
+        self.drive = os.path.join(self.workdir, 'drives', 'd')
+        os.makedirs(os.path.join(self.drive, 'src'))
+        with open(os.path.join(self.drive, 'src', 'file.txt'), 'w') as f:
+            f.write('contents')
+
+        # snapshots are mounted below the temporary directory, so that leftovers can be found
+        self.mount_dir = os.path.join(self.workdir, 'tmp')
+        os.mkdir(self.mount_dir)
+        self.tempdir = tempfile.tempdir
+        tempfile.tempdir = self.mount_dir
+
+        self.environ = dict(os.environ)
+        os.environ['FAKE_VSHADOW_ROOT'] = os.path.join(self.workdir, 'drives')
+        os.environ['FAKE_VSHADOW_STATE'] = os.path.join(self.workdir, 'vshadow_state.json')
+        self.config = dict(utils.config)
+        utils.config['vshadow_bin'] = os.path.join(tools_dir, 'fake_vshadow.py')
+        utils.config['subprocess_startupinfo'] = None
+        del utils.phase_timings[:]
+
+    def tearDown(self):
+        tempfile.tempdir = self.tempdir
+        os.environ.clear()
+        os.environ.update(self.environ)
+        utils.config.clear()
+        utils.config.update(self.config)
+        snapshots.shared.clear()
+        del utils.phase_timings[:]
+        shutil.rmtree(self.workdir)
+
+    def phases(self, phase):
+        return [p for p in utils.phase_timings if p['phase'] == phase]
+
+    def leftovers(self):
+        return os.listdir(self.mount_dir)
+
+
+class TestLatency(SnapshotTestCase):
+    def test_fake_provider_records_every_step(self):
+        spec = {'provider': 'fake', 'path': self.drive, 'delay': 0.05}
+        with snapshots.snapshot_set(['d:'], spec) as root:
+            with open(os.path.join(root, 'd', 'src', 'file.txt')) as f:
+                self.assertEqual(f.read(), 'contents')
+            # the snapshot is a copy, so changes of the drive do not show
+            os.remove(os.path.join(self.drive, 'src', 'file.txt'))
+            self.assertTrue(os.path.isfile(os.path.join(root, 'd', 'src', 'file.txt')))
+
+        for phase in ('snapshot_create', 'snapshot_mount', 'snapshot_unmount', 'snapshot_delete'):
+            records = self.phases(phase)
+            self.assertEqual(len(records), 1, phase)
+            self.assertEqual(records[0]['provider'], 'fake')
+        self.assertGreaterEqual(self.phases('snapshot_create')[0]['duration'], 0.05)
+        self.assertGreaterEqual(self.phases('snapshot_delete')[0]['duration'], 0.05)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_latency_by_provider(self):
+        with snapshots.snapshot_set(['d:'], 'vss'):
+            pass
+        with snapshots.snapshot_set(['d:'], {'provider': 'none', 'path': self.drive}):
+            pass
+        with snapshots.snapshot_set(['d:'], {'provider': 'none', 'path': self.drive}):
+            pass
+
+        latency = josync.snapshot_latency(utils.phase_timings)
+        self.assertEqual(sorted(latency), ['none', 'vss'])
+        self.assertEqual(latency['vss']['count'], 1)
+        self.assertEqual(latency['none']['count'], 2)
+        for step in ('create', 'mount', 'unmount', 'delete'):
+            self.assertEqual(latency['vss'][step], sum(p['duration'] for p in self.phases('snapshot_' + step)
+                                                       if p['provider'] == 'vss'))
+        self.assertEqual(self.leftovers(), [])
+
+    def test_shared_snapshot_is_not_recreated(self):
+        with snapshots.shared_snapshots([('vss', ['d:'])]):
+            with snapshots.snapshot_set(['d:'], 'vss') as root:
+                self.assertTrue(os.path.isfile(os.path.join(root, 'd', 'src', 'file.txt')))
+        self.assertEqual(len(self.phases('snapshot_create')), 1)
+        self.assertEqual(len(self.phases('snapshot_delete')), 1)
+
+
+class TestSpecs(SnapshotTestCase):
+    def test_normalize_spec(self):
+        self.assertEqual(snapshots.normalize_spec('none'), {'provider': 'none'})
+        self.assertEqual(snapshots.normalize_spec({'provider': 'fake', 'delay': 1}), {'provider': 'fake', 'delay': 1})
+        utils.config.pop('snapshot_provider', None)
+        self.assertEqual(snapshots.normalize_spec(), {'provider': 'vss'})
+        utils.config['snapshot_provider'] = 'none'
+        self.assertEqual(snapshots.normalize_spec(), {'provider': 'none'})
+
+    def test_invalid_specs(self):
+        self.assertRaises(ValueError, snapshots.normalize_spec, 'zfs')
+        self.assertRaises(ValueError, snapshots.normalize_spec, {'path': '/srv'})
+        self.assertRaises(ValueError, snapshots.normalize_spec, 42)
+        # lvm needs the volume and where it is mounted, btrfs the subvolume
+        self.assertRaises(ValueError, snapshots.normalize_spec, {'provider': 'lvm', 'volume': '/dev/vg0/data'})
+        self.assertRaises(ValueError, snapshots.normalize_spec, 'btrfs')
+
+    def test_source_spec_by_drive_and_source(self):
+        utils.config['snapshot_provider'] = 'vss'
+        drive_specs = {'E:/': {'provider': 'none', 'path': '/srv/e'}, 'f:': 'fake'}
+        self.assertEqual(snapshots.source_spec(drive_specs, {'path': 'd:/src'}, 'd:'), {'provider': 'vss'})
+        self.assertEqual(snapshots.source_spec(drive_specs, {'path': 'e:/src'}, 'e:'), {'provider': 'none', 'path': '/srv/e'})
+        self.assertEqual(snapshots.source_spec(drive_specs, {'path': 'f:/src'}, 'f:'), {'provider': 'fake'})
+        # the spec of a source wins over the spec of its drive
+        self.assertEqual(snapshots.source_spec(drive_specs, {'path': 'e:/src', 'snapshot': 'vss'}, 'e:'), {'provider': 'vss'})
+        self.assertRaises(ValueError, snapshots.source_spec, drive_specs, {'path': 'e:/src', 'snapshot': 'zfs'}, 'e:')
+
+    def test_live_path(self):
+        self.assertEqual(snapshots.live_path({'provider': 'none', 'path': self.drive + '/'}, 'd:', '/src'),
+                         os.path.join(self.drive, 'src'))
+        self.assertEqual(snapshots.live_path('vss', 'd:', '/src'), 'd:/src')
+
+
+class TestVssFailures(SnapshotTestCase):
+    def fail(self, operations):
+        os.environ['FAKE_VSHADOW_FAIL'] = operations
+
+    def test_create_fails(self):
+        self.fail('create')
+        with self.assertRaises(OSError):
+            with snapshots.snapshot_set(['d:'], 'vss'):
+                self.fail_body()
+        self.assertEqual(self.phases('snapshot_mount'), [])
+        self.assertEqual(self.leftovers(), [])
+
+    def test_mount_fails(self):
+        self.fail('mount')
+        with self.assertRaises(OSError):
+            with snapshots.snapshot_set(['d:'], 'vss'):
+                self.fail_body()
+        # the snapshot is deleted and the mount point removed
+        self.assertEqual(len(self.phases('snapshot_delete')), 1)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_delete_fails(self):
+        self.fail('delete')
+        synced = []
+        with self.assertRaises(OSError):
+            with snapshots.snapshot_set(['d:'], 'vss') as root:
+                synced.append(os.path.isfile(os.path.join(root, 'd', 'src', 'file.txt')))
+        self.assertEqual(synced, [True])
+        self.assertEqual(len(self.phases('snapshot_delete')), 1)
+
+    def test_body_error_deletes_snapshot(self):
+        with self.assertRaises(RuntimeError):
+            with snapshots.snapshot_set(['d:'], 'vss'):
+                raise RuntimeError('sync failed')
+        self.assertEqual(len(self.phases('snapshot_delete')), 1)
+        self.assertEqual(self.leftovers(), [])
+
+    def fail_body(self):
+        raise AssertionError('The snapshot should not be usable.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+"""Benchmark of Josync's own overhead, using synthetic source trees and stand-in binaries.
+
+Generates a source tree, writes a job file and a config pointing to the fake
+``vshadow``/``cygpath`` in this directory and to either the fake rsync or a real
+rsync, and runs ``jobs.create_job_from_file(...).run()`` several times with churn in
+the source tree between runs. Reports wall-clock time, the wall-clock time rsync was
+running and the number of processes started per run, the peak memory of the benchmark
+process up to each run (a high-water mark, not the memory of the run alone), plus timings
+of the hot paths ``utils.get_cygwin_path``, ``utils.RsyncOutputParser`` and
+``snapshots.snapshot_set`` (with the ``vss`` provider).
+
+The job snapshots the fake drive D: with the ``vss`` provider and the fake drive's
+directory as ``path``. Give ``path`` as well when setting ``snapshots`` with ``--job-options``.
+
+Results can be saved with ``--save`` and compared to saved results with ``--compare``,
+exiting with status 1 if any timing got slower by more than ``--tolerance``.
+
+Example::
+
+    python tools/benchmark.py --files 20000 --runs 3 --churn 0.01 --save baseline.json
+    python tools/benchmark.py --files 20000 --runs 3 --churn 0.01 --compare baseline.json
+"""
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import logging
+import subprocess as sp
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(tools_dir))
+
+import utils
+import jobs
+import snapshots
+
+logger = logging.getLogger('benchmark')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark Josync with synthetic source trees.')
+    parser.add_argument('--files',help='number of files in the source tree (default 10000)',type=int,default=10000)
+    parser.add_argument('--fanout',help='maximum number of files and subdirectories per directory (default 20)',type=int,default=20)
+    parser.add_argument('--size-median',help='median file size in bytes (default 4096)',type=float,default=4096)
+    parser.add_argument('--size-sigma',help='spread of the log-normal file size distribution (default 1.5)',type=float,default=1.5)
+    parser.add_argument('--churn',help='fraction of files changed, added or deleted between runs (default 0.01)',type=float,default=0.01)
+    parser.add_argument('--runs',help='number of job runs (default 3)',type=int,default=3)
+    parser.add_argument('--rsync',help='path to a real rsync binary (default: fake rsync)',type=str,default=None)
+    parser.add_argument('--job-options',help='JSON with extra job options, e.g. \'{"indexed": true}\'',type=str,default='{}')
+    parser.add_argument('--job-type',help='job type (default sync)',type=str,default='sync')
+    parser.add_argument('--workdir',help='directory for trees and targets (default: new temp dir, deleted afterwards)',type=str,default=None)
+    parser.add_argument('--seed',help='random seed (default 0)',type=int,default=0)
+    parser.add_argument('--save',help='save results as JSON',type=str,default=None)
+    parser.add_argument('--compare',help='compare with results saved by --save',type=str,default=None)
+    parser.add_argument('--tolerance',help='allowed relative slowdown when comparing (default 0.2)',type=float,default=0.2)
+    return parser
+
+
+def random_size(rng, median, sigma):
+    return int(rng.lognormvariate(0, sigma)*median)
+
+
+def generate_tree(root, n_files, fanout, median, sigma, rng):
+    """Create ``n_files`` files of random size in a random directory tree under ``root``."""
+    dirs = [root]
+    os.makedirs(root)
+    for i in range(n_files):
+        parent = rng.choice(dirs)
+        if rng.random() < 1./fanout:
+            path = os.path.join(parent, 'dir{}'.format(len(dirs)))
+            os.mkdir(path)
+            dirs.append(path)
+            parent = path
+        write_file(os.path.join(parent, 'file{}.dat'.format(i)), random_size(rng, median, sigma), rng)
+    return dirs
+
+
+def write_file(path, size, rng):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(min(size, 4096))*(size//4096) + os.urandom(size % 4096))
+
+
+def apply_churn(root, fraction, median, sigma, rng):
+    """Modify, add and delete files in the tree, in the proportions 2:1:1."""
+    files = []
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirs.append(dirpath)
+        files += [os.path.join(dirpath, f) for f in filenames]
+    n = int(len(files)*fraction)
+    rng.shuffle(files)
+    for path in files[:n//2]:
+        write_file(path, random_size(rng, median, sigma), rng)
+    for path in files[n//2:n//2+n//4]:
+        os.remove(path)
+    for i in range(n - n//2 - n//4):
+        write_file(os.path.join(rng.choice(dirs), 'new{}_{}.dat'.format(time.time(), i)), random_size(rng, median, sigma), rng)
+    return n
+
+
+class SpawnCounter(object):
+    """Counts processes started through ``subprocess.Popen`` while the context is active."""
+    def __init__(self):
+        self.count = 0
+        self.original_init = None
+
+    def __enter__(self):
+        self.original_init = sp.Popen.__init__
+        original_init = self.original_init
+        counter = self
+
+        def counting_init(popen, *args, **kwargs):
+            counter.count += 1
+            original_init(popen, *args, **kwargs)
+        sp.Popen.__init__ = counting_init
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sp.Popen.__init__ = self.original_init
+        return False
+
+
+def peak_rss():
+    """Peak resident memory of this process and of its largest child so far, in kB.
+
+    These are high-water marks of the whole benchmark process, so a run only shows its
+    own peak if that is higher than the peaks of all earlier runs.
+    """
+    if resource is None:
+        return None, None
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def setup_environment(workdir, rsync):
+    """Write a Josync config using the stand-in binaries and prepare the fake drive D:."""
+    bin_dir = os.path.join(workdir, 'bin')
+    os.mkdir(bin_dir)
+    os.symlink(os.path.join(tools_dir, 'fake_cygpath.py'), os.path.join(bin_dir, 'cygpath.exe'))
+    os.symlink(rsync or os.path.join(tools_dir, 'fake_rsync.py'), os.path.join(bin_dir, 'rsync.exe'))
+
+    drives = os.path.join(workdir, 'drives')
+    os.makedirs(os.path.join(drives, 'd'))
+    os.environ['FAKE_VSHADOW_ROOT'] = drives
+    os.environ['FAKE_VSHADOW_STATE'] = os.path.join(workdir, 'vshadow_state.json')
+
+    config_file = os.path.join(workdir, 'bench.josync-config')
+    with open(config_file, 'w') as f:
+        f.write(json.dumps({
+            'cygwin_bin_path': bin_dir,
+            'vshadow_bin': os.path.join(tools_dir, 'fake_vshadow.py')
+        }))
+
+    utils.config['is_pythonw'] = True
+    utils.config['subprocess_startupinfo'] = None
+    utils.config['dry_run'] = False
+    # no mapped network drives
+    utils.net_drives_state['enumerated'] = True
+    utils.read_config(default_cfg=config_file, user_cfg=os.path.join(workdir, 'user.josync-config'))
+    return os.path.join(drives, 'd', 'src')
+
+
+def wall_clock_time(records):
+    """Wall-clock time covered by phase records, counting overlapping phases only once."""
+    total = 0.
+    end = None
+    for record in sorted(records, key=lambda r: r['start']):
+        record_end = record['start'] + record['duration']
+        if end is None or record['start'] >= end:
+            total += record['duration']
+            end = record_end
+        elif record_end > end:
+            total += record_end - end
+            end = record_end
+    return total
+
+
+def time_it(func, repeat=3):
+    """Best wall-clock time of ``repeat`` calls of ``func``."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def hot_path_benchmarks(workdir):
+    results = {}
+
+    paths = ['c:\\Users\\bench\\dir{}\\file{}.dat'.format(i % 100, i) for i in range(10000)]
+
+    def translate_uncached():
+        utils.cygwin_path_cache.clear()
+        for p in paths:
+            utils.get_cygwin_path(p)
+    results['cygpath_10000_uncached'] = time_it(translate_uncached)
+    results['cygpath_10000_cached'] = time_it(lambda: [utils.get_cygwin_path(p) for p in paths])
+
+    lines = []
+    for i in range(100000):
+        lines.append('>f+++++++++ {} d/src/dir{}/file{}.dat'.format(i*17, i % 100, i))
+        if i % 10 == 0:
+            lines.append('     {:,}  {}%  12.34MB/s    0:00:{:02d} (xfr#{}, to-chk={}/100000)'.format(i*17, i % 100, i % 60, i, 100000-i))
+
+    def parse():
+        parser = utils.RsyncOutputParser(sized=True)
+        for line in lines:
+            parser.feed(line)
+    results['parser_110000_lines'] = time_it(parse)
+
+    def shadow_cycle():
+        with snapshots.snapshot_set(['d:'], 'vss'):
+            pass
+    results['volume_shadow_cycle'] = time_it(shadow_cycle)
+
+    return results
+
+
+def run_benchmark(args, workdir):
+    rng = random.Random(args.seed)
+    source = setup_environment(workdir, args.rsync)
+    os.chdir(workdir)
+
+    start = time.time()
+    generate_tree(source, args.files, args.fanout, args.size_median, args.size_sigma, rng)
+    logger.info("Generated {} files in {:.1f} s.".format(args.files, time.time()-start))
+
+    target = os.path.join(workdir, 'target')
+    os.mkdir(target)
+    job_file = os.path.join(workdir, 'bench.josync-job')
+    params = {
+        'type': args.job_type,
+        'sources': [{'path': 'd:/src', 'excludes': []}],
+        'snapshots': {'d:': {'provider': 'vss', 'path': os.path.dirname(source)}},
+        'target': target
+    }
+    params.update(json.loads(args.job_options))
+    with open(job_file, 'w') as f:
+        f.write(json.dumps(params))
+
+    results = {'runs': []}
+    for i in range(args.runs):
+        churned = apply_churn(source, args.churn, args.size_median, args.size_sigma, rng) if i > 0 else args.files
+        del utils.phase_timings[:]
+        with SpawnCounter() as counter:
+            start = time.time()
+            job = jobs.create_job_from_file(job_file)
+            job.run()
+            elapsed = time.time() - start
+        rss_self, rss_children = peak_rss()
+        run = {
+            'run': i,
+            'churned_files': churned,
+            'time': elapsed,
+            'spawns': counter.count,
+            'process_peak_rss_kb': rss_self,
+            'process_peak_child_rss_kb': rss_children,
+            # rsync processes running in parallel, e.g. shards, count once
+            'rsync_time': wall_clock_time([p for p in utils.phase_timings if p['phase'] == 'rsync']),
+            'stats': job.stats
+        }
+        run['overhead_time'] = run['time'] - run['rsync_time']
+        results['runs'].append(run)
+
+    results['hot_paths'] = hot_path_benchmarks(workdir)
+    return results
+
+
+def print_results(results):
+    print "{:>4} {:>8} {:>9} {:>9} {:>9} {:>7} {:>19}".format('run', 'churned', 'time [s]', 'rsync [s]', 'other [s]', 'spawns',
+                                                             'process peak [kB]')
+    for run in results['runs']:
+        print "{:>4} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>7} {:>19}".format(
+            run['run'], run['churned_files'], run['time'], run['rsync_time'], run['overhead_time'], run['spawns'],
+            run['process_peak_rss_kb'])
+    print
+    for name, value in sorted(results['hot_paths'].items()):
+        print "{:<28} {:>9.4f} s".format(name, value)
+
+
+def compare_results(results, baseline, tolerance):
+    """Print timings that got slower than ``tolerance`` allows. Returns True if there were any."""
+    timings = dict(results['hot_paths'])
+    baseline_timings = dict(baseline['hot_paths'])
+    for run, baseline_run in zip(results['runs'], baseline['runs']):
+        timings['run{}_overhead_time'.format(run['run'])] = run['overhead_time']
+        baseline_timings['run{}_overhead_time'.format(run['run'])] = baseline_run['overhead_time']
+        timings['run{}_spawns'.format(run['run'])] = run['spawns']
+        baseline_timings['run{}_spawns'.format(run['run'])] = baseline_run['spawns']
+
+    regressions = False
+    for name in sorted(timings):
+        if not name in baseline_timings:
+            continue
+        if timings[name] > baseline_timings[name]*(1+tolerance):
+            print "Regression in {}: {:.4f} (baseline {:.4f})".format(name, timings[name], baseline_timings[name])
+            regressions = True
+    return regressions
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(name)s [%(levelname)s] %(message)s')
+    logger.setLevel(logging.INFO)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='josync-bench-')
+    workdir = os.path.abspath(workdir)
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    cwd = os.getcwd()
+    try:
+        results = run_benchmark(args, workdir)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.loads(f.read())
+        if compare_results(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
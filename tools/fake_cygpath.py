@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+"""Stand-in for cygpath.exe, for running Josync without cygwin.
+
+Prints each argument on its own line with backslashes replaced by forward slashes,
+which is the identity for paths on systems other than Windows.
+"""
+import sys
+
+
+def main(args):
+    for path in args:
+        print path.replace('\\', '/')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""Minimal stand-in for rsync.exe, for benchmarking Josync without cygwin.
+
+Copies new and changed files (by size and modification time) from the sources to the
+target and prints a ``--stats`` block like rsync 3.1. Supported are the parts of the
+command line that affect which files are copied: several sources, ``/./`` in source
+paths with ``--relative`` (listing the implied parent directories), ``--files-from``
+(with ``--from0`` and ``--recursive``), ``--delete`` and ``--dry-run``, as well as hide
+(``H``) and protect (``P``) rules of anchored directories in a ``--filter=merge`` file. Excludes and all other options are accepted and ignored.
+
+``--write-batch`` only records the command line in the batch file, and ``--read-batch``
+runs the recorded command line again against the new target.
+"""
+import sys
+import os
+import shutil
+import json
+
+
+def parse_args(args):
+    options = {}
+    paths = []
+    for arg in args:
+        if arg.startswith('--'):
+            name, sep, value = arg[2:].partition('=')
+            options[name] = value if sep else True
+        elif arg.startswith('-') and len(arg) > 1:
+            for c in arg[1:]:
+                options[c] = True
+        else:
+            paths.append(arg)
+    return options, paths[:-1], paths[-1]
+
+
+def list_tree(root):
+    """Relative paths of all files and directories under root."""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            entries.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return entries
+
+
+def read_filter_rules(options):
+    """Hidden and protected directories from a ``--filter=merge`` file, relative to the transfer root."""
+    rules = {'H': [], 'P': []}
+    rule = options.get('filter')
+    if rule and rule.startswith('merge '):
+        with open(rule[len('merge '):]) as f:
+            for line in f:
+                kind, pattern = line.rstrip('\n').split(' ', 1)
+                if kind in rules:
+                    rules[kind].append(pattern.strip('/').replace('\\', ''))
+    return rules['H'], rules['P']
+
+
+def is_below(path, directories):
+    return any(path == d or path.startswith(d + '/') for d in directories)
+
+
+def main(args):
+    options, sources, target = parse_args(args)
+    if 'read-batch' in options:
+        with open(options['read-batch']) as f:
+            return main(json.loads(f.read()) + [target])
+    if 'write-batch' in options:
+        with open(options['write-batch'], 'w') as f:
+            f.write(json.dumps([a for a in args[:-1] if not a.startswith('--write-batch')]))
+    relative = 'relative' in options or 'R' in options or 'files-from' in options
+    dry_run = 'dry-run' in options or 'n' in options
+    hidden, protected = read_filter_rules(options)
+
+    # pairs of (base directory, relative path) to transfer
+    transfers = []
+    if 'files-from' in options:
+        with open(options['files-from'], 'rb') as f:
+            names = f.read().split('\0' if 'from0' in options else '\n')
+        for source in sources:
+            for name in names:
+                if not name:
+                    continue
+                transfers.append((source, name))
+                if ('recursive' in options or 'r' in options) and os.path.isdir(os.path.join(source, name)):
+                    transfers += [(source, os.path.join(name, p)) for p in list_tree(os.path.join(source, name))]
+    else:
+        for source in sources:
+            if relative and '/./' in source:
+                base, rel = source.split('/./', 1)
+            elif relative:
+                base, rel = os.path.dirname(source.rstrip('/')), os.path.basename(source.rstrip('/'))
+            elif source.endswith('/'):
+                base, rel = source, ''
+            else:
+                base, rel = os.path.dirname(source), os.path.basename(source)
+            transfers.append((base, rel))
+            if os.path.isdir(os.path.join(base, rel)):
+                transfers += [(base, os.path.join(rel, p)) for p in list_tree(os.path.join(base, rel))
+                              if not is_below(os.path.join(rel, p), hidden)]
+
+    if relative:
+        # rsync also lists the parent directories of relative paths (--implied-dirs)
+        listed = set(transfers)
+        implied = []
+        for base, rel in transfers:
+            parent = os.path.dirname(rel.rstrip('/'))
+            while parent and not (base, parent) in listed:
+                listed.add((base, parent))
+                implied.append((base, parent))
+                parent = os.path.dirname(parent)
+        transfers = sorted(implied) + transfers
+
+    num_files = transferred = deleted = 0
+    total_size = transferred_size = 0
+    for base, rel in transfers:
+        source_path = os.path.join(base, rel)
+        target_path = os.path.join(target, rel)
+        if not os.path.lexists(source_path):
+            if 'delete-missing-args' in options and os.path.lexists(target_path):
+                deleted += 1
+                if not dry_run:
+                    if os.path.isdir(target_path):
+                        shutil.rmtree(target_path)
+                    else:
+                        os.remove(target_path)
+            continue
+        num_files += 1
+        if os.path.isdir(source_path):
+            if not dry_run and not os.path.isdir(target_path):
+                os.makedirs(target_path)
+            continue
+        st = os.stat(source_path)
+        total_size += st.st_size
+        if os.path.isfile(target_path):
+            tt = os.stat(target_path)
+            if tt.st_size == st.st_size and int(tt.st_mtime) == int(st.st_mtime):
+                continue
+        transferred += 1
+        transferred_size += st.st_size
+        if 'verbose' in options or 'v' in options:
+            print rel
+        if not dry_run:
+            if not os.path.isdir(os.path.dirname(target_path)):
+                os.makedirs(os.path.dirname(target_path))
+            shutil.copy2(source_path, target_path)
+
+    if 'delete' in options and not 'files-from' in options:
+        for base, rel in transfers:
+            source_dir = os.path.join(base, rel)
+            if not os.path.isdir(source_dir) or not os.path.isdir(os.path.join(target, rel)):
+                continue
+            for name in os.listdir(os.path.join(target, rel)):
+                if is_below(os.path.join(rel, name), protected):
+                    continue
+                if not os.path.lexists(os.path.join(source_dir, name)):
+                    deleted += 1
+                    if not dry_run:
+                        path = os.path.join(target, rel, name)
+                        if os.path.isdir(path):
+                            shutil.rmtree(path)
+                        else:
+                            os.remove(path)
+
+    if 'stats' in options:
+        print
+        print "Number of files: {:,}".format(num_files)
+        print "Number of created files: 0"
+        print "Number of deleted files: {:,}".format(deleted)
+        print "Number of regular files transferred: {:,}".format(transferred)
+        print "Total file size: {:,} bytes".format(total_size)
+        print "Total transferred file size: {:,} bytes".format(transferred_size)
+        print "Literal data: {:,} bytes".format(transferred_size)
+        print "Matched data: 0 bytes"
+        print
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
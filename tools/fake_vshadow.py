@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Stand-in for vshadow.exe, for running Josync on systems without volume shadow copies.
+
+Point ``vshadow_bin`` in ``user.josync-config`` to this script. Supported calls are the
+ones Josync makes::
+
+    fake_vshadow.py -p -nw D: [E: ...]   create a (set of) snapshot(s)
+    fake_vshadow.py -el={GUID},path      "mount" a snapshot by symlinking path to the drive
+    fake_vshadow.py -ds={GUID}           delete a snapshot
+
+Environment variables:
+
+FAKE_VSHADOW_ROOT
+    Directory holding one subdirectory per drive letter, e.g. ``root/d`` for ``D:``.
+    Defaults to the current directory.
+FAKE_VSHADOW_STATE
+    JSON file keeping track of existing snapshots. Defaults to a file in the temp directory.
+FAKE_VSHADOW_FAIL
+    Comma-separated list of operations (``create``, ``mount``, ``delete``) that should fail.
+"""
+import sys
+import os
+import json
+import uuid
+import tempfile
+import datetime
+
+state_file = os.environ.get('FAKE_VSHADOW_STATE', os.path.join(tempfile.gettempdir(), 'fake_vshadow_state.json'))
+root = os.environ.get('FAKE_VSHADOW_ROOT', os.getcwd())
+fail = os.environ.get('FAKE_VSHADOW_FAIL', '').split(',')
+
+
+def load_state():
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.loads(f.read())
+
+
+def save_state(state):
+    with open(state_file, 'w') as f:
+        f.write(json.dumps(state))
+
+
+def create(drives):
+    if 'create' in fail:
+        print "Error creating shadow copy set."
+        return 1
+    state = load_state()
+    set_id = '{{{}}}'.format(uuid.uuid4())
+    now = datetime.datetime.now().strftime('%m/%d/%Y %I:%M:%S %p')
+    print "VSHADOW.EXE 3.0 - Volume Shadow Copy sample client (fake)"
+    print "Creating shadow set {} ...".format(set_id)
+    print "- Adding volumes to the shadow set..."
+    print
+    print "List of created shadow copies:"
+    print
+    for drive in drives:
+        letter = drive[0].lower()
+        guid = '{{{}}}'.format(uuid.uuid4())
+        state[guid] = {'drive': letter, 'mount': None}
+        print "* SNAPSHOT ID = {} ...".format(guid)
+        print "   - Shadow copy Set: {}".format(set_id)
+        print "   - Original count of shadow copies = {}".format(len(drives))
+        print "   - Original Volume name: \\\\?\\Volume{{{}}}\\ [{}:\\]".format(uuid.uuid4(), letter.upper())
+        print "   - Creation Time: {}".format(now)
+        print "   - Shadow copy device name: \\\\?\\GLOBALROOT\\Device\\HarddiskVolumeShadowCopy{}".format(len(state))
+        print "   - Originating machine: localhost"
+        print
+    save_state(state)
+    print "Snapshot creation done."
+    return 0
+
+
+def mount(arg):
+    guid, path = arg.split(',', 1)
+    state = load_state()
+    if 'mount' in fail or not guid in state:
+        print "Error mounting shadow copy {}.".format(guid)
+        return 1
+    os.rmdir(path)
+    os.symlink(os.path.abspath(os.path.join(root, state[guid]['drive'])), path)
+    state[guid]['mount'] = path
+    save_state(state)
+    print "Shadow copy {} exposed at {}".format(guid, path)
+    return 0
+
+
+def delete(guid):
+    state = load_state()
+    if 'delete' in fail or not guid in state:
+        print "Error deleting shadow copy {}.".format(guid)
+        return 1
+    path = state.pop(guid)['mount']
+    if path and os.path.islink(path):
+        # leave an empty directory, as vshadow does when unmounting
+        os.remove(path)
+        os.mkdir(path)
+    save_state(state)
+    print "Shadow copy {} deleted.".format(guid)
+    return 0
+
+
+def main(args):
+    if args[:2] == ['-p', '-nw'] and len(args) > 2:
+        return create(args[2:])
+    if len(args) == 1 and args[0].startswith('-el='):
+        return mount(args[0][len('-el='):])
+    if len(args) == 1 and args[0].startswith('-ds='):
+        return delete(args[0][len('-ds='):])
+    print "fake_vshadow: unsupported arguments {}".format(' '.join(args))
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
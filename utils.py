@@ -1,38 +1,250 @@
 ﻿import os
 import json
 import subprocess as sp
+import distutils.spawn
 from contextlib import contextmanager
 import re
-import tempfile
 import logging
 import collections
 import threading
 import sys
 import datetime
 import smtplib
+import time
+import select
+import errno
 from email.mime.text import MIMEText
 from email.header import Header
 
+try:
+    import ctypes
+    import msvcrt
+    get_drive_type = ctypes.windll.kernel32.GetDriveTypeW
+    peek_named_pipe = ctypes.windll.kernel32.PeekNamedPipe
+except (ImportError, AttributeError):
+    # not on Windows
+    get_drive_type = None
+    peek_named_pipe = None
+
 version = "0.0"
 config = {}
 net_drives = {}
+net_drives_state = {'enumerated': False, 'lock': threading.Lock()}
+config_files = ('default.josync-config', 'user.josync-config')
+environment_cache_file = 'josync-environment.cache'
+# config values that are set at runtime, and are not cached
+runtime_config_keys = ('is_pythonw', 'subprocess_startupinfo', 'dry_run')
+phase_timings = []
+phase_timings_lock = threading.Lock()
 logger = logging.getLogger(__name__)
+# file names and stats printed by rsync, configured in logging.josync-config
+rsync_output_logger = logging.getLogger('rsync_output')
+
+
+@contextmanager
+def timed_phase(phase, **details):
+    """timed_phase(phase, **details)
+    Measure the wall-clock duration of a phase of the run and record it in ``phase_timings``.
+
+    Yields the record, so that details such as exit codes can be added to it inside
+    the :keyword:`with` block.
+
+    :param phase: Name of the phase.
+    :type phase: str
+    :yields: dict -- Record of the phase.
+    """
+    record = {'phase': phase}
+    record.update(details)
+    start = time.time()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = str(e)
+        raise
+    finally:
+        record['start'] = start
+        record['duration'] = time.time() - start
+        logger.debug("Phase {} took {:.3f} s.".format(phase, record['duration']))
+        with phase_timings_lock:
+            phase_timings.append(record)
 
 
-def initialize():
+def write_run_report(report_file, report):
+    """Append a run report as one line of JSON to a report file.
+
+    :param report_file: Path to report file.
+    :type report_file: str
+    :param report: JSON serializable report.
+    :type report: dict
+    """
+    with open(report_file, 'a') as f:
+        f.write(json.dumps(report, sort_keys=True)+'\n')
+    logger.debug("Run report written to {}.".format(report_file))
+
+
+def write_file_atomic(filename, text):
+    """Replace the contents of a file in one step, so that readers never see a partial file.
+
+    :param filename: Path to file.
+    :type filename: str
+    :param text: New contents.
+    :type text: str
+    """
+    temp_file = filename + '.tmp'
+    with open(temp_file, 'w') as f:
+        f.write(text)
+    if os.path.isfile(filename):
+        os.remove(filename)
+    os.rename(temp_file, filename)
+
+
+def run_report_filename(job_file):
+    """Name of the file where run reports of a job are written.
+
+    :param job_file: Path to job file.
+    :type job_file: str
+    """
+    return job_file.replace('.josync-job','')+'.josync-job-report'
+
+
+def read_last_run_report(report_file, successful=True):
+    """Read the latest report from a run report file.
+
+    Only the end of the file is read.
+
+    :param report_file: Path to report file.
+    :type report_file: str
+    :param successful: Only consider reports of successful runs.
+    :type successful: bool
+    :returns: dict -- The report, or ``None`` if there is none.
+    """
+    if not os.path.isfile(report_file):
+        return None
+    with open(report_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 1048576))
+        lines = f.read().splitlines()
+    for line in reversed(lines):
+        try:
+            report = json.loads(line)
+        except ValueError:
+            continue
+        if not successful or report.get('success'):
+            return report
+    return None
+
+
+def initialize(use_cache=True):
+    """Set up subprocess flags and read the global config.
+
+    The merged config and the mapped net drives are cached in ``environment_cache_file``
+    (see :func:`load_environment_cache`). Net drives are only enumerated when a drive
+    letter cannot be identified as a local drive (see :func:`is_net_drive`).
+
+    :param use_cache: Use the environment cache if it is valid.
+    :type use_cache: bool
+    """
+    with timed_phase('initialize'):
+        initialize_environment(use_cache)
+
+
+def initialize_environment(use_cache=True):
     # subprocess flags
     config['is_pythonw'] = (os.path.split(os.path.splitext(sys.executable)[0])[1] == "pythonw")
-    startupinfo = sp.STARTUPINFO()
-    startupinfo.dwFlags |= sp.STARTF_USESHOWWINDOW
-    startupinfo.wShowWindow = sp.SW_HIDE
+    if hasattr(sp, 'STARTUPINFO'):
+        startupinfo = sp.STARTUPINFO()
+        startupinfo.dwFlags |= sp.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = sp.SW_HIDE
+    else:
+        # not on Windows, e.g. when testing with fake binaries
+        startupinfo = None
     config['subprocess_startupinfo'] = startupinfo
 
-    # enumerate net drives
-    enumerate_net_drives()
+    cache = load_environment_cache() if use_cache else None
+    if cache is not None:
+        logger.debug("Using cached config and binary paths from {}.".format(environment_cache_file))
+        config.update(cache['config'])
+        if 'net_drives' in cache:
+            net_drives.update(cache['net_drives'])
+            net_drives_state['enumerated'] = True
+        return
 
     # parse global settings file
-    read_config(default_cfg='default.josync-config',user_cfg='user.josync-config')
+    with timed_phase('read_config'):
+        read_config(default_cfg=config_files[0],user_cfg=config_files[1])
+    save_environment_cache()
+
+
+def config_files_signature():
+    """Modification times and sizes of the config files, used to invalidate the environment cache."""
+    signature = {}
+    for config_file in config_files:
+        if os.path.isfile(config_file):
+            st = os.stat(config_file)
+            signature[config_file] = [st.st_mtime, st.st_size]
+        else:
+            signature[config_file] = None
+    return signature
+
+
+def load_environment_cache():
+    """Read the environment cache, if it is still valid.
 
+    The cache is valid for ``environment_cache_ttl`` seconds (default one hour), as long
+    as the config files are unchanged. Cached net drives expire after
+    ``net_drives_cache_ttl`` seconds (default 10 minutes), since drives can be mapped
+    at any time.
+
+    :returns: dict -- The cache, or ``None`` if there is no valid cache.
+    """
+    if not os.path.isfile(environment_cache_file):
+        return None
+    try:
+        with open(environment_cache_file) as f:
+            cache = json.loads(f.read())
+        age = time.time() - cache['time']
+        if cache['signature'] != json.loads(json.dumps(config_files_signature())):
+            logger.debug("Config files changed since the environment cache was written.")
+            return None
+        if age < 0 or age > cache['config'].get('environment_cache_ttl', 3600):
+            logger.debug("Environment cache has expired.")
+            return None
+        net_drives_age = time.time() - cache.get('net_drives_time', 0)
+        if net_drives_age < 0 or net_drives_age > cache['config'].get('net_drives_cache_ttl', 600):
+            cache.pop('net_drives', None)
+        return cache
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.warning("Could not read environment cache {}: {}".format(environment_cache_file, e))
+        return None
+
+
+def save_environment_cache():
+    """Write the config read from the config files, and net drives if enumerated, to the environment cache."""
+    cache = {
+        'time': time.time(),
+        'signature': config_files_signature(),
+        'config': dict((k, v) for k, v in config.items() if not k in runtime_config_keys)
+    }
+    if net_drives_state['enumerated']:
+        cache['net_drives'] = net_drives
+        cache['net_drives_time'] = time.time()
+        if os.path.isfile(environment_cache_file):
+            # keep the config part of an existing cache
+            previous = load_environment_cache()
+            if previous is not None:
+                cache['time'] = previous['time']
+    try:
+        with open(environment_cache_file, 'w') as f:
+            f.write(json.dumps(cache))
+    except (IOError, TypeError, ValueError) as e:
+        logger.warning("Could not write environment cache {}: {}".format(environment_cache_file, e))
+
+
+def invalidate_environment_cache():
+    """Delete the environment cache, so that the next run probes the environment again."""
+    if os.path.isfile(environment_cache_file):
+        os.remove(environment_cache_file)
 
 
 def read_config(default_cfg,user_cfg):
@@ -49,16 +261,26 @@ def read_config(default_cfg,user_cfg):
     update_config(user_cfg)
 
     # Check config parameters
+    if not 'cygwin_bin_path' in config and os.name != 'nt' and config.get('snapshot_provider', 'vss') != 'vss':
+        # native rsync, e.g. on Linux: paths are passed as they are
+        config['native_rsync'] = True
+        config['rsync_bin'] = config.get('rsync_bin', 'rsync')
+        if not os.path.isfile(config['rsync_bin']) and distutils.spawn.find_executable(config['rsync_bin']) is None:
+            raise IOError("rsync could not be found at {}.".format(config['rsync_bin']))
+        return
+    config['native_rsync'] = False
     try:
         config['cygpath_bin'] = '{}/cygpath.exe'.format(config['cygwin_bin_path'])
         config['rsync_bin'] = '{}/rsync.exe'.format(config['cygwin_bin_path'])
+        if not 'cygwin_root' in config and os.path.basename(os.path.abspath(config['cygwin_bin_path'])).lower() == 'bin':
+            config['cygwin_root'] = os.path.dirname(os.path.abspath(config['cygwin_bin_path']))
     except KeyError as e:
         print "One of the necessary configuration parameters were not found."
         raise
     if not os.path.isfile(config['cygpath_bin']):
         raise IOError("cygpath.exe could not be found at {}.".format(config['cygpath_bin']))
-    if not os.path.isfile(config['vshadow_bin']):
-        raise IOError("vshadow.exe could not be found at {}.".format(config['vshadow_bin']))
+    if config.get('snapshot_provider', 'vss') == 'vss' and not os.path.isfile(config.get('vshadow_bin', '')):
+        raise IOError("vshadow.exe could not be found at {}.".format(config.get('vshadow_bin')))
     if not os.path.isfile(config['rsync_bin']):
         raise IOError("rsync.exe could not be found at {}.".format(config['rsync_bin']))
 
@@ -79,21 +301,130 @@ def update_config(config_file):
     config.update(config_in.items())
 
 
+class LRUCache(object):
+    """Small thread-safe least-recently-used cache."""
+    def __init__(self, maxsize=1024):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+cygwin_path_cache = LRUCache()
+
+
+def translate_cygwin_path(path):
+    """Translate a windows path to a cygwin path without calling cygpath.
+
+    Handles absolute drive paths (``c:\\foo`` becomes ``/cygdrive/c/foo``), UNC paths
+    (``\\\\server\\share`` becomes ``//server/share``) and paths without drive that
+    are already written with forward slashes. Paths inside the cygwin installation
+    are left to cygpath, since they are translated through the cygwin mount table.
+
+    :param path: The windows path to convert.
+    :type path: str
+    :returns: str -- The cygwin path, or ``None`` if ``path`` is not a form handled here.
+    """
+    if not path:
+        return None
+    normalized = path.replace('\\', '/')
+    parts = normalized.split('/')
+    if '.' in parts or '..' in parts or normalized.endswith('/'):
+        return None
+
+    cygwin_root = config.get('cygwin_root')
+    if cygwin_root and os.path.normcase(normalized+'/').startswith(os.path.normcase(cygwin_root.replace('\\', '/').rstrip('/')+'/')):
+        return None
+
+    if re.match(r'^[A-Za-z]:/', normalized):
+        if '//' in normalized:
+            return None
+        return '{}/{}{}'.format(config.get('cygdrive_prefix', '/cygdrive').rstrip('/'), normalized[0].lower(), normalized[2:])
+    if normalized.startswith('//'):
+        if '//' in normalized[2:] or not re.match(r'^//[^/:]+/[^/]', normalized):
+            return None
+        return normalized
+    if path.startswith('/') and not '\\' in path and not '//' in path:
+        return path
+    return None
+
+
 def get_cygwin_path(path):
     """Return cygwin path for a given windows path.
 
+    Common forms are translated in-process by :func:`translate_cygwin_path`. Other paths
+    are converted by the cygpath binary. Results are kept in a least-recently-used cache.
+
     :param path: The windows path to convert.
     :type path: str
     :returns: str -- The cygwin path to ``path``.
     :raises: IOError
     """
-    cygpath = config['cygpath_bin']
-    returncode,cygwin_path = shell_execute([cygpath,path])
-    if returncode != 0:
-        raise IOError("cygpath returned with exit code {}".format(returncode))
-    if not len(cygwin_path) > 0:
-        raise IOError("No cygwin path was found for {}.".format(path))
-    return cygwin_path
+    return get_cygwin_paths([path])[0]
+
+
+def get_cygwin_paths(paths):
+    """Return cygwin paths for a list of windows paths.
+
+    Paths that cannot be translated in-process are converted in a single cygpath call.
+
+    :param paths: The windows paths to convert.
+    :type paths: list
+    :returns: list -- The cygwin paths, in the order of ``paths``.
+    :raises: IOError
+    """
+    if config.get('native_rsync', False):
+        return list(paths)
+    cygwin_paths = [cygwin_path_cache.get(path) for path in paths]
+
+    external = []
+    for i, path in enumerate(paths):
+        if cygwin_paths[i] is not None:
+            continue
+        if config.get('fast_cygpath', True):
+            cygwin_paths[i] = translate_cygwin_path(path)
+        if cygwin_paths[i] is None:
+            external.append(i)
+        else:
+            cygwin_path_cache.put(path, cygwin_paths[i])
+
+    if external:
+        external_paths = [paths[i] for i in external]
+        logger.debug("Calling cygpath for {} path(s).".format(len(external_paths)))
+        returncode,output = shell_execute([config['cygpath_bin']]+external_paths)
+        if returncode != 0:
+            raise IOError("cygpath returned with exit code {}".format(returncode))
+        lines = output.splitlines()
+        if len(lines) != len(external_paths):
+            raise IOError("cygpath returned {} path(s) for {} input path(s).".format(len(lines),len(external_paths)))
+        for i, cygwin_path in zip(external, lines):
+            cygwin_path = cygwin_path.strip()
+            if not len(cygwin_path) > 0:
+                raise IOError("No cygwin path was found for {}.".format(paths[i]))
+            cygwin_paths[i] = cygwin_path
+            cygwin_path_cache.put(paths[i], cygwin_path)
+
+    return cygwin_paths
 
 
 def shell_execute(command):
@@ -109,52 +440,51 @@ def shell_execute(command):
     return (process.returncode, stdout)
 
 
-@contextmanager
-def volume_shadow(drive):
-    """volume_shadow(drive)
-    Creates a shadow copy of a drive and mounts it at a temporary directory.
+def run_in_parallel(func, args_list, max_workers=1):
+    """Call ``func`` once for every argument tuple in ``args_list`` using a pool of threads.
 
-    Implemented with ``contextmanager`` to be used through the python :keyword:`with` statement.
+    Calls that have not yet been started are skipped once any call has raised,
+    but calls already running are allowed to finish (and clean up after themselves).
 
-    :param drive: Drive to shadow copy.
-    :type drive: str
-    :yields: str -- Path to temp folder where shadow copy is mounted.
-    :raises: OSError
+    :param func: Function to call.
+    :param args_list: List of argument tuples.
+    :type args_list: list
+    :param max_workers: Maximum number of concurrent calls.
+    :type max_workers: int
+    :returns: List of return values, in the order of ``args_list``.
+    :raises: The first exception raised by any of the calls.
     """
-    logger.info("Attempting to create shadow copy of volume {}".format(drive))
-
-    vshadow = config['vshadow_bin']
-    vshadow_returncode, vshadow_output = shell_execute([vshadow, '-p', '-nw', drive])
-    guidmatch = re.search(r"\* SNAPSHOT ID = (\{[0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12}\})", vshadow_output)
-    if not guidmatch or not vshadow_returncode == 0:
-        raise OSError("vhadow did not produce a GUID. Return code: {} (hint: try running as administrator)".format(vshadow_returncode))
-    shadow_guid = guidmatch.group(1)
-    logger.debug("Shadow copy GUID: {}".format(shadow_guid))
-
-    try:
-        # mount shadow copy in a temp dir
-        shadow_path = tempfile.mkdtemp()
-        shadow_mount_path = "{}\\{}".format(shadow_path, drive[0])
-        os.mkdir(shadow_mount_path)
-        vshadow_returncode, vshadow_output = shell_execute([vshadow, '-el={},{}'.format(shadow_guid, shadow_mount_path)])
-        if not vshadow_returncode == 0:
-            logger.error("vshadow could not mount shadow copy with GUID {} at {}.\n{}".format(shadow_guid,shadow_mount_path,vshadow_output))
-            raise OSError("vshadow could not mount shadow copy: {}".format(shadow_guid))
-
-        logger.info("Shadow copy {} successfully created and mounted at {}".format(shadow_guid,shadow_mount_path))
-
-        yield shadow_path
-
-    finally:
+    args_list = list(args_list)
+    results = [None]*len(args_list)
+    errors = []
+    pending = collections.deque(enumerate(args_list))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if errors or not pending:
+                    return
+                index, args = pending.popleft()
+            try:
+                results[index] = func(*args)
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+
+    if max_workers <= 1 or len(args_list) <= 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker) for i in range(min(max_workers, len(args_list)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
 
-        logger.info("Deleting shadow copy {} of volume {}".format(shadow_guid, drive))
-        vshadow_returncode, vshadow_output = shell_execute([vshadow, '-ds={}'.format(shadow_guid)])
-        if not vshadow_returncode == 0:
-            logger.error("vshadow could not delete shadow copy with GUID {}.\n{}".format(shadow_guid,vshadow_output))
-            raise OSError("vshadow could not delete shadow copy: {}".format(shadow_guid))
-        os.rmdir(shadow_mount_path)
-        os.rmdir(shadow_path)
-        logger.info("Shadow copy {} of {} at {} successfully deleted".format(shadow_guid, drive, shadow_mount_path))
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
 
 
 def enumerate_net_drives():
@@ -183,19 +513,276 @@ def enumerate_net_drives():
 def is_net_drive(drive):
     '''Looks up drive in net_drives
 
+    Drives that Windows reports as local are not looked up. For other drives,
+    including mapped drives that are not connected, net drives are enumerated
+    (or read from the environment cache) the first time they are needed.
+
     :returns: True if drive is a net drive (is in net_drives list)
     '''
+    if not drive or os.name != 'nt':
+        # drives are only mapped on Windows
+        return False
+    if get_drive_type is not None:
+        # removable, fixed, CD-ROM or RAM disk
+        if get_drive_type(u'{}\\'.format(drive[:2])) in (2, 3, 5, 6):
+            return False
+    with net_drives_state['lock']:
+        if not net_drives_state['enumerated']:
+            with timed_phase('enumerate_net_drives'):
+                enumerate_net_drives()
+            net_drives_state['enumerated'] = True
+            if config:
+                save_environment_cache()
     return drive.lower() in net_drives.keys()
 
 
+# Events produced by RsyncOutputParser
+ItemizedChange = collections.namedtuple('ItemizedChange', ['path', 'change', 'size'])
+ProgressUpdate = collections.namedtuple('ProgressUpdate', ['bytes', 'percent', 'rate', 'eta', 'files_transferred', 'files_to_check', 'files_total'])
+StatsItem = collections.namedtuple('StatsItem', ['key', 'value'])
+OutputLine = collections.namedtuple('OutputLine', ['line'])
+
+
+def parse_rsync_number(text):
+    """Parse an integer from rsync output, ignoring thousands separators.
+
+    :param text: Number as printed by rsync, e.g. ``1,238,099``.
+    :type text: str
+    :returns: float
+    """
+    return float(re.sub(r"[,.']", '', text))
+
+
+class RsyncOutputParser(object):
+    """Incremental parser turning rsync stdout into events.
+
+    Feed it one line at a time with :meth:`feed`. Every line results in one event
+    passed to each subscriber:
+
+    * :class:`ItemizedChange` for ``--itemize-changes`` lines (``size`` is only known
+      when rsync is run with ``--out-format`` set to :attr:`itemize_out_format`),
+    * :class:`ProgressUpdate` for ``--progress`` and ``--info=progress2`` lines,
+    * :class:`StatsItem` for lines of the ``--stats`` block,
+    * :class:`OutputLine` for anything else.
+
+    Only the totals from the stats block are kept, so memory use does not grow with the
+    number of files.
+    """
+
+    #: ``--out-format`` giving itemized changes with file sizes.
+    itemize_out_format = '%i %l %n%L'
+
+    # e.g. ">f.st...... 1024 docs/file.txt" or "*deleting   docs/old.txt"
+    itemize_pattern = re.compile(r"^([<>ch.][fdLDS][cstpoguax.+ ?]{7,9}|\*deleting\s*) (?:(\d+) )?(.*)$")
+    # e.g. "  1,238,099  100%  146.38MB/s    0:00:00 (xfr#1, to-chk=0/1)"
+    progress_pattern = re.compile(r"^\s*([\d,.']+)\s+(\d+)%\s+([\d.,]+)([kMGT]?)B/s\s+(\d+):(\d+):(\d+)"
+                                  r"(?:\s+\(xfr#(\d+), (?:ir|to)-chk=(\d+)/(\d+)\))?")
+    rate_factors = {'': 1., 'k': 1024., 'M': 1024.**2, 'G': 1024.**3, 'T': 1024.**4}
+    # lines in the --stats block, older and newer wordings
+    stats_patterns = [
+        ("num_files", re.compile(r"^Number of files:\s+([\d,.']+)")),
+        ("files_transferred", re.compile(r"^Number of (?:regular )?files transferred:\s+([\d,.']+)")),
+        ("files_created", re.compile(r"^Number of created files:\s+([\d,.']+)")),
+        ("files_deleted", re.compile(r"^Number of deleted files:\s+([\d,.']+)")),
+        ("tot_file_size", re.compile(r"^Total file size:\s+([\d,.']+) bytes")),
+        ("file_size_transferred", re.compile(r"^Total transferred file size:\s+([\d,.']+) bytes")),
+        ("literal_data", re.compile(r"^Literal data:\s+([\d,.']+) bytes")),
+        ("matched_data", re.compile(r"^Matched data:\s+([\d,.']+) bytes")),
+        ("bytes_sent", re.compile(r"^Total bytes sent:\s+([\d,.']+)")),
+        ("bytes_received", re.compile(r"^Total bytes received:\s+([\d,.']+)")),
+    ]
+
+    def __init__(self, sized=False):
+        super(RsyncOutputParser, self).__init__()
+        self.sized = sized
+        self.stats = {}
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """Call ``callback(event)`` for every parsed event."""
+        self.subscribers.append(callback)
+
+    def emit(self, event):
+        for callback in self.subscribers:
+            callback(event)
+
+    def feed(self, line):
+        """Parse one line of rsync output.
+
+        Progress updates separated by carriage returns are parsed one by one.
+
+        :param line: Line of output without line break.
+        :type line: str
+        """
+        for part in line.split('\r'):
+            if part.strip():
+                self.emit(self.parse(part.rstrip()))
+
+    def parse(self, line):
+        """Parse a single line of rsync output into an event."""
+        match = self.progress_pattern.match(line)
+        if match:
+            hours, minutes, seconds = [int(match.group(i)) for i in (5, 6, 7)]
+            counts = [int(match.group(i)) if match.group(i) else None for i in (8, 9, 10)]
+            return ProgressUpdate(parse_rsync_number(match.group(1)),
+                                  int(match.group(2)),
+                                  float(match.group(3).replace(',', '.'))*self.rate_factors[match.group(4)],
+                                  3600*hours+60*minutes+seconds,
+                                  *counts)
+
+        for key, pattern in self.stats_patterns:
+            match = pattern.match(line)
+            if match:
+                value = parse_rsync_number(match.group(1))
+                self.stats[key] = value
+                return StatsItem(key, value)
+
+        match = self.itemize_pattern.match(line)
+        if match:
+            change = match.group(1).strip()
+            size = match.group(2)
+            path = match.group(3)
+            if size is not None and not self.sized:
+                # no size in the output format, the number belongs to the path
+                path = '{} {}'.format(size, path)
+                size = None
+            if ' -> ' in path and change[1] == 'L':
+                path = path.split(' -> ', 1)[0]
+            return ItemizedChange(path, change, float(size) if size is not None else None)
+
+        return OutputLine(line)
+
+
+class PipeEngine(object):
+    """Reads the output pipes of any number of processes on a single thread.
+
+    Each registered pipe is read in large chunks, split into lines and passed to its
+    callback line by line. Waiting for output uses ``select`` where pipes support it,
+    and on Windows polls the pipes with ``PeekNamedPipe``. The thread is started when
+    the first pipe is registered and stops when no pipes remain.
+    """
+    chunk_size = 65536
+    poll_interval = 0.02
+
+    def __init__(self):
+        super(PipeEngine, self).__init__()
+        self.lock = threading.Lock()
+        self.pipes = {}
+        self.thread = None
+        if peek_named_pipe is None:
+            # writing to this pipe wakes up select when pipes are registered
+            self.wake_read, self.wake_write = os.pipe()
+
+    def register(self, pipe, callback, done=None, split_cr=False):
+        """Start reading a pipe.
+
+        :param pipe: File object of the pipe.
+        :param callback: Called with every line read, without line break and trailing whitespace.
+        :param done: Called without arguments when the pipe is closed.
+        :param split_cr: Also end lines at carriage returns, as used by progress output.
+        :type split_cr: bool
+        """
+        fd = pipe.fileno()
+        with self.lock:
+            self.pipes[fd] = {'callback': callback, 'done': done, 'partial': b'',
+                              'separator': re.compile(b'[\r\n]' if split_cr else b'\n')}
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='PipeEngine')
+                self.thread.daemon = True
+                self.thread.start()
+        if peek_named_pipe is None:
+            os.write(self.wake_write, b'x')
+
+    def run(self):
+        while True:
+            with self.lock:
+                fds = list(self.pipes.keys())
+                if not fds:
+                    self.thread = None
+                    return
+            for fd, size in self.wait_readable(fds):
+                self.read(fd, size)
+
+    def wait_readable(self, fds):
+        """Wait until some pipes can be read.
+
+        :returns: List of 2-tuples with file descriptor and number of bytes to read.
+        """
+        if peek_named_pipe is None:
+            try:
+                readable = select.select(fds + [self.wake_read], [], [])[0]
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            if self.wake_read in readable:
+                os.read(self.wake_read, self.chunk_size)
+                readable.remove(self.wake_read)
+            return [(fd, self.chunk_size) for fd in readable]
+
+        readable = []
+        for fd in fds:
+            available = ctypes.c_ulong(0)
+            if not peek_named_pipe(msvcrt.get_osfhandle(fd), None, 0, None, ctypes.byref(available), None):
+                # pipe closed, reading it gives end of file
+                readable.append((fd, self.chunk_size))
+            elif available.value > 0:
+                readable.append((fd, min(available.value, self.chunk_size)))
+        if not readable:
+            time.sleep(self.poll_interval)
+        return readable
+
+    def read(self, fd, size):
+        pipe = self.pipes[fd]
+        try:
+            data = os.read(fd, size)
+        except OSError as e:
+            logger.debug("Reading pipe failed: {}".format(e))
+            data = b''
+
+        if data:
+            lines = pipe['separator'].split(pipe['partial'] + data)
+            pipe['partial'] = lines.pop()
+        else:
+            lines = [pipe['partial']] if pipe['partial'] else []
+
+        for line in lines:
+            if not line:
+                continue
+            try:
+                pipe['callback'](line.rstrip())
+            except Exception as e:
+                logger.exception(e)
+
+        if not data:
+            with self.lock:
+                del self.pipes[fd]
+            if pipe['done'] is not None:
+                pipe['done']()
+
+
+pipe_engine = PipeEngine()
+
+
 class Rsync(sp.Popen):
-    """Sub-class of subprocess.Popen to run rsync process."""
-    def __init__(self, source, target, options=None):
+    """Sub-class of subprocess.Popen to run rsync process.
+
+    ``source`` is either a single source path, a list of source paths or ``None``. If a
+    :class:`RsyncOutputParser` is given, every line of stdout is fed to it as it is read.
+
+    Output is read by the shared :data:`pipe_engine`, unless the config option
+    ``pipe_engine`` is ``false``, in which case each pipe gets its own thread."""
+    def __init__(self, source, target, options=None, parser=None):
         # Construct rsync call and create process.
         options = options if options is not None else []
         if config['dry_run']:
             options += ['--dry-run']
-        self.rsync_call = [config['rsync_bin']]+options+[source,target]
+        if source is None:
+            # e.g. with --read-batch
+            sources = []
+        else:
+            sources = [source] if isinstance(source, basestring) else list(source)
+        self.rsync_call = [config['rsync_bin']]+options+sources+[target]
         logger.debug("rsync process created from call {}".format(' '.join(self.rsync_call)))
         logger.info("Starting rsync process.")
         super(Rsync, self).__init__(self.rsync_call,
@@ -203,10 +790,20 @@ class Rsync(sp.Popen):
                                     bufsize=1,startupinfo=config['subprocess_startupinfo'])
 
         self.output_buffer = collections.deque(maxlen=20)
-        self.threads = [
-            self.output_thread(self.stdout,self.stdout_send),
-            self.output_thread(self.stderr,self.stderr_send)
-        ]
+        self.parser = parser
+        # live progress output is ended by carriage returns, and is not echoed to stdout
+        self.progress = any(o.startswith('--info=progress') or o == '--progress' for o in options)
+        if config.get('pipe_engine', True):
+            self.threads = []
+            self.pipes_closed = [threading.Event(), threading.Event()]
+            pipe_engine.register(self.stdout,self.stdout_send,self.pipes_closed[0].set,split_cr=self.progress)
+            pipe_engine.register(self.stderr,self.stderr_send,self.pipes_closed[1].set)
+        else:
+            self.pipes_closed = []
+            self.threads = [
+                self.output_thread(self.stdout,self.stdout_send),
+                self.output_thread(self.stderr,self.stderr_send)
+            ]
 
 
     def output_thread(self,pipe,send):
@@ -224,8 +821,11 @@ class Rsync(sp.Popen):
         return t
 
     def stdout_send(self,line):
-        sys.stdout.write(line+'\n')
-        self.output_buffer.append(line)
+        if not self.progress or not RsyncOutputParser.progress_pattern.match(line):
+            rsync_output_logger.info(line)
+            self.output_buffer.append(line)
+        if self.parser:
+            self.parser.feed(line)
 
     def stderr_send(self,line):
         logger.warning(line)
@@ -234,6 +834,11 @@ class Rsync(sp.Popen):
         super(Rsync, self).wait()
         for t in self.threads:
             t.join()
+        for closed in self.pipes_closed:
+            # wait() without timeout can not be interrupted in python 2
+            while not closed.wait(1):
+                pass
+        return self.returncode
 
 
 def get_file_modification_date(filename):
@@ -296,6 +901,16 @@ class JobDescriptionKeyError(Exception):
 class JobDescriptionValueError(Exception):
     pass
 
+class TimelineError(Exception):
+    """A timeline snapshot could not be completed."""
+    pass
+
+class RsyncError(IOError):
+    """rsync returned with a non-zero exit code, available as ``returncode``."""
+    def __init__(self, returncode):
+        super(RsyncError, self).__init__("rsync returned with exit code {}.".format(returncode))
+        self.returncode = returncode
+
 
 class FailureNotifier(object):
     """Keeps track of when the last time a job was successfully run.
@@ -0,0 +1,181 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import random
+import threading
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+# bytes read at once when hashing
+read_size = 4*1024*1024
+
+
+def hash_file(path):
+    """SHA-1 of the contents of a file, read in large sequential blocks.
+
+    A module level function, so that it can be called in a process pool.
+
+    :param path: Path to file.
+    :type path: str
+    :returns: 2-tuple of path and hex digest, or path and ``None`` if the file could not be read.
+    """
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(read_size)
+                if not data:
+                    break
+                digest.update(data)
+    except (IOError, OSError):
+        return path, None
+    return path, digest.hexdigest()
+
+
+class HashCache(object):
+    """SQLite cache of file hashes, valid as long as the size and modification time of a file are unchanged.
+
+    :param cache_file: Path to cache database.
+    :type cache_file: str
+    """
+    def __init__(self, cache_file):
+        super(HashCache, self).__init__()
+        self.cache_file = cache_file
+        self.local = threading.local()
+        connection = self.connect()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)")
+
+    def connect(self):
+        """Return a connection for the current thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.cache_file, timeout=60)
+            self.local.connection = connection
+        return connection
+
+    def get(self, key, size, mtime):
+        """Cached hash of a file, or ``None`` if it is unknown or the file has changed."""
+        row = self.connect().execute("SELECT hash FROM hashes WHERE path = ? AND size = ? AND mtime = ?",
+                                     (key, size, mtime)).fetchone()
+        return row[0] if row is not None else None
+
+    def put_many(self, entries):
+        """Store hashes.
+
+        :param entries: Iterable of 4-tuples of key, size, mtime and hash.
+        """
+        connection = self.connect()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", entries)
+
+
+class Verifier(object):
+    """Compares the contents of synced files at the source and the target by hashing.
+
+    A sample of the files of a source is hashed at both ends in a pool of processes.
+    Hashes are cached by path, size and modification time, so files that did not change
+    since they were last hashed are not read again. Source files are cached by their
+    path on the original drive, since the shadow copy is mounted somewhere else on every run.
+
+    :param hash_cache: Cache of hashes.
+    :type hash_cache: :class:`HashCache`
+    :param sample: Fraction of the files to verify, ``1`` for all.
+    :type sample: float
+    :param workers: Number of processes hashing files.
+    :type workers: int
+    """
+    def __init__(self, hash_cache, sample=1., workers=2):
+        super(Verifier, self).__init__()
+        self.hash_cache = hash_cache
+        self.sample = sample
+        self.workers = workers
+
+    def hash_files(self, files, pool=None):
+        """Hash files, using the cache where possible.
+
+        :param files: List of 2-tuples of cache key and path.
+        :type files: list
+        :param pool: Process pool to hash files in, or ``None`` to hash them in this process.
+        :type pool: multiprocessing.Pool
+        :returns: dict -- Hash (or ``None`` if unreadable) by path.
+        """
+        hashes = {}
+        keys = {}
+        to_hash = []
+        for key, path in files:
+            st = os.stat(path)
+            cached = self.hash_cache.get(key, st.st_size, st.st_mtime)
+            if cached is not None:
+                hashes[path] = cached
+            else:
+                keys[path] = (key, st.st_size, st.st_mtime)
+                to_hash.append(path)
+
+        if pool is not None:
+            hashes.update(pool.imap_unordered(hash_file, to_hash, chunksize=4))
+        else:
+            hashes.update(hash_file(path) for path in to_hash)
+
+        self.hash_cache.put_many((keys[path] + (hashes[path],)) for path in to_hash if hashes[path] is not None)
+        return hashes
+
+    def verify(self, source_files, target_root, source_name, chunk_size=1000):
+        """Verify a sample of the files of one source.
+
+        Files are verified in chunks of ``chunk_size``, so that memory use does not grow with the size of the source.
+
+        :param source_files: Iterable of 2-tuples of path relative to the source and path to the file
+                             in the shadow copy, e.g. from :meth:`excludes.ExcludeFilter.included_files`.
+        :param target_root: Directory at the target corresponding to the source.
+        :type target_root: str
+        :param source_name: Name of the source (drive and path), used as prefix of the cache keys.
+        :type source_name: str
+        :returns: dict -- Stats: ``verify_files``, ``verify_bytes``, ``verify_missing`` and ``verify_mismatches``.
+        """
+        rng = random.Random()
+        stats = {'verify_files': 0, 'verify_bytes': 0, 'verify_missing': 0, 'verify_mismatches': 0}
+        pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+        try:
+            chunk = []
+            for relative, source_path in source_files:
+                if os.path.islink(source_path) or (self.sample < 1 and rng.random() >= self.sample):
+                    continue
+                chunk.append((relative, source_path, os.path.join(target_root, relative)))
+                if len(chunk) >= chunk_size:
+                    self.verify_chunk(chunk, source_name, stats, pool)
+                    chunk = []
+            self.verify_chunk(chunk, source_name, stats, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        logger.info("Verified {} file(s) of {} ({} missing, {} different).".format(
+                    stats['verify_files'], source_name, stats['verify_missing'], stats['verify_mismatches']))
+        return stats
+
+    def verify_chunk(self, pairs, source_name, stats, pool):
+        present = []
+        for relative, source_path, target_path in pairs:
+            if not os.path.isfile(target_path):
+                stats['verify_missing'] += 1
+                logger.warning("Verification of {}: {} is missing at the target.".format(source_name, relative))
+            elif os.path.getsize(target_path) != os.path.getsize(source_path):
+                stats['verify_mismatches'] += 1
+                logger.warning("Verification of {}: size of {} differs at the target.".format(source_name, relative))
+            else:
+                present.append((relative, source_path, target_path))
+
+        files = [(source_name + '/' + relative, source_path) for relative, source_path, target_path in present]
+        files += [(target_path, target_path) for relative, source_path, target_path in present]
+        hashes = self.hash_files(files, pool)
+
+        for relative, source_path, target_path in present:
+            stats['verify_files'] += 1
+            stats['verify_bytes'] += os.path.getsize(source_path)
+            if hashes[source_path] is None or hashes[source_path] != hashes[target_path]:
+                stats['verify_mismatches'] += 1
+                logger.warning("Verification of {}: contents of {} differ at the target.".format(source_name, relative))
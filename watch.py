@@ -0,0 +1,369 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+import utils
+import excludes
+import snapshots
+
+logger = logging.getLogger(__name__)
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+event_header = struct.Struct('iIII')
+
+
+def fs_path(path):
+    """Path as unicode, decoding names read from the file system as bytes."""
+    return path if isinstance(path, unicode) else path.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+
+
+class InotifyWatcher(object):
+    """Watches directory trees for changes with Linux inotify, through ctypes.
+
+    Every directory of the trees gets a watch, and directories created later are
+    added as they appear. The number of watches is limited by the kernel setting
+    ``fs.inotify.max_user_watches``.
+
+    :param roots: Directories to watch, with everything below them.
+    :type roots: list
+    :raises: OSError
+    """
+    def __init__(self, roots):
+        super(InotifyWatcher, self).__init__()
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not start inotify.")
+        self.watches = {}
+        try:
+            for root in roots:
+                self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding() or 'utf-8'), watch_mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # removed since it was listed
+                return
+            raise OSError(error, "Could not watch {}: {}".format(path, os.strerror(error)))
+        self.watches[wd] = path
+
+    def add_tree(self, root):
+        for dirpath, dirnames, filenames in os.walk(fs_path(root)):
+            self.add_watch(dirpath)
+
+    def read(self, timeout):
+        """Wait for changes.
+
+        :param timeout: Seconds to wait at most.
+        :type timeout: float
+        :returns: List of 2-tuples of changed path and ``True`` for directories that were created
+                  or moved in, or ``None`` if changes were lost and everything must be synced.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        changes = []
+        lost = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            name = data[offset + event_header.size:offset + event_header.size + length].rstrip(b'\0')
+            offset += event_header.size + length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Too many changes at once, inotify dropped events.")
+                lost = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, fs_path(name)) if name else directory
+            new_dir = bool(mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO))
+            if new_dir:
+                try:
+                    self.add_tree(path)
+                except OSError as e:
+                    logger.warning("{} (watching for changes is incomplete).".format(e))
+                    lost = True
+            changes.append((path, new_dir))
+        return None if lost else changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Finds changes by walking directory trees every ``interval`` seconds and comparing sizes and modification times.
+
+    :param roots: Directories to watch, with everything below them.
+    :type roots: list
+    :param interval: Seconds between scans.
+    :type interval: float
+    """
+    def __init__(self, roots, interval=60):
+        super(PollingWatcher, self).__init__()
+        self.roots = [fs_path(root) for root in roots]
+        self.interval = interval
+        self.state = self.scan()
+        self.next_scan = time.time() + interval
+
+    def scan(self):
+        state = {}
+        for root in self.roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.lstat(path)
+                    except OSError:
+                        continue
+                    state[path] = (name in dirnames, st.st_size, st.st_mtime)
+        return state
+
+    def read(self, timeout):
+        """Wait for changes, see :meth:`InotifyWatcher.read`."""
+        wait = self.next_scan - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        state = self.scan()
+        self.next_scan = time.time() + self.interval
+
+        changes = []
+        for path, entry in state.items():
+            previous = self.state.get(path)
+            if previous is None:
+                changes.append((path, entry[0]))
+            elif previous != entry and not entry[0]:
+                changes.append((path, False))
+        changes += [(path, False) for path in self.state if not path in state]
+        self.state = state
+        return changes
+
+    def close(self):
+        pass
+
+
+def create_watcher(roots, poll_interval=60):
+    """Watch directory trees with inotify where possible, else by polling.
+
+    :param roots: Directories to watch.
+    :type roots: list
+    :param poll_interval: Seconds between scans when polling.
+    :type poll_interval: float
+    :returns: :class:`InotifyWatcher` or :class:`PollingWatcher`.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            watcher = InotifyWatcher(roots)
+            logger.info("Watching {} directories with inotify.".format(len(watcher.watches)))
+            return watcher
+        except (OSError, AttributeError) as e:
+            logger.warning("Could not watch with inotify ({}), polling every {} s instead.".format(e, poll_interval))
+    else:
+        logger.info("Polling for changes every {} s.".format(poll_interval))
+    return PollingWatcher(roots, poll_interval)
+
+
+class PendingChanges(object):
+    """Changed paths collected since the last sync.
+
+    Changes are synced once no new change arrived for ``debounce`` seconds, or
+    ``max_delay`` seconds after the first change, whichever comes first. Paths below
+    new directories are left out, since the directories are synced with everything
+    in them. More than ``max_paths`` paths are given up for a full sync.
+
+    :param debounce: Seconds without changes before syncing.
+    :type debounce: float
+    :param max_delay: Seconds after the first change before syncing at the latest.
+    :type max_delay: float
+    :param max_paths: Number of paths above which a full sync is cheaper.
+    :type max_paths: int
+    """
+    def __init__(self, debounce=5, max_delay=60, max_paths=10000):
+        super(PendingChanges, self).__init__()
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_paths = max_paths
+        self.clear()
+
+    def clear(self):
+        self.paths = set()
+        self.new_dirs = set()
+        self.lost = False
+        self.first = None
+        self.last = None
+
+    def add(self, changes, now):
+        """Add changes as returned by :meth:`InotifyWatcher.read`."""
+        if changes is None:
+            self.lost = True
+        else:
+            for path, new_dir in changes:
+                (self.new_dirs if new_dir else self.paths).add(path)
+            if len(self.paths) + len(self.new_dirs) > self.max_paths:
+                logger.info("More than {} changed paths, syncing everything.".format(self.max_paths))
+                self.lost = True
+            if not changes:
+                return
+        if self.lost:
+            self.paths.clear()
+            self.new_dirs.clear()
+        if self.first is None:
+            self.first = now
+        self.last = now
+
+    def ready(self, now):
+        """True if the changes should be synced now."""
+        return self.first is not None and (now - self.last >= self.debounce or now - self.first >= self.max_delay)
+
+    def take(self):
+        """Remove the changes.
+
+        :returns: List of 2-tuples of path and ``True`` if it is a new directory, sorted, or
+                  ``None`` if changes were lost and everything must be synced.
+        """
+        if self.lost:
+            self.clear()
+            return None
+        changes = []
+        for path in sorted(self.new_dirs | self.paths):
+            parent = os.path.dirname(path)
+            while parent and parent != os.path.dirname(parent) and not parent in self.new_dirs:
+                parent = os.path.dirname(parent)
+            if not parent in self.new_dirs:
+                changes.append((path, path in self.new_dirs))
+        self.clear()
+        return changes
+
+
+class WatchRunner(object):
+    """Keeps a job resident and syncs the paths of its sources as they change.
+
+    The live source directories are watched (see :func:`create_watcher`). Changes are
+    collected in :class:`PendingChanges`, and the changed paths that the excludes of
+    their source do not skip are synced with :meth:`jobs.SyncJob.sync_changes`. A full
+    run of the job reconciles the target with the sources at the start, every
+    ``watch_full_hours``, after changes were lost and after an incremental sync failed.
+
+    :param job: Job to watch.
+    :type job: :class:`jobs.SyncJob`
+    :param full_run: Function running the job in full.
+    """
+    def __init__(self, job, full_run):
+        super(WatchRunner, self).__init__()
+        self.job = job
+        self.full_run = full_run
+        self.pending = PendingChanges(job.watch_debounce, job.watch_max_delay, job.watch_max_paths)
+
+        # live directory, transfer path and excludes of every source, longest directory first
+        self.sources = []
+        for drive, sources in job.sources.items():
+            for s in sources:
+                root = os.path.abspath(fs_path(snapshots.live_path(s['snapshot'], drive, s['path'])))
+                prefix = drive[0] + '/' + s['path'].replace('\\','/').strip('/')
+                self.sources.append((root, drive, s, prefix.rstrip('/'), excludes.ExcludeFilter(job.source_excludes(s))))
+        self.sources.sort(key=lambda source: len(source[0]), reverse=True)
+
+    def source_changes(self, changes):
+        """Map changed paths to their sources and paths relative to the transfer root.
+
+        :returns: dict -- Lists of 2-tuples of source and list of 2-tuples of path and
+                  ``True`` for new directories, by drive.
+        """
+        by_source = {}
+        for path, new_dir in changes:
+            for root, drive, s, prefix, exclude_filter in self.sources:
+                if path == root or not path.startswith(os.path.join(root, '')):
+                    continue
+                relative = prefix + '/' + os.path.relpath(path, root).replace('\\', '/')
+                is_dir = os.path.isdir(path)
+                # changes of existing directories are left to the next full run
+                if (is_dir and not new_dir) or exclude_filter.is_excluded(relative, is_dir):
+                    break
+                by_source.setdefault((drive, id(s)), (drive, s, []))[2].append((relative, new_dir))
+                break
+
+        changes_by_drive = {}
+        for drive, s, paths in by_source.values():
+            changes_by_drive.setdefault(drive, []).append((s, paths))
+        return changes_by_drive
+
+    def sync(self, changes):
+        changes_by_drive = self.source_changes(changes)
+        if not changes_by_drive:
+            return
+        count = sum(len(paths) for source_changes in changes_by_drive.values() for s, paths in source_changes)
+        start = time.time()
+        self.job.stats = {}
+        self.job.sync_changes(changes_by_drive)
+        logger.info("Synced {} changed path(s) in {:.1f} s, {:.1f} kB transferred.".format(
+                    count, time.time() - start, self.job.stats.get('file_size_transferred', 0)/1024.))
+
+    def run(self, stop=None):
+        """Watch and sync until interrupted.
+
+        :param stop: Event ending the loop when set, e.g. for tests.
+        :type stop: threading.Event
+        """
+        watcher = create_watcher([root for root, drive, s, prefix, exclude_filter in self.sources], self.job.watch_poll)
+        try:
+            last_full_run = None
+            while stop is None or not stop.is_set():
+                if last_full_run is None or time.time() - last_full_run >= self.job.watch_full_hours*3600:
+                    self.pending.clear()
+                    logger.info("Running the job in full to reconcile the target with the sources.")
+                    self.full_run()
+                    last_full_run = time.time()
+
+                self.pending.add(watcher.read(1.), time.time())
+                if not self.pending.ready(time.time()):
+                    continue
+                changes = self.pending.take()
+                if changes is None:
+                    last_full_run = None
+                    continue
+                try:
+                    self.sync(changes)
+                except Exception as e:
+                    logger.error("Syncing changes failed, running the job in full: {}".format(e))
+                    logger.exception(e)
+                    last_full_run = None
+                finally:
+                    with utils.phase_timings_lock:
+                        del utils.phase_timings[:]
+        finally:
+            watcher.close()